@@ -1,83 +1,369 @@
 import logging.config
+import time
 import traceback
 
 import pandas as pd
 import yaml
 from flask import Flask
-from flask import render_template, request
+from flask import jsonify, render_template, request
 from flask_sqlalchemy import SQLAlchemy
 
-from src.modeling import get_userinput, predict_user_input
-from src.more_chocolate_plz import Chocolates
+from src.artifacts import load_catalog, probe_artifacts
+from src.audit import AuditLog
+from src.batching import MicroBatcher
+from src.cache import ResultCache, cache_key, normalize_input
+from src.catalog import CatalogStore, load_snapshot, probe_catalog
+from src.clean_data import load_preprocessor
+from src.metrics import CONTENT_TYPE, MetricsRegistry
+from src.modeling import predict_batch_from_snapshot, snapshot_recs
+from src.precompute import catalog_fingerprint, load_precomputed
+from src.registry import ModelRegistry
 
-# export FLASK_DEBUG=1
-# Initialize the Flask application
-app = Flask(__name__, template_folder="app/templates", static_folder="app/static")
 
-# Configure flask app from flask_config.py
-app.config.from_pyfile('config/flaskconfig.py')
+def timing_headers(timing, started):
+    """Response headers that report where the time of a recommendation request went"""
+    return {'Server-Timing': 'queue;dur=%.3f, batch;dur=%.3f, total;dur=%.3f' % (
+                timing['queue'] * 1000, timing['batch'] * 1000,
+                (time.perf_counter() - started) * 1000),
+            'X-Batch-Size': str(timing['batch_size']),
+            'X-Cache-Hits': str(timing['cache_hits'])}
 
-# Define LOGGING_CONFIG in flask_config.py - path to config file for setting
-# up the logger (e.g. config/logging/local.conf)
-logging.config.fileConfig(app.config["LOGGING_CONFIG"])
-logger = logging.getLogger(app.config["APP_NAME"])
-logger.debug('Web app log')
 
-# Initialize the database
-db = SQLAlchemy(app)
+def create_app(config_file='config/flaskconfig.py', **settings):
+    """Build the Flask application and load the model, the preprocessor and the catalog into it
 
-# Connect to RDS or local database and query all data
-logger.info('Connecting to %s', app.config['SQLALCHEMY_DATABASE_URI'])
-recs = db.session.query(Chocolates)
+    Everything the app serves from is loaded here, so that a server that creates the app before
+    forking its workers (gunicorn with ``preload_app``, see wsgi.py) shares it across all of them.
 
+    Args:
+        config_file (str): path of the flask configuration file
+        **settings: configuration values that override the ones of the file
 
-# load config yaml
-try:
-    with open(app.config['CONFIGS'], "r") as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
-        logger.info("Configuration file loaded from %s", app.config['CONFIGS'])
-except FileNotFoundError:
-    logger.error("Configuration file %s is not found", app.config['CONFIGS'])
+    Returns:
+        app (:obj:`flask.Flask`): the web application
+    """
+    # Initialize the Flask application
+    app = Flask(__name__, template_folder="app/templates", static_folder="app/static")
 
+    # Configure flask app from flask_config.py
+    app.config.from_pyfile(config_file)
+    app.config.update(settings)
 
-@app.route('/')
-def index():
-    """  Create view into index page that collects user input data
-    Returns: rendered html template
-    """
-    try:
-        logger.debug("Index page accessed")
-        return render_template('index.html', booleans=app.config['BOOLS'])
-    except:
-        traceback.print_exc()
-        logger.warning("Not able to display loan applications information, error page returned")
-        return render_template('error.html')
-
-
-@app.route('/submit', methods=['GET', 'POST'])
-def submit():
-    """  The submission page that list out recommendation table for user
-    Returns: rendered html template
-    """
+    # Define LOGGING_CONFIG in flask_config.py - path to config file for setting
+    # up the logger (e.g. config/logging/local.conf)
+    logging.config.fileConfig(app.config["LOGGING_CONFIG"], disable_existing_loggers=False)
+    logger = logging.getLogger(app.config["APP_NAME"])
+    logger.debug('Web app log')
+
+    # Initialize the database
+    db = SQLAlchemy(app)
+
+    logger.info('Connecting to %s', app.config['SQLALCHEMY_DATABASE_URI'])
+
+    # load config yaml
     try:
-        logger.debug("submmission page accessed")
-        # get data from rds 
-        data = pd.read_sql(recs.statement, recs.session.bind)
-        # user insert value
-        input_value = get_userinput(request.form["cocoa_percent"], request.form["rating"],
-                                    request.form["beans"], request.form["cocoa_butter"],
-                                    request.form["vanilla"], request.form["lecithin"],
-                                    request.form["salt"], request.form["sugar"],
-                                    request.form["sweetener_without_sugar"],
-                                    **config['modeling']['get_userinput'])
-        # get prediction result
-        recommendation = predict_user_input(data, input_value, **config['modeling']['predict_user_input'])
-        return render_template('submit.html', rec=recommendation.values)
-    except:
-        traceback.print_exc()
-        logger.warning("Not able to display loan applications information, error page returned")
-        return render_template('error.html')
-    
+        with open(app.config['CONFIGS'], "r") as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+            logger.info("Configuration file loaded from %s", app.config['CONFIGS'])
+    except FileNotFoundError:
+        logger.error("Configuration file %s is not found", app.config['CONFIGS'])
+        raise
+
+    predict_config = config['modeling']['predict_user_input']
+    replace_dict = config['modeling']['get_userinput']['replace_dict']
+
+    # Keep the model and the preprocessor in memory, they are swapped when run_modeling rewrites them
+    models = ModelRegistry(predict_config['model_save_path'],
+                           check_interval=app.config['MODEL_CHECK_INTERVAL'])
+    preprocessors = ModelRegistry(predict_config['preprocessor_save_path'],
+                                  loader=load_preprocessor,
+                                  check_interval=app.config['MODEL_CHECK_INTERVAL'])
+    models.load()
+    if preprocessors.get() is None:
+        logger.warning("Preprocessor could not be loaded, the scalar is fitted on the catalog instead")
+
+    def artifact_versions():
+        """Versions of the model and the preprocessor the catalog snapshot is built with"""
+        models.get()
+        preprocessors.get()
+        return models.version, preprocessors.version
+
+    def read_catalog(lazy_display=False):
+        """Read the chocolates table into a snapshot labelled by the current model"""
+        model, preprocessor = models.current, preprocessors.current
+        return load_snapshot(db.session, model.model, predict_config['features'],
+                             predict_config['web_display_vars'],
+                             preprocessor=None if preprocessor is None else preprocessor.model,
+                             model_version=model.version, lazy_display=lazy_display)
+
+    def open_catalog():
+        """Memory-map the catalog written by run_modeling, labelled by the current model"""
+        return load_catalog(app.config['CATALOG_ARTIFACTS'], models.current.model, models.version)
+
+    # Keep the chocolates table in memory, it is only re-read when stale or changed, or when the
+    # model is swapped. With CATALOG_ARTIFACTS the catalog files are mapped instead of read
+    if app.config['CATALOG_ARTIFACTS'] is None:
+        catalog = CatalogStore(read_catalog, lambda: probe_catalog(db.session),
+                               ttl=app.config['CATALOG_TTL'],
+                               probe_interval=app.config['CATALOG_PROBE_INTERVAL'],
+                               depends_on=artifact_versions)
+    else:
+        catalog = CatalogStore(open_catalog,
+                               lambda: probe_artifacts(app.config['CATALOG_ARTIFACTS']),
+                               ttl=None, probe_interval=app.config['CATALOG_PROBE_INTERVAL'],
+                               depends_on=lambda: models.get().version)
+
+    def current_snapshot():
+        """The snapshot to serve from, read from the table on every call if CATALOG_SNAPSHOT is off"""
+        if app.config['CATALOG_SNAPSHOT']:
+            return catalog.get()
+        artifact_versions()
+        return read_catalog(lazy_display=True)
+
+    # Recommendations of the whole input grid, precomputed offline for one catalog and model
+    precomputed = None if app.config['PRECOMPUTED_RECS'] is None else \
+        ModelRegistry(app.config['PRECOMPUTED_RECS'], loader=load_precomputed,
+                      check_interval=app.config['MODEL_CHECK_INTERVAL'])
+    fingerprints = {}
+
+    def precomputed_recs(snapshot):
+        """The precomputed recommendations if they were computed from this snapshot, else None"""
+        table = None if precomputed is None else precomputed.get()
+        if table is None:
+            return None
+        if snapshot.generation not in fingerprints:
+            # computed once per snapshot, the arrays are hashed
+            fingerprints.clear()
+            fingerprints[snapshot.generation] = catalog_fingerprint(snapshot)
+            if fingerprints[snapshot.generation] != table.model.fingerprint:
+                logger.warning("Precomputed recommendations in %s do not belong to the catalog "
+                               "snapshot, please rerun precompute_recs", app.config['PRECOMPUTED_RECS'])
+        return table.model if fingerprints.get(snapshot.generation) == table.model.fingerprint else None
+
+    # Recommendations of repeated user inputs, valid for one catalog snapshot and model version
+    results = ResultCache(maxsize=app.config['RESULT_CACHE_SIZE'],
+                          ttl=app.config['RESULT_CACHE_TTL'])
+
+    # Prometheus metrics of this process, scraped from /metrics, summed over the worker processes
+    # that share METRICS_DIR
+    metrics = MetricsRegistry(app.config['METRICS_DIR'])
+    stage_seconds = metrics.histogram('chocolate_stage_seconds', 'Seconds spent in every stage of '
+                                      'serving recommendations', ['stage'])
+    request_seconds = metrics.histogram('chocolate_request_seconds', 'Seconds to serve a request',
+                                        ['endpoint'])
+    batch_sizes = metrics.histogram('chocolate_batch_size', 'Number of user inputs scored together',
+                                    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+    cache_lookups = metrics.counter('chocolate_result_cache_lookups', 'User inputs looked up in the '
+                                    'result cache', ['result'])
+    grid_lookups = metrics.counter('chocolate_precomputed_lookups', 'User inputs looked up in the '
+                                   'precomputed recommendations', ['result'])
+    errors = metrics.counter('chocolate_errors', 'Requests that failed', ['endpoint', 'status'])
+
+    # Recommendations served are only logged when AUDIT_LOG_PATH is set, by a background thread
+    audit = None if app.config['AUDIT_LOG_PATH'] is None else AuditLog(app.config['AUDIT_LOG_PATH'])
+
+    def score_inputs(items):
+        """Score a micro-batch of (snapshot, normalized user input) pairs, one call per snapshot"""
+        recs = [None] * len(items)
+        for snapshot in {id(snapshot): snapshot for snapshot, _ in items}.values():
+            rows = [i for i, (item_snapshot, _) in enumerate(items) if item_snapshot is snapshot]
+            inputs = pd.DataFrame([items[i][1] for i in rows], columns=app.config['INPUT_FIELDS'])
+            timings = {}
+            for i, rec in zip(rows, predict_batch_from_snapshot(snapshot, inputs, predict_config['top'],
+                                                                timings=timings)):
+                recs[i] = rec
+            for stage, seconds in timings.items():
+                stage_seconds.observe(seconds, stage=stage)
+        batch_sizes.observe(len(items))
+        return recs
+
+    # Concurrent requests that miss the cache are scored together in one vectorized call
+    batcher = MicroBatcher(score_inputs, max_wait=app.config['BATCH_MAX_WAIT_MS'] / 1000,
+                           max_batch=app.config['BATCH_MAX_SIZE'])
+
+    def recommend(user_inputs):
+        """Recommendations for normalized user inputs, from the result cache or the micro-batcher
+
+        Returns:
+            recs (:obj:`list`): the recommendation table of every user input
+            timing (:obj:`dict`): seconds spent waiting for and running the batch, and its size
+        """
+        with stage_seconds.time(stage='db_read'):
+            snapshot = current_snapshot()
+        if not app.config['CATALOG_SNAPSHOT']:
+            # the snapshot belongs to this request, so it is scored right here without caching
+            start = time.perf_counter()
+            recs = score_inputs([(snapshot, user_input) for user_input in user_inputs])
+            timing = {'queue': 0.0, 'batch': time.perf_counter() - start,
+                      'batch_size': len(recs), 'cache_hits': 0}
+            missing = []
+        else:
+            version = (snapshot.generation, snapshot.model_version)
+            # the inputs are scored as they are, only the cache lookup is quantized
+            keys = [cache_key(user_input, app.config['RESULT_CACHE_DECIMALS'])
+                    for user_input in user_inputs]
+            recs = [results.get(key, version) for key in keys]
+            missing = [i for i, rec in enumerate(recs) if rec is None]
+            timing = {'queue': 0.0, 'batch': 0.0, 'batch_size': 0,
+                      'cache_hits': len(recs) - len(missing)}
+            cache_lookups.inc(timing['cache_hits'], result='hit')
+            cache_lookups.inc(len(missing), result='miss')
+            table = precomputed_recs(snapshot) if missing else None
+            if table is not None:
+                # an O(1) read of the grid point, only inputs off the grid are scored
+                with stage_seconds.time(stage='lookup'):
+                    for i in missing:
+                        positions = table.lookup(user_inputs[i], app.config['PRECOMPUTED_SNAP'])
+                        if positions is not None:
+                            recs[i] = snapshot_recs(snapshot, positions)
+                            results.put(keys[i], version, recs[i])
+                found = len(missing) - sum(recs[i] is None for i in missing)
+                grid_lookups.inc(found, result='hit')
+                grid_lookups.inc(len(missing) - found, result='miss')
+                missing = [i for i in missing if recs[i] is None]
+        if missing:
+            future = batcher.submit([(snapshot, user_inputs[i]) for i in missing])
+            for i, rec in zip(missing, future.result(app.config['BATCH_TIMEOUT'])):
+                results.put(keys[i], version, rec)
+                recs[i] = rec
+            timing.update(queue=future.queue_seconds, batch=future.batch_seconds,
+                          batch_size=future.batch_size)
+            stage_seconds.observe(future.queue_seconds, stage='queue')
+
+        if audit is not None:
+            for user_input, rec in zip(user_inputs, recs):
+                audit.write({'time': time.time(), 'model_version': snapshot.model_version,
+                             'input': dict(zip(app.config['INPUT_FIELDS'], user_input)),
+                             'recommendations': rec['chocolate_bar'].tolist()})
+        return recs, timing
+
+    warm = {'ready': False}
+
+    def warm_up():
+        """Load the catalog snapshot and run one prediction through it, on the calling thread"""
+        with app.app_context():
+            try:
+                snapshot = current_snapshot()
+                if app.config['CATALOG_SNAPSHOT']:
+                    precomputed_recs(snapshot)
+                inputs = pd.DataFrame([[70.0, 3.5] + [0] * (len(app.config['INPUT_FIELDS']) - 2)],
+                                      columns=app.config['INPUT_FIELDS'])
+                predict_batch_from_snapshot(snapshot, inputs, predict_config['top'])
+                warm['ready'] = True
+                logger.info("App is warm with %i chocolate bars", len(snapshot))
+            except Exception as errors:
+                logger.error("Catalog snapshot could not be loaded: %s", errors)
+            finally:
+                db.session.remove()
+        return warm['ready']
+
+    warm_up()
+    # connections opened while warming up must not be shared with forked workers
+    db.get_engine(app).dispose()
+
+    @app.route('/healthz')
+    def healthz():
+        """  Liveness probe, the process is up
+        Returns: json response
+        """
+        return jsonify(status='ok')
+
+    @app.route('/ready')
+    def ready():
+        """  Readiness probe, passes once the model and the catalog are loaded and warm
+        Returns: json response
+        """
+        if warm['ready'] or warm_up():
+            return jsonify(status='ready', model_version=models.version,
+                           chocolate_bars=len(current_snapshot()))
+        return jsonify(status='warming up'), 503
+
+    @app.route('/')
+    def index():
+        """  Create view into index page that collects user input data
+        Returns: rendered html template
+        """
+        try:
+            logger.debug("Index page accessed")
+            return render_template('index.html', booleans=app.config['BOOLS'])
+        except:
+            traceback.print_exc()
+            logger.warning("Not able to display loan applications information, error page returned")
+            return render_template('error.html')
+
+    @app.route('/submit', methods=['GET', 'POST'])
+    def submit():
+        """  The submission page that list out recommendation table for user
+        Returns: rendered html template
+        """
+        try:
+            logger.debug("submmission page accessed")
+            started = time.perf_counter()
+            # user insert value, normalized so that repeated inputs share a cache entry
+            user_input = normalize_input([request.form[name] for name in app.config['INPUT_FIELDS']],
+                                         replace_dict)
+            # get prediction result with the model the snapshot was labelled by
+            recs, timing = recommend([user_input])
+            with stage_seconds.time(stage='render'):
+                page = render_template('submit.html', rec=recs[0].records())
+            request_seconds.observe(time.perf_counter() - started, endpoint='submit')
+            return page, timing_headers(timing, started)
+        except:
+            traceback.print_exc()
+            errors.inc(endpoint='submit', status='500')
+            logger.warning("Not able to display loan applications information, error page returned")
+            return render_template('error.html')
+
+    @app.route('/api/recommend', methods=['POST'])
+    def api_recommend():
+        """  JSON recommendations for one user profile, or for an array of them
+        Returns: json response
+        """
+        started = time.perf_counter()
+        payload = request.get_json(silent=True)
+        profiles = payload if isinstance(payload, list) else [payload]
+        try:
+            if not profiles:
+                raise ValueError("no profile is provided")
+            user_inputs = [normalize_input([profile[name] for name in app.config['INPUT_FIELDS']],
+                                           replace_dict)
+                           for profile in profiles]
+        except (TypeError, KeyError, ValueError) as invalid:
+            logger.warning("Invalid recommendation request: %s", invalid)
+            errors.inc(endpoint='api_recommend', status='400')
+            return jsonify(error="Profiles must be json objects with the fields %s, invalid: %s" %
+                                 (', '.join(app.config['INPUT_FIELDS']), invalid)), 400
+
+        try:
+            recs, timing = recommend(user_inputs)
+        except Exception as failure:
+            logger.error("Not able to generate recommendations: %s", failure)
+            errors.inc(endpoint='api_recommend', status='500')
+            return jsonify(error="Not able to generate recommendations"), 500
+
+        body = [{'recommendations': rec.records()} for rec in recs]
+        response = jsonify(body if isinstance(payload, list) else body[0])
+        request_seconds.observe(time.perf_counter() - started, endpoint='api_recommend')
+        return response, timing_headers(timing, started)
+
+    @app.after_request
+    def flush_metrics(response):
+        """  Write the metrics of this worker for /metrics of the others, at most once a second
+        Returns: the response unchanged
+        """
+        metrics.flush()
+        return response
+
+    @app.route('/metrics')
+    def metrics_page():
+        """  Prometheus metrics of this process, summed over all workers when METRICS_DIR is set
+        Returns: text response
+        """
+        return metrics.render(), 200, {'Content-Type': CONTENT_TYPE}
+
+    return app
+
 
 if __name__ == '__main__':
+    app = create_app()
     app.run(debug=app.config["DEBUG"], port=app.config["PORT"], host=app.config["HOST"])
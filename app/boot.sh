@@ -1,3 +1,9 @@
 #!/usr/bin/env bash
 
-python3 app.py
\ No newline at end of file
+if [ "${FLASK_ENV}" = "development" ]; then
+    python3 app.py
+else
+    # per-request DEBUG messages are not written in production
+    export LOGGING_CONFIG="${LOGGING_CONFIG:-config/logging/production.conf}"
+    exec gunicorn -c gunicorn.conf.py wsgi:app
+fi
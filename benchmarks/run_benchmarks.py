@@ -0,0 +1,288 @@
+"""Time and memory-profile the pipeline and serving functions on generated catalogs
+
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 --output benchmarks/results/head.json
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 --baseline benchmarks/results/head.json
+
+Every function runs ``--repeat`` times for the timing and once more under tracemalloc for the
+peak memory it allocates. The database functions run against a SQLite file and the S3 functions
+against moto's in-memory S3, so no credentials or servers are needed.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import yaml
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.synthetic import write_catalog
+from src.clean_data import clean, fit_preprocessor, read_data, read_data_chunks, standardization
+from src.modeling import (formatting_preds, generate_kmeans, get_userinput, model_evaluation,
+                          predict_user_input)
+from src.more_chocolate_plz import Chocolates, add_rows, bulk_add_rows, create_db, get_engine
+
+logger = logging.getLogger('benchmarks')
+
+MB = 1024 * 1024
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+
+def measure(run, repeat=3, reset=None):
+    """Time ``run`` and trace the peak memory it allocates
+
+    Args:
+        run (callable): the code to measure
+        repeat (int): number of timed calls
+        reset (callable): called before every call, outside of the measurement
+
+    Returns:
+        result (:obj:`dict`): the fastest and mean seconds, and the peak traced memory in MB
+    """
+    seconds = []
+    for _ in range(repeat):
+        if reset is not None:
+            reset()
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+
+    # traced separately, tracemalloc slows the call down
+    if reset is not None:
+        reset()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'mean_seconds': sum(seconds) / len(seconds),
+            'repeat': repeat, 'peak_memory_mb': peak / MB}
+
+
+def pipeline_cases(raw_path, workdir, config):
+    """The benchmarks of the modeling pipeline and the web app prediction, by name"""
+    clean_config = dict(config['clean_data']['clean'], store_path=os.path.join(workdir, 'clean.csv'))
+    features = config['clean_data']['standardization']['features']
+    kmeans_config = dict(config['modeling']['generate_kmeans'],
+                         model_save_path=os.path.join(workdir, 'kmeans.joblib'))
+    eval_config = dict(config['modeling']['model_evaluation'],
+                       metric_save_path=os.path.join(workdir, 'metrics.csv'))
+    predict_config = dict(config['modeling']['predict_user_input'],
+                          model_save_path=kmeans_config['model_save_path'],
+                          preprocessor_save_path=os.path.join(workdir, 'preprocessor.joblib'),
+                          store_path=None)
+
+    # inputs of every stage are the outputs of the one before, computed once outside of the timing
+    raw_df = read_data(raw_path, **config['clean_data']['read_data'])
+    df = clean(raw_df.copy(), **clean_config)
+    preprocessor = fit_preprocessor(df, features, predict_config['preprocessor_save_path'])
+    scale_df = df.copy()
+    scale_df[features] = preprocessor['scalar'].transform(df[features].values)
+    model = generate_kmeans(scale_df, **kmeans_config)
+
+    # the web app reads the chocolates table, which has the row number as index column
+    data = df.assign(index=np.arange(len(df)))
+    user_input = get_userinput(70, 3.5, 'Yes', 'Yes', 'No', 'No', 'No', 'Yes', 'No',
+                               **config['modeling']['get_userinput'])
+    preds = pd.concat([data[predict_config['clean_vars']], user_input])
+    scaled_preds = preds.copy()
+    scaled_preds[features] = preprocessor['scalar'].transform(preds[features].values)
+    preds['cluster_label'] = model.predict(scaled_preds[features].values)
+    preds[features] = scaled_preds[features]
+
+    return {
+        'read_data': (lambda: read_data(raw_path, **config['clean_data']['read_data']), None),
+        # clean encodes the frame it is given in place
+        'clean': (lambda: clean(raw_df.copy(), **clean_config), None),
+        'standardization': (lambda: standardization(df, features), None),
+        'generate_kmeans': (lambda: generate_kmeans(scale_df, **kmeans_config), None),
+        'model_evaluation': (lambda: model_evaluation(scale_df, model, **eval_config), None),
+        'predict_user_input': (lambda: predict_user_input(data, user_input, **predict_config), None),
+        'formatting_preds': (lambda: formatting_preds(preds, data[predict_config['web_display_vars']],
+                                                      features, predict_config['top']), None),
+    }
+
+
+def database_cases(workdir):
+    """The benchmarks of loading the cleaned data into a SQLite database, by name"""
+    engine_string = 'sqlite:///%s' % os.path.join(workdir, 'chocolates.db')
+    create_db(engine_string)
+    engine = get_engine(engine_string)
+    session = sessionmaker(bind=engine)()
+    clean_path = os.path.join(workdir, 'clean.csv')
+
+    def empty_table():
+        session.query(Chocolates).delete()
+        session.commit()
+
+    return {
+        'add_rows': (lambda: add_rows(clean_path, session), empty_table),
+        'bulk_add_rows': (lambda: bulk_add_rows(clean_path, engine), empty_table),
+    }
+
+
+def s3_cases(raw_path, config):
+    """The benchmarks of moving the raw data through S3, by name, run inside a moto mock"""
+    import boto3
+    from src.s3 import upload_file_to_s3
+
+    client = boto3.client('s3')
+    client.create_bucket(Bucket='benchmarks')
+    s3path = 's3://benchmarks/chocolate.csv'
+    upload_file_to_s3(raw_path, s3path, client=client)
+
+    def stream_chunks():
+        for _ in read_data_chunks(s3path, **config['clean_data']['read_data_chunks']):
+            pass
+
+    return {
+        'upload_file_to_s3': (lambda: upload_file_to_s3(raw_path, s3path, skip_unchanged=False,
+                                                        client=client), None),
+        'read_data_chunks_s3': (stream_chunks, None),
+    }
+
+
+def run_size(n_rows, config, repeat=3, select=None, max_add_rows=100000, seed=423):
+    """Run every benchmark on a generated catalog of ``n_rows`` chocolate bars
+
+    Args:
+        n_rows (int): number of chocolate bars in the catalog
+        config (:obj:`dict`): the pipeline configuration, see config/config.yaml
+        repeat (int): number of timed calls of every function
+        select (:obj:`list`): names of the benchmarks to run, every benchmark if None
+        max_add_rows (int): largest catalog loaded row by row with add_rows
+        seed (int): the random state of the catalog generator
+
+    Returns:
+        results (:obj:`list`): one record per benchmark
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        raw_path = write_catalog(os.path.join(workdir, 'chocolate.csv'), n_rows, seed)
+        cases = pipeline_cases(raw_path, workdir, config)
+        cases.update(database_cases(workdir))
+        try:
+            from moto import mock_aws
+        except ImportError:  # moto < 5
+            try:
+                from moto import mock_s3 as mock_aws
+            except ImportError:
+                mock_aws = None
+                logger.warning("moto is not installed, the S3 benchmarks are skipped")
+
+        def record(name, run, reset):
+            if select is not None and name not in select:
+                return
+            if name == 'add_rows' and n_rows > max_add_rows:
+                logger.info("add_rows is skipped for %i rows, above --max_add_rows", n_rows)
+                return
+            result = dict(benchmark=name, rows=n_rows, **measure(run, repeat, reset))
+            logger.info("%-20s %9i rows %10.4f s %10.1f MB", name, n_rows, result['seconds'],
+                        result['peak_memory_mb'])
+            results.append(result)
+
+        for name, (run, reset) in cases.items():
+            record(name, run, reset)
+        if mock_aws is not None:
+            with mock_aws():
+                for name, (run, reset) in s3_cases(raw_path, config).items():
+                    record(name, run, reset)
+    return results
+
+
+def git_commit():
+    """The commit the benchmarks run on, None outside of a git checkout"""
+    try:
+        # no capture_output, it is new in Python 3.7
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold=1.2):
+    """Compare the fastest times against a baseline run
+
+    Args:
+        results (:obj:`list`): the records of this run
+        baseline (:obj:`list`): the records of the baseline run
+        threshold (float): ratio of the times above which a benchmark counts as a regression
+
+    Returns:
+        regressions (:obj:`list`): (benchmark, rows, ratio) of every regression
+    """
+    before = {(r['benchmark'], r['rows']): r['seconds'] for r in baseline}
+    regressions = []
+    for r in results:
+        key = (r['benchmark'], r['rows'])
+        if key not in before:
+            continue
+        ratio = r['seconds'] / max(before[key], 1e-9)
+        logger.info("%-20s %9i rows %6.2fx of the baseline", key[0], key[1], ratio)
+        if ratio > threshold:
+            regressions.append((key[0], key[1], ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline and serving functions on "
+                                                 "generated chocolate catalogs")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="Number of chocolate bars of every catalog")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of timed calls per function")
+    parser.add_argument('--benchmarks', nargs='+', default=None,
+                        help="Names of the benchmarks to run, all by default")
+    parser.add_argument('--max_add_rows', type=int, default=100000,
+                        help="Largest catalog loaded row by row with add_rows")
+    parser.add_argument('--seed', type=int, default=423, help="Random state of the catalog generator")
+    parser.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    parser.add_argument('--output', default=None,
+                        help="Path of the JSON results, benchmarks/results/<commit>.json by default")
+    parser.add_argument('--baseline', default=None,
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="Slowdown against the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        level=logging.INFO)
+    # the functions under test log every call
+    logging.getLogger('src').setLevel(logging.WARNING)
+    logging.getLogger('s3').setLevel(logging.WARNING)
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmarks')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmarks')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    results = []
+    for n_rows in args.sizes:
+        results += run_size(n_rows, config, args.repeat, args.benchmarks, args.max_add_rows,
+                            args.seed)
+
+    commit = git_commit()
+    report = {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'machine': platform.platform(),
+              'cpus': os.cpu_count(), 'seed': args.seed, 'results': results}
+    output = args.output or os.path.join('benchmarks', 'results', '%s.json' % (commit or 'local')[:12])
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info("Results are saved to %s", output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        for name, n_rows, ratio in regressions:
+            logger.warning("%s on %i rows is %.2fx slower than the baseline", name, n_rows, ratio)
+        if regressions:
+            raise SystemExit(1)
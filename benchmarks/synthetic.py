@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+# share of bars that have every ingredient, close to the Flavors of Cacao data in data/chocolate_data
+INGREDIENTS = {'bean': 1.0, 'cocoa_butter': 0.69, 'vanila': 0.156, 'lecithin': 0.215, 'salt': 0.017,
+               'sugar': 0.963, 'sweetener_without_sugar': 0.034}
+INGREDIENT_COLUMNS = {'bean': 'beans', 'cocoa_butter': 'cocoa_butter', 'vanila': 'vanilla',
+                      'lecithin': 'lecithin', 'salt': 'salt', 'sugar': 'sugar',
+                      'sweetener_without_sugar': 'sweetener_without_sugar'}
+RATINGS = [1.0, 1.5, 2.0, 2.25, 2.5, 2.75, 3.0, 3.25, 3.5, 3.75, 4.0]
+RATING_SHARES = [0.001, 0.002, 0.013, 0.006, 0.067, 0.137, 0.212, 0.177, 0.22, 0.119, 0.046]
+TASTES = ['cocoa', 'nutty', 'roasty', 'fruity', 'creamy', 'sweet', 'earthy', 'spicy', 'floral',
+          'sour', 'bitter', 'vanilla', 'caramel', 'coffee', 'woody', 'citrus', 'berry', 'smoky',
+          'grassy', 'honey', 'milk', 'molasses', 'tobacco', 'banana', 'coconut', 'strong', 'mild']
+COUNTRIES = ['Peru', 'Venezuela', 'Ecuador', 'Dominican republic', 'Madagascar', 'Bolivia',
+             'Nicaragua', 'Colombia', 'Tanzania', 'Brazil', 'Belize', 'Ghana', 'Vietnam', 'Mexico',
+             'Papua new guinea', 'Trinidad', 'Guatemala', 'Costa rica', 'Haiti', 'Uganda']
+LOCATIONS = ['U.S.A', 'France', 'Canada', 'U.K.', 'Italy', 'Belgium', 'Ecuador', 'Australia',
+             'Switzerland', 'Germany', 'Japan', 'Spain']
+
+
+def generate_catalog(n_rows, seed=423):
+    """Generate raw chocolate bar records with the columns and value formats of the raw data
+
+    The marginal distributions of cocoa percent, rating and ingredients follow the real data, the
+    names are made up. The same ``n_rows`` and ``seed`` always give the same records.
+
+    Args:
+        n_rows (int): number of chocolate bars
+        seed (int): the random state
+
+    Returns:
+        data (:obj:`DataFrame <pandas.DataFrame>`): the raw records, like data/chocolate_data/chocolate.csv
+    """
+    if n_rows < 1:
+        raise ValueError("A catalog needs at least one chocolate bar, got %i" % n_rows)
+    rng = np.random.default_rng(seed)
+    # a catalog of any size has about one company per 4.4 bars, like the real data
+    n_companies = max(1, n_rows * 10 // 44)
+
+    data = pd.DataFrame({
+        'ref': rng.integers(5, 2500, n_rows),
+        'company': np.char.add('company ', rng.integers(0, n_companies, n_rows).astype(str)),
+        'company_location': rng.choice(LOCATIONS, n_rows),
+        'review_date': rng.integers(2006, 2022, n_rows),
+        'country_of_bean_origin': rng.choice(COUNTRIES, n_rows),
+        'specific_bean_origin_or_bar_name': np.char.add('bar ', rng.integers(0, n_rows, n_rows).astype(str)),
+        'cocoa_percent': np.clip(np.round(rng.normal(71.5, 5.3, n_rows)), 42, 100),
+        'rating': rng.choice(RATINGS, n_rows, p=RATING_SHARES),
+    })
+
+    has = {name: rng.random(n_rows) < share for name, share in INGREDIENTS.items()}
+    data['counts_of_ingredients'] = np.sum(list(has.values()), axis=0)
+    for name, column in INGREDIENT_COLUMNS.items():
+        data[column] = np.where(has[name], 'have_' + name, 'have_not_' + name)
+
+    data['first_taste'] = rng.choice(TASTES, n_rows)
+    data['second_taste'] = rng.choice(TASTES, n_rows)
+    # most bars have fewer than four tastes
+    data['third_taste'] = np.where(rng.random(n_rows) < 0.72, rng.choice(TASTES, n_rows), None)
+    data['fourth_taste'] = np.where(rng.random(n_rows) < 0.11, rng.choice(TASTES, n_rows), None)
+    return data
+
+
+def write_catalog(path, n_rows, seed=423):
+    """Write a generated catalog to csv in the layout of the raw data, with an unnamed index column
+
+    Args:
+        path (str): the path of the csv
+        n_rows (int): number of chocolate bars
+        seed (int): the random state
+
+    Returns:
+        path (str): the path of the csv
+    """
+    generate_catalog(n_rows, seed).to_csv(path)
+    return path
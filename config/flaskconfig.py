@@ -1,6 +1,7 @@
 import os
 DEBUG = True
-LOGGING_CONFIG = "config/logging/local.conf"
+# config/logging/production.conf logs at INFO instead of DEBUG
+LOGGING_CONFIG = os.environ.get("LOGGING_CONFIG", "config/logging/local.conf")
 PORT = 5000
 APP_NAME = "chocolate"
 SQLALCHEMY_TRACK_MODIFICATIONS = True
@@ -10,9 +11,45 @@ MAX_ROWS_SHOW = 100
 
 # boolean list used for index html
 BOOLS = ['Yes', 'No']
+# form fields of the user input, in the order of get_userinput
+INPUT_FIELDS = ['cocoa_percent', 'rating', 'beans', 'cocoa_butter', 'vanilla', 'lecithin', 'salt',
+                'sugar', 'sweetener_without_sugar']
 # config file path
 CONFIGS = 'config/config.yaml'
 
+# in-memory catalog snapshot: set CATALOG_SNAPSHOT=false to query the table on every request
+# instead, otherwise reload after CATALOG_TTL seconds, and probe the table
+# row count / max index for changes at most every CATALOG_PROBE_INTERVAL seconds. Without the
+# snapshot every request reads the features of all rows and predicts their clusters: O(rows)
+CATALOG_SNAPSHOT = os.environ.get("CATALOG_SNAPSHOT", "true").lower() == "true"
+CATALOG_TTL = int(os.environ.get("CATALOG_TTL", 3600))
+CATALOG_PROBE_INTERVAL = int(os.environ.get("CATALOG_PROBE_INTERVAL", 30))
+# directory of the memory-mapped catalog written by run_modeling (e.g. data/catalog), served
+# instead of the chocolates table when set
+CATALOG_ARTIFACTS = os.environ.get("CATALOG_ARTIFACTS")
+# look for a new model / preprocessor file at most every MODEL_CHECK_INTERVAL seconds
+MODEL_CHECK_INTERVAL = int(os.environ.get("MODEL_CHECK_INTERVAL", 10))
+# cache of recommendation results keyed by the user input rounded to RESULT_CACHE_DECIMALS, which
+# must keep the quarter-point ratings apart. The unrounded input is what gets scored
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 4096))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 600))
+RESULT_CACHE_DECIMALS = 2
+# cache misses of concurrent requests are scored together: a batch waits up to BATCH_MAX_WAIT_MS
+# milliseconds for up to BATCH_MAX_SIZE user inputs, requests give up after BATCH_TIMEOUT seconds
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 2))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 256))
+BATCH_TIMEOUT = 5
+# recommendations of the whole input grid written by run.py precompute_recs (e.g.
+# data/precomputed_recs.npz), served when they belong to the catalog snapshot. With
+# PRECOMPUTED_SNAP inputs between grid points take the nearest one, otherwise they are scored
+PRECOMPUTED_RECS = os.environ.get("PRECOMPUTED_RECS")
+PRECOMPUTED_SNAP = os.environ.get("PRECOMPUTED_SNAP", "true").lower() == "true"
+# append the recommendations served to this JSON lines file, nothing is written if unset
+AUDIT_LOG_PATH = os.environ.get("AUDIT_LOG_PATH")
+# directory the worker processes write their metrics to, so that /metrics of any worker serves
+# the sum over all of them; every process only serves its own if unset. gunicorn.conf.py sets it
+METRICS_DIR = os.environ.get("METRICS_DIR")
+
 # Connection string
 DB_HOST = os.environ.get("MYSQL_HOST")
 DB_PORT = os.environ.get("MYSQL_PORT")
@@ -29,3 +66,11 @@ else:
     SQLALCHEMY_DATABASE_URI = "{dialect}://{user}:{pw}@{host}:{port}/{db}".format(dialect=DB_DIALECT, user=DB_USER,
                                                                                   pw=DB_PW, host=DB_HOST, port=DB_PORT,
                                                                                   db=DATABASE)
+
+# connection pool of the database engine, sqlite is not pooled by size
+SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": True}
+if not SQLALCHEMY_DATABASE_URI.startswith("sqlite"):
+    SQLALCHEMY_ENGINE_OPTIONS.update(pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+                                     max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+                                     pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+                                     pool_timeout=int(os.environ.get("DB_POOL_TIMEOUT", 10)))
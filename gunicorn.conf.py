@@ -0,0 +1,41 @@
+import gc
+import glob
+import multiprocessing
+import os
+import tempfile
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+bind = "0.0.0.0:%s" % os.environ.get("PORT", 5000)
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# threads let requests of one worker share a micro-batch
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 30
+# the workers write their metrics here and /metrics sums them, see config/flaskconfig.py
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "chocolate_metrics"))
+
+# create the app, and with it the model, the scalar and the catalog arrays, once in the master
+# so that the workers share those pages copy-on-write instead of loading a copy each
+preload_app = True
+
+
+def on_starting(server):
+    # the metrics of the workers of an earlier server are not carried over. The directory itself
+    # was already created by the preloaded app
+    for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "*.json")):
+        os.remove(path)
+
+
+def pre_fork(server, worker):
+    # objects loaded by the master are left out of the workers' garbage collection, which would
+    # otherwise write to them and copy their pages into every worker. gc.freeze is new in Python
+    # 3.7, the python3 of the ubuntu:18.04 images is 3.6 and only misses out on the sharing
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    # the worker does not count the metrics of the master again. Done by a fork hook from Python
+    # 3.7, again here for the python3 of the ubuntu:18.04 images, 3.6
+    from src.metrics import reset_after_fork
+    reset_after_fork()
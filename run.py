@@ -1,21 +1,292 @@
 import argparse
 import logging.config
-import pkg_resources
+import os
 
-import yaml
+from config.flaskconfig import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_ENGINE_OPTIONS
 
-from config.flaskconfig import SQLALCHEMY_DATABASE_URI
-from src.clean_data import clean, standardization, read_data
-from src.modeling import generate_kmeans, model_evaluation
-from src.more_chocolate_plz import create_db, upload_to_rds
-from src.s3 import upload_file_to_s3, download_file_from_s3
-
-logging.config.fileConfig(pkg_resources.resource_filename(__name__, "config/logging/local.conf"),
-                          disable_existing_loggers=False)
+logging.config.fileConfig(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "logging",
+                                       "local.conf"), disable_existing_loggers=False)
 logger = logging.getLogger("chocolate bars")
 
-if __name__ == '__main__':
 
+def load_config(config_path):
+    """Load the yaml configuration file for parameters and tmo path"""
+    import yaml
+
+    try:
+        with open(config_path, "r") as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+            logger.info("Configuration file loaded from %s", config_path)
+    except FileNotFoundError:
+        logger.error("Configuration file %s is not found", config_path)
+        raise
+    return config
+
+
+def transfer(args):
+    """Upload data to s3 or download it, one file or a whole prefix"""
+    from src.s3 import (download_file_from_s3, sync_from_s3, sync_to_s3, transfer_config,
+                        upload_file_to_s3)
+
+    sb_used = args.subparser_name
+    config = transfer_config(multipart_threshold=args.multipart_threshold,
+                             multipart_chunksize=args.multipart_chunksize,
+                             max_concurrency=args.max_concurrency)
+    if sb_used == "upload" and args.recursive:
+        sync_to_s3(args.local_path, args.s3path, config, not args.force, args.max_workers)
+    elif sb_used == "upload":
+        upload_file_to_s3(args.local_path, args.s3path, config, not args.force)
+    elif args.recursive:
+        sync_from_s3(args.s3path, args.local_path, config, not args.force, args.max_workers)
+    else:
+        download_file_from_s3(args.local_path, args.s3path, config, not args.force)
+
+
+def create_database(args):
+    """Create the chocolates table"""
+    from src.more_chocolate_plz import create_db
+
+    # the pool settings are meant for the configured database only
+    create_db(args.engine_string, SQLALCHEMY_ENGINE_OPTIONS
+              if args.engine_string == SQLALCHEMY_DATABASE_URI else None)
+
+
+def run_modeling(args):
+    """Clean the raw data, fit the model and build the catalog, skipping unchanged stages"""
+    import tempfile
+
+    import numpy as np
+    import pandas as pd
+    from joblib import load
+
+    import src.artifacts
+    import src.clean_data
+    import src.modeling
+    import src.recommender
+    from src.artifacts import catalog_meta, save_catalog
+    from src.clean_data import (apply_preprocessor, clean, clean_streaming, fit_preprocessor,
+                                load_preprocessor, read_data, read_data_chunks, save_scaled_chunks)
+    from src.metrics import StageTimer
+    from src.modeling import generate_kmeans, model_evaluation
+    from src.recommender import build_cluster_index, save_cluster_index
+    from src.registry import file_hash
+    from src.stage_cache import StageCache, code_version, input_hash
+
+    # load configuration file for parameters and tmo path
+    config = load_config(args.config)
+    clean_config = config['clean_data']
+    kmeans_config = config['modeling']['generate_kmeans']
+    catalog_config = config['modeling']['catalog_artifacts']
+    # every stage is skipped when its inputs, config and code are unchanged since a cached run
+    cache = StageCache(config['stage_cache']['directory'],
+                       config['stage_cache']['enabled'] and not args.no_cache,
+                       config['stage_cache']['keep'])
+    # wall time and peak RSS of every stage
+    timer = StageTimer()
+    state = {}
+    # the minibatch engine streams the cleaned data through every stage instead of loading it
+    minibatch = kmeans_config['engine'] == 'minibatch'
+    tmp_dir = tempfile.TemporaryDirectory()
+
+    def run_clean():
+        if clean_config['streaming']:
+            # clean raw data chunk by chunk, the scalar is fitted on the way
+            chunks = read_data_chunks(args.local_path, **clean_config['read_data_chunks'])
+            clean_streaming(chunks, **clean_config['clean'], **clean_config['standardization'])
+        else:
+            # read in raw data
+            raw_df = read_data(args.local_path, **clean_config['read_data'])
+            # clean data
+            state['df'] = clean(raw_df, **clean_config['clean'])
+            # fit the scalar once and save it next to the model
+            state['preprocessor'] = fit_preprocessor(state['df'], **clean_config['standardization'])
+
+    # cleaning and standardization share a stage, the streaming path fits the scalar while cleaning
+    with timer.stage('clean') as record:
+        clean_key = cache.fingerprint('clean', clean_config, [input_hash(args.local_path)],
+                                      code_version(src.clean_data))
+        record['ran'] = cache.run('clean', clean_key,
+                                  {'clean_data.csv': clean_config['clean']['store_path'],
+                                   'preprocessor.joblib': clean_config['standardization']['save_path']},
+                                  run_clean)
+        preprocessor = state['preprocessor'] if 'preprocessor' in state else \
+            load_preprocessor(clean_config['standardization']['save_path'])
+
+    def clean_chunks():
+        # a fresh pass over the cleaned data, with the text columns kept as text in every chunk
+        dtypes = {name: dtype for name, dtype in clean_config['read_data_chunks']['dtypes'].items()
+                  if dtype == 'str'}
+        return read_data_chunks(clean_config['clean']['store_path'], None,
+                                kmeans_config['batch_size'], dtypes=dtypes)
+
+    def frame():
+        # the cleaned data in memory, never loaded by the minibatch engine
+        if 'df' not in state:
+            state['df'] = pd.read_csv(clean_config['clean']['store_path'])
+        return state['df']
+
+    def scaled():
+        # standardization, only computed by the stages that run
+        if 'scale_df' not in state:
+            state['scale_df'] = apply_preprocessor(frame(), preprocessor)
+        return state['scale_df']
+
+    def scaled_values():
+        # the scaled features, memory-mapped from a temporary file with the minibatch engine
+        if 'values' not in state:
+            state['values'] = save_scaled_chunks(clean_chunks(), preprocessor,
+                                                 os.path.join(tmp_dir.name, 'values.npy')) \
+                if minibatch else scaled()[preprocessor['features']].values
+        return state['values']
+
+    def run_fit():
+        # generate k means model and save to joblib
+        if minibatch:
+            # stream the cleaned data instead of fitting on the in-memory frame
+            def read_chunks():
+                return (apply_preprocessor(chunk, preprocessor) for chunk in clean_chunks())
+            model = generate_kmeans(read_chunks, **kmeans_config)
+        else:
+            model = generate_kmeans(scaled(), **kmeans_config)
+        # precompute the per-cluster nearest-neighbour index used for recommendations
+        index = build_cluster_index(scaled_values(), model.labels_, model.n_clusters)
+        save_cluster_index(index, **config['modeling']['cluster_index'])
+        state['model'] = model
+
+    with timer.stage('fit') as record:
+        fit_key = cache.fingerprint('fit', [kmeans_config, config['modeling']['cluster_index']],
+                                    [clean_key], code_version(src.modeling, src.recommender))
+        record['ran'] = cache.run('fit', fit_key,
+                                  {'kmeans.joblib': kmeans_config['model_save_path'],
+                                   'cluster_index.joblib': config['modeling']['cluster_index']['save_path']},
+                                  run_fit)
+        model = state['model'] if 'model' in state else load(kmeans_config['model_save_path'])
+
+    with timer.stage('catalog') as record:
+        # memory-mapped catalog for the web app and the batch scorer. It is versioned in its own
+        # directory rather than copied into the stage cache, so it is rebuilt unless the current
+        # version was built with the same fingerprint, e.g. not after a sweep or another model
+        catalog_key = cache.fingerprint('catalog', catalog_config, [fit_key], code_version(src.artifacts))
+        meta = catalog_meta(catalog_config['directory'])
+        record['ran'] = not cache.enabled or meta is None or meta.get('fingerprint') != catalog_key
+        if record['ran']:
+            logger.info("Running stage catalog (%s)", catalog_key[:12])
+            save_catalog(clean_chunks if minibatch else frame(), model, preprocessor,
+                         model_version=file_hash(kmeans_config['model_save_path']),
+                         fingerprint=catalog_key, **catalog_config)
+        else:
+            logger.info("Stage catalog is unchanged (%s), current version kept", catalog_key[:12])
+
+    # model evaluation, a change to its config does not refit the model
+    eval_config = config['modeling']['model_evaluation']
+
+    def run_evaluation():
+        if minibatch:
+            # every metric is computed on a sample of the memory-mapped features
+            values = scaled_values()
+            sample = np.sort(np.random.RandomState(eval_config['seed']).choice(
+                len(values), min(eval_config['sample_size'] or len(values), len(values)),
+                replace=False))
+            data = pd.DataFrame(values[sample], columns=preprocessor['features'])
+        else:
+            data = scaled()
+        model_evaluation(data, model, **eval_config)
+
+    with timer.stage('model_evaluation') as record:
+        record['ran'] = cache.run('model_evaluation',
+                                  cache.fingerprint('model_evaluation', eval_config, [fit_key],
+                                                    code_version(src.modeling)),
+                                  {'performance_metric.csv': eval_config['metric_save_path']},
+                                  run_evaluation)
+    timer.save(**config['pipeline_metrics'])
+    tmp_dir.cleanup()
+
+
+def sweep(args):
+    """Fit k-means over a grid of cluster numbers and seeds and promote the best model"""
+    import pandas as pd
+
+    from src.artifacts import save_catalog
+    from src.clean_data import apply_preprocessor, fit_preprocessor
+    from src.modeling import model_evaluation
+    from src.recommender import build_cluster_index, save_cluster_index
+    from src.registry import file_hash
+    from src.sweep import sweep_kmeans
+
+    config = load_config(args.config)
+    # refit the scalar on the cleaned data so the promoted model and scalar belong together
+    df = pd.read_csv(config['clean_data']['clean']['store_path'])
+    preprocessor = fit_preprocessor(df, **config['clean_data']['standardization'])
+    scale_df = apply_preprocessor(df, preprocessor)
+    model, _ = sweep_kmeans(scale_df, **config['modeling']['sweep'])
+    index = build_cluster_index(scale_df[preprocessor['features']].values, model.labels_,
+                                model.n_clusters)
+    save_cluster_index(index, **config['modeling']['cluster_index'])
+    save_catalog(df, model, preprocessor,
+                 model_version=file_hash(config['modeling']['sweep']['model_save_path']),
+                 **config['modeling']['catalog_artifacts'])
+    model_evaluation(scale_df, model, **config['modeling']['model_evaluation'])
+
+
+def recommend_batch(args):
+    """Score a file of user profiles in one vectorized call"""
+    from src.recommender import score_profiles
+
+    config = load_config(args.config)
+    score_profiles(args.input_path, args.output_path, **config['modeling']['recommend_batch'])
+
+
+def precompute(args):
+    """Precompute the recommendations of the whole grid of user inputs"""
+    from joblib import load
+    from sqlalchemy.orm import sessionmaker
+
+    from src.artifacts import load_catalog
+    from src.catalog import load_snapshot
+    from src.clean_data import load_preprocessor
+    from src.more_chocolate_plz import get_engine
+    from src.precompute import precompute_recs
+    from src.registry import file_hash
+
+    config = load_config(args.config)
+    precompute_config = dict(config['modeling']['precompute_recs'])
+    artifact_dir = precompute_config.pop('artifact_dir')
+    model_save_path = precompute_config.pop('model_save_path')
+    preprocessor_save_path = precompute_config.pop('preprocessor_save_path')
+    display_vars = precompute_config.pop('display_vars')
+    model, model_version = load(model_save_path), file_hash(model_save_path)
+    # score against the same catalog the web app serves, so that the fingerprints match
+    if artifact_dir is not None:
+        snapshot = load_catalog(artifact_dir, model, model_version)
+    else:
+        engine = get_engine(args.engine_string, **(SQLALCHEMY_ENGINE_OPTIONS
+                                                  if args.engine_string == SQLALCHEMY_DATABASE_URI else {}))
+        snapshot = load_snapshot(sessionmaker(bind=engine)(), model, precompute_config['features'],
+                                 display_vars, model_version=model_version,
+                                 # like the web app, the scalar is fitted on the catalog without one
+                                 preprocessor=load_preprocessor(preprocessor_save_path)
+                                 if os.path.exists(preprocessor_save_path) else None)
+    precompute_recs(snapshot, **precompute_config)
+
+
+def store_rds(args):
+    """Load the cleaned table into the database"""
+    from src.more_chocolate_plz import upload_to_rds
+
+    upload_to_rds(args.file_path, args.engine_string, args.batch_size, args.mode,
+                  args.key_columns, args.delete_missing,
+                  SQLALCHEMY_ENGINE_OPTIONS if args.engine_string == SQLALCHEMY_DATABASE_URI else None)
+
+
+# The function that runs every subcommand. Each one imports what it needs when it runs, so that
+# light commands like upload or create_db do not pay for loading scikit-learn, pandas or boto3
+COMMANDS = {"upload": transfer, "download": transfer, "create_db": create_database,
+            "run_modeling": run_modeling, "store_rds": store_rds, "sweep": sweep,
+            "recommend_batch": recommend_batch, "precompute_recs": precompute}
+
+
+def build_parser():
+    """Command line parser of every subcommand"""
     # Add parsers for both creating a database and adding chocolates to it
     parser = argparse.ArgumentParser(description="Create and/or add data to database")
     subparsers = parser.add_subparsers(dest="subparser_name")
@@ -29,55 +300,86 @@ if __name__ == '__main__':
     sb_upload = subparsers.add_parser("upload", help="Upload raw data to s3")
     sb_upload.add_argument("--s3path", default=None, help="S3 data path")
     sb_upload.add_argument("--local_path", default=None, help="The local path")
+    sb_upload.add_argument("--recursive", action="store_true",
+                           help="Upload every file under the path, several files at a time")
+    sb_upload.add_argument("--force", action="store_true",
+                           help="Upload files even if their size and checksum are unchanged")
+    sb_upload.add_argument("--multipart_threshold", default=8, type=int,
+                           help="Files of at least this many MB are transferred in parallel parts")
+    sb_upload.add_argument("--multipart_chunksize", default=8, type=int,
+                           help="Size in MB of every part of a file transferred in parts")
+    sb_upload.add_argument("--max_concurrency", default=10, type=int,
+                           help="Number of threads transferring the parts of one file")
+    sb_upload.add_argument("--max_workers", default=8, type=int,
+                           help="Number of files transferred at the same time with --recursive")
 
     # Sub-parser for downloading data to s3
     sb_download = subparsers.add_parser("download", help="Download raw data to s3")
     sb_download.add_argument("--s3path", default=None, help="S3 data path")
     sb_download.add_argument("--local_path", default=None, help="The local path")
+    sb_download.add_argument("--recursive", action="store_true",
+                             help="Download every file under the path, several files at a time")
+    sb_download.add_argument("--force", action="store_true",
+                             help="Download files even if their size and checksum are unchanged")
+    sb_download.add_argument("--multipart_threshold", default=8, type=int,
+                             help="Files of at least this many MB are transferred in parallel parts")
+    sb_download.add_argument("--multipart_chunksize", default=8, type=int,
+                             help="Size in MB of every part of a file transferred in parts")
+    sb_download.add_argument("--max_concurrency", default=10, type=int,
+                             help="Number of threads transferring the parts of one file")
+    sb_download.add_argument("--max_workers", default=8, type=int,
+                             help="Number of files transferred at the same time with --recursive")
 
     # Sub-parser for modeling from csv
     sb_run_modeling = subparsers.add_parser("run_modeling", help="Modeling to give recommendations")
-    sb_run_modeling.add_argument("--local_path", default=None, help="The local path")
+    sb_run_modeling.add_argument("--local_path", default=None,
+                                 help="The local path, or an s3:// path that is streamed without a local copy")
     sb_run_modeling.add_argument('--config', default=None, help='Path to configuration file')
+    sb_run_modeling.add_argument("--no_cache", action="store_true",
+                                 help="Rerun every stage instead of restoring unchanged ones from the stage cache")
 
     # Store generated recommendations into RDS
     sb_rds = subparsers.add_parser("store_rds", help="store cleaned table into RDS database")
     sb_rds.add_argument('--file_path', default=None, help='path of clean data')
     sb_rds.add_argument("--engine_string", default=SQLALCHEMY_DATABASE_URI,
                         help="SQLAlchemy connection URI for database")
+    sb_rds.add_argument("--batch_size", default=10000, type=int,
+                        help="Number of rows inserted and committed together")
+    sb_rds.add_argument("--mode", default="append", choices=["append", "upsert"],
+                        help="Append every row, or only insert new and update changed rows")
+    sb_rds.add_argument("--key_columns", default=None, nargs="+",
+                        help="Columns that identify a chocolate bar, all columns by default")
+    sb_rds.add_argument("--delete_missing", action="store_true",
+                        help="In upsert mode, delete rows that are missing from the file")
 
-    args = parser.parse_args()
-    sb_used = args.subparser_name
+    # Sub-parser for choosing the number of clusters
+    sb_sweep = subparsers.add_parser("sweep", help="Fit k-means over a grid of cluster numbers and seeds "
+                                                   "and promote the best model")
+    sb_sweep.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
 
-    if sb_used == "upload":
-        upload_file_to_s3(args.local_path, args.s3path)
-    elif sb_used == "download":
-        download_file_from_s3(args.local_path, args.s3path)
-    elif sb_used == "create_db":
-        create_db(args.engine_string)
-    elif sb_used == "run_modeling":
-        # load configuration file for parameters and tmo path
-        try:
-            with open(args.config, "r") as f:
-                config = yaml.load(f, Loader=yaml.FullLoader)
-                logger.info("Configuration file loaded from %s", args.config)
-        except FileNotFoundError:
-            logger.error("Configuration file %s is not found", args.config)
-        # read in raw data
-        raw_df = read_data(args.local_path, **config['clean_data']['read_data'])
-        # clean data
-        df = clean(raw_df, **config['clean_data']['clean'])
-        # standardization
-        scale_df = standardization(df, **config['clean_data']['standardization'])
-        # generate k means model and save to joblib
-        model = generate_kmeans(scale_df, **config['modeling']['generate_kmeans'])
-        # model evaluation
-        model_evaluation(scale_df, model, **config['modeling']['model_evaluation'])
-    elif sb_used == "store_rds":
-        upload_to_rds(args.file_path, args.engine_string)
-    else:
-        parser.print_help()
+    # Score a file of user profiles in one vectorized call
+    sb_batch = subparsers.add_parser("recommend_batch", help="Recommend chocolate bars for a file of "
+                                                             "user profiles")
+    sb_batch.add_argument("--input_path", required=True, help="CSV or JSONL file of user profiles")
+    sb_batch.add_argument("--output_path", required=True, help="Path of the recommendation table")
+    sb_batch.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
 
+    # Materialize the recommendations of the whole grid of user inputs for the web app
+    sb_precompute = subparsers.add_parser("precompute_recs", help="Recommend chocolate bars for every "
+                                                                  "flag combination on a cocoa percent "
+                                                                  "and rating grid")
+    sb_precompute.add_argument('--config', default='config/config.yaml', help='Path to configuration file')
+    sb_precompute.add_argument("--engine_string", default=SQLALCHEMY_DATABASE_URI,
+                               help="SQLAlchemy connection URI of the catalog, unless artifact_dir is set")
 
+    return parser
 
 
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    command = COMMANDS.get(args.subparser_name)
+    if command is None:
+        parser.print_help()
+    else:
+        command(args)
@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from joblib import dump, load
+
+from src.catalog import CatalogSnapshot
+from src.clean_data import save_scaled_chunks
+from src.recommender import ClusterIndex, build_cluster_index
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # the display table falls back to csv
+    feather = None
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_VERSION = 1
+CURRENT = 'CURRENT'
+INDEX_ARRAYS = ['positions', 'features', 'sq_norms', 'offsets']
+
+
+def save_catalog(data, model, preprocessor, directory, display_vars, bar_index='index',
+                 model_version=None, keep=2, block_size=10000, fingerprint=None):
+    """Write the catalog as memory-mappable arrays and a columnar display table
+
+    Every call writes a new version directory under ``directory`` and then points the
+    ``CURRENT`` file at it, so that readers never see a half-written catalog. Only the newest
+    ``keep`` versions are kept.
+
+    Args:
+        data (:obj:`DataFrame <pandas.DataFrame>`): the cleaned records of chocolate bars. This can
+            also be a function that returns an iterator of cleaned chunks, so the data never has
+            to fit in memory
+        model (:obj:`sklearn.cluster._kmeans.KMeans`): the k-means clustering model
+        preprocessor (:obj:`dict`): the preprocessing artifact saved at training time
+        directory (str): the directory of the catalog versions
+        display_vars (:obj:`list`): the list of features used for display
+        bar_index (str): the column name for chocolate bar index, the id of the bar in the
+            chocolates table
+        model_version (str): the version of the model the cluster labels were predicted by
+        keep (int): the number of catalog versions to keep
+        block_size (int): the number of rows labelled together
+        fingerprint (str): the fingerprint of the pipeline stage that built the catalog, see
+            :class:`StageCache <src.stage_cache.StageCache>`
+
+    Returns:
+        version_dir (str): the directory of the new catalog version
+    """
+    if callable(data):
+        read_chunks = data
+    else:
+        def read_chunks():
+            return iter([data])
+
+    version = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    version_dir = os.path.join(directory, version)
+    os.makedirs(version_dir)
+    try:
+        ids = []
+        with _DisplayWriter(version_dir) as display:
+            def display_chunks():
+                # the ids and display columns are written on the way through the features
+                for chunk in read_chunks():
+                    if bar_index not in chunk:
+                        raise ValueError("Data has no %s column of bar ids, please rerun the "
+                                         "clean stage of run_modeling" % bar_index)
+                    ids.append(chunk[bar_index].to_numpy(dtype=np.int64))
+                    display.write(chunk[display_vars])
+                    yield chunk
+
+            scaled = save_scaled_chunks(display_chunks(), preprocessor,
+                                        os.path.join(version_dir, 'features.npy'))
+        ids = np.concatenate(ids)
+        labels = np.concatenate([model.predict(scaled[lo:lo + block_size])
+                                 for lo in range(0, len(scaled), block_size)]).astype(np.int32)
+        index = build_cluster_index(scaled, labels, model.n_clusters)
+
+        np.save(os.path.join(version_dir, 'ids.npy'), ids)
+        np.save(os.path.join(version_dir, 'labels.npy'), labels)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(version_dir, 'index_%s.npy' % name), getattr(index, name))
+        dump(preprocessor, os.path.join(version_dir, 'preprocessor.joblib'))
+        with open(os.path.join(version_dir, 'meta.json'), 'w') as f:
+            json.dump({'artifact_version': ARTIFACT_VERSION, 'rows': len(ids),
+                       'n_clusters': int(model.n_clusters), 'model_version': model_version,
+                       'display_vars': list(display_vars), 'fingerprint': fingerprint}, f)
+    except Exception:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    # switch readers to the new version in one atomic rename
+    with open(os.path.join(directory, CURRENT + '.tmp'), 'w') as f:
+        f.write(version)
+    os.replace(os.path.join(directory, CURRENT + '.tmp'), os.path.join(directory, CURRENT))
+    logger.info("Catalog of %i chocolate bars is saved to %s", len(ids), version_dir)
+
+    versions = sorted(name for name in os.listdir(directory)
+                      if os.path.isdir(os.path.join(directory, name)))
+    for old in versions[:-keep]:
+        # readers that still map the old files keep them until they close them
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+
+    return version_dir
+
+
+class _DisplayWriter:
+    """Append the display columns chunk by chunk to an Arrow file, or a csv without pyarrow"""
+
+    def __init__(self, version_dir):
+        self.version_dir = version_dir
+        self.writer = None
+        self.schema = None
+        self.rows = 0
+
+    def write(self, display):
+        display = display.reset_index(drop=True)
+        if feather is None:
+            display.to_csv(os.path.join(self.version_dir, 'display.csv'), index=False,
+                           mode='a' if self.rows else 'w', header=not self.rows)
+        else:
+            if self.writer is None:
+                self.schema = pa.Schema.from_pandas(display, preserve_index=False)
+                # an uncompressed Arrow file is a feather file that can be memory-mapped
+                self.writer = pa.ipc.new_file(os.path.join(self.version_dir, 'display.arrow'),
+                                              self.schema)
+            self.writer.write_table(pa.Table.from_pandas(display, schema=self.schema,
+                                                         preserve_index=False))
+        self.rows += len(display)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def probe_artifacts(directory):
+    """Cheap version probe of the catalog artifacts
+
+    Args:
+        directory (str): the directory of the catalog versions
+
+    Returns:
+        version (str): the name of the current catalog version
+    """
+    with open(os.path.join(directory, CURRENT)) as f:
+        return f.read().strip()
+
+
+def catalog_meta(directory):
+    """Metadata of the current catalog version
+
+    Args:
+        directory (str): the directory of the catalog versions
+
+    Returns:
+        meta (:obj:`dict`): the metadata written by :func:`save_catalog`, None if there is no
+            catalog yet
+    """
+    try:
+        with open(os.path.join(directory, probe_artifacts(directory), 'meta.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def load_catalog(directory, model, model_version=None, mmap_mode='r'):
+    """Open the current catalog version as a snapshot without reading the arrays into memory
+
+    The arrays are memory-mapped, so opening the catalog takes the same time for any number of
+    chocolate bars and every process that opens it shares the same pages. Cluster labels and
+    the index are only recomputed if the catalog was labelled by a different model version.
+
+    Args:
+        directory (str): the directory of the catalog versions
+        model (:obj:`sklearn.cluster._kmeans.KMeans`): the k-means clustering model
+        model_version (str): the version of the model
+        mmap_mode (str): the numpy memory-map mode, the arrays are read into memory if None
+
+    Returns:
+        snapshot (:obj:`CatalogSnapshot <src.catalog.CatalogSnapshot>`): the catalog snapshot
+    """
+    version = probe_artifacts(directory)
+    version_dir = os.path.join(directory, version)
+    with open(os.path.join(version_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['artifact_version'] != ARTIFACT_VERSION:
+        raise ValueError("Catalog %s has artifact version %s, expected %i, please rerun "
+                         "run_modeling" % (version_dir, meta['artifact_version'], ARTIFACT_VERSION))
+
+    def array(name):
+        return np.load(os.path.join(version_dir, name + '.npy'), mmap_mode=mmap_mode)
+
+    ids, features = array('ids'), array('features')
+    if model_version is not None and model_version == meta['model_version']:
+        labels = array('labels')
+        index = ClusterIndex(*[array('index_' + name) for name in INDEX_ARRAYS])
+    else:
+        logger.warning("Catalog %s was labelled by model version %s, relabelling it",
+                       version_dir, meta['model_version'])
+        labels = np.ascontiguousarray(model.predict(features), dtype=np.int32)
+        index = build_cluster_index(features, labels, model.n_clusters)
+
+    if os.path.exists(os.path.join(version_dir, 'display.arrow')):
+        display = feather.read_table(os.path.join(version_dir, 'display.arrow'),
+                                     memory_map=mmap_mode is not None)
+    else:
+        display = pd.read_csv(os.path.join(version_dir, 'display.csv')).to_numpy(dtype=object)
+    preprocessor = load(os.path.join(version_dir, 'preprocessor.joblib'))
+
+    snapshot = CatalogSnapshot(ids, features, labels, display, meta['display_vars'], preprocessor,
+                               version, index, model, model_version)
+    logger.info("Catalog snapshot opened with %i chocolate bars from %s", len(snapshot),
+                version_dir)
+    return snapshot
@@ -0,0 +1,96 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class AuditLog:
+    """
+    Append-only JSON lines log written by a background thread. :meth:`write` only puts the record
+    on a queue, the writer thread collects records for up to ``flush_interval`` seconds or
+    ``max_batch`` records and appends them to ``path`` in one write. Records are dropped, and
+    counted, when the queue is full rather than blocking the caller.
+    """
+
+    def __init__(self, path, flush_interval=1.0, max_batch=512, max_queue=10000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.written = 0
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, record):
+        """Queue one record for the writer thread, never blocks"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def __call__(self, rec_result):
+        """Queue a recommendation table, so that the log can be used as writer of formatting_preds"""
+        self.write({'recommendations': rec_result.to_dict(orient='records')})
+
+    def close(self, timeout=5):
+        """Flush the queued records and stop the writer thread"""
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _ensure_started(self):
+        # the thread and the queue are created lazily, and again in a forked worker process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self.max_queue)
+            self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not _STOP and len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is _STOP
+            self._flush([record for record in batch if record is not _STOP])
+            if stop:
+                return
+
+    def _flush(self, records):
+        if not records:
+            return
+        lines = ''.join(json.dumps(record, default=str) + '\n' for record in records)
+        try:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+            self.written += len(records)
+        except OSError as errors:
+            logger.error("%i audit records could not be written to %s: %s", len(records),
+                         self.path, errors)
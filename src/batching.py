@@ -0,0 +1,88 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Collects the items submitted by concurrent requests for up to ``max_wait`` seconds, or until
+    ``max_batch`` items are queued, and runs them through ``handler`` in one call on a background
+    thread. ``handler`` takes a list of items and returns one result per item. Every request gets
+    a :obj:`Future <concurrent.futures.Future>` of its own results, which also carries the
+    seconds it waited in the queue, the seconds the batch took and the size of the batch.
+    """
+
+    def __init__(self, handler, max_wait=0.002, max_batch=256):
+        self.handler = handler
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.batches = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, items):
+        """Queue a list of items and return the future of their results"""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((list(items), future, time.perf_counter()))
+        return future
+
+    def __call__(self, items, timeout=None):
+        """Run a list of items in the next batch and wait for their results"""
+        return self.submit(items).result(timeout)
+
+    def _ensure_started(self):
+        # the thread and the queue are created lazily, and again in a forked worker process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            requests = [self._queue.get()]
+            size = len(requests[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    # past the deadline only what is already queued joins the batch
+                    requests.append(self._queue.get(timeout=timeout) if timeout > 0 else
+                                    self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                size += len(requests[-1][0])
+            self._run_batch(requests)
+
+    def _run_batch(self, requests):
+        start = time.perf_counter()
+        items = [item for request_items, _, _ in requests for item in request_items]
+        try:
+            results = self.handler(items)
+        except Exception as errors:
+            logger.error("Batch of %i items failed: %s", len(items), errors)
+            for _, future, _ in requests:
+                future.set_exception(errors)
+            return
+        seconds = time.perf_counter() - start
+        self.batches += 1
+
+        offset = 0
+        for request_items, future, queued_at in requests:
+            future.queue_seconds = start - queued_at
+            future.batch_seconds = seconds
+            future.batch_size = len(items)
+            future.set_result(results[offset:offset + len(request_items)])
+            offset += len(request_items)
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_input(values, replace_dict):
+    """Turn the raw user input into a hashable tuple of numbers, the input that is scored
+
+    Args:
+        values (:obj:`list`): the user input values in the order of the input features
+        replace_dict (:obj:`dictionary`): the dictionary that map 'yes' and 'no' into 1 and 0
+
+    Returns:
+        user_input (:obj:`tuple`): the normalized user input
+    """
+    return tuple(float(replace_dict.get(value, value)) for value in values)
+
+
+def cache_key(user_input, decimals=2):
+    """Quantized cache key of a normalized user input, only used to look up results: inputs that
+    differ by less than the rounding share the result of the first one scored
+
+    Args:
+        user_input (:obj:`tuple`): the normalized user input
+        decimals (int): the number of decimals the inputs are rounded to, enough to tell the
+            quarter-point ratings apart
+
+    Returns:
+        key (:obj:`tuple`): the cache key
+    """
+    return tuple(round(value, decimals) for value in user_input)
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of recommendation results with a time to live. Every entry belongs to
+    one version of the model and the catalog, and the whole cache is dropped when a lookup
+    comes with a different version.
+    """
+
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        """Return the cached result for key, or None if it is missing, expired or outdated"""
+        with self._lock:
+            if version != self.version:
+                self._invalidate(version)
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl is not None and time.monotonic() >= entry[1]):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, version, value):
+        """Store the result for key, evicting the least recently used entry when full"""
+        with self._lock:
+            if version != self.version:
+                self._invalidate(version)
+            expires = None if self.ttl is None else time.monotonic() + self.ttl
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, version, compute):
+        """Return the cached result for key, computing and storing it on a miss"""
+        value = self.get(key, version)
+        if value is None:
+            value = compute()
+            self.put(key, version, value)
+        return value
+
+    def stats(self):
+        """Hit and miss counters of the cache"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _invalidate(self, version):
+        if self._entries:
+            logger.info("Result cache of %i entries invalidated for version %s",
+                        len(self._entries), version)
+        self._entries.clear()
+        self.version = version
@@ -0,0 +1,254 @@
+import itertools
+import logging
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func
+from sqlalchemy.exc import DBAPIError
+
+from src.clean_data import fit_preprocessor, transform_features
+from src.more_chocolate_plz import Chocolates
+from src.recommender import build_cluster_index
+
+logger = logging.getLogger(__name__)
+
+# tells snapshots apart even when the table version probe is unchanged
+_generations = itertools.count(1)
+
+
+class CatalogSnapshot:
+    """
+    Read-only copy of the chocolates table held as contiguous NumPy arrays, so that a
+    recommendation request never has to touch the database
+    """
+
+    def __init__(self, ids, features, labels, display, display_vars, preprocessor, version,
+                 index=None, model=None, model_version=None):
+        self.ids = ids
+        self.features = features
+        self.labels = labels
+        self.index = build_cluster_index(features, labels) if index is None else index
+        self.display = display
+        self.display_vars = display_vars
+        self.preprocessor = preprocessor
+        self.version = version
+        self.model = model
+        self.model_version = model_version
+        self.generation = next(_generations)
+        self.loaded_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return "<Catalog snapshot of %i chocolate bars, version %s>" % (len(self), self.version)
+
+    def display_rows(self, positions):
+        """Return the display columns of the bars at the given catalog positions as a 2d array"""
+        if isinstance(self.display, np.ndarray):
+            return self.display[positions]
+        if callable(self.display):
+            # display columns are fetched from the database by chocolate bar index
+            return self.display(self.ids[positions])
+        # memory-mapped arrow table, only the requested rows are materialized
+        return self.display.take(positions).to_pandas().to_numpy(dtype=object)
+
+
+def build_snapshot(data, model, features, display_vars, bar_index='index', version=None,
+                   preprocessor=None, model_version=None, display=None):
+    """Convert the chocolate bar records into a catalog snapshot
+
+    Args:
+        data (:obj:`DataFrame <pandas.DataFrame>`): the records of chocolate bars
+        model (:obj:`sklearn.cluster._kmeans.KMeans`): the k-means clustering model
+        features (:obj:`list`): the list of features for recommendation generation
+        display_vars (:obj:`list`): the list of features used for display on webpage
+        bar_index (str): the column name for chocolate bar index
+        version (:obj:`tuple`): the probe result the records were read under
+        preprocessor (:obj:`dict`): the preprocessing artifact saved at training time
+        model_version (str): the version of the model, kept with the labels it produced
+        display (callable): fetches the display columns of chocolate bar indexes, taken from the
+            data if None
+
+    Returns:
+        snapshot (:obj:`CatalogSnapshot`): the catalog snapshot
+    """
+    if preprocessor is None:
+        logger.warning("No preprocessor is provided, the scalar is fitted on the catalog instead")
+        preprocessor = fit_preprocessor(data.astype({var: np.float64 for var in features}), features)
+
+    scaled = transform_features(data, preprocessor)
+    labels = np.ascontiguousarray(model.predict(scaled), dtype=np.int32)
+    ids = np.ascontiguousarray(data[bar_index].to_numpy(dtype=np.int64))
+    if display is None:
+        display = data[display_vars].to_numpy(dtype=object)
+
+    index = build_cluster_index(scaled, labels, model.n_clusters)
+
+    return CatalogSnapshot(ids, scaled, labels, display, list(display_vars), preprocessor, version,
+                           index, model, model_version)
+
+
+def probe_catalog(session):
+    """Cheap version probe of the chocolates table
+
+    Args:
+        session (:obj:`sqlalchemy.orm.session.Session`): database session
+
+    Returns:
+        version (:obj:`tuple`): row count, the largest chocolate bar index and the row version of
+            the last load, which every row a load inserts or updates is tagged with
+    """
+    try:
+        count, max_index, row_version = session.query(func.count(Chocolates.index),
+                                                      func.max(Chocolates.index),
+                                                      func.max(Chocolates.row_version)).one()
+    except DBAPIError:
+        # a table created before the row_version column, see more_chocolate_plz.migrate_db
+        session.rollback()
+        logger.warning("The chocolates table has no row_version column, rows updated in place are "
+                       "not noticed until it is migrated with run.py create_db")
+        count, max_index = session.query(func.count(Chocolates.index), func.max(Chocolates.index)).one()
+        row_version = None
+    return int(count), max_index, row_version
+
+
+def display_query(session, display_vars, bar_index='index'):
+    """Fetcher of the display columns of a few chocolate bars, for snapshots without them
+
+    Args:
+        session (:obj:`sqlalchemy.orm.session.Session`): database session
+        display_vars (:obj:`list`): the list of features used for display on webpage
+        bar_index (str): the column name for chocolate bar index
+
+    Returns:
+        fetch (callable): returns the display columns of the given chocolate bar indexes, in order,
+            empty (None) for bars that were deleted since the features were read
+    """
+    columns = list(dict.fromkeys([bar_index] + list(display_vars)))
+
+    def fetch(ids):
+        ids = [int(bar) for bar in ids]
+        recs = session.query(*[getattr(Chocolates, col) for col in columns]).filter(
+            getattr(Chocolates, bar_index).in_(ids))
+        rows = pd.read_sql(recs.statement, session.bind).set_index(bar_index, drop=False).reindex(ids)
+        missing = rows[bar_index].isna()
+        if missing.any():
+            logger.warning("Chocolate bars %s were deleted from the table, their display columns "
+                           "are left empty", sorted(set(np.array(ids)[missing.to_numpy()].tolist())))
+            rows[bar_index] = ids
+        display = rows[display_vars].to_numpy(dtype=object)
+        display[pd.isna(display)] = None
+        return display
+
+    return fetch
+
+
+def load_snapshot(session, model, features, display_vars, bar_index='index', preprocessor=None,
+                  model_version=None, lazy_display=False):
+    """Read the chocolates table once and build a catalog snapshot from it
+
+    Only the columns needed are selected. With ``lazy_display`` only the chocolate bar index and
+    the features are read, which the covering index on the features answers without touching
+    the table, and the display columns of the recommended bars are fetched when they are needed.
+
+    Args:
+        session (:obj:`sqlalchemy.orm.session.Session`): database session
+        model (:obj:`sklearn.cluster._kmeans.KMeans`): the k-means clustering model
+        features (:obj:`list`): the list of features for recommendation generation
+        display_vars (:obj:`list`): the list of features used for display on webpage
+        bar_index (str): the column name for chocolate bar index
+        preprocessor (:obj:`dict`): the preprocessing artifact saved at training time
+        model_version (str): the version of the model, kept with the labels it produced
+        lazy_display (bool): whether to fetch the display columns per request
+
+    Returns:
+        snapshot (:obj:`CatalogSnapshot`): the catalog snapshot
+    """
+    # a snapshot with lazy display columns is read per request, it is never probed for changes
+    version = None if lazy_display else probe_catalog(session)
+    display = display_query(session, display_vars, bar_index) if lazy_display else None
+    columns = list(dict.fromkeys([bar_index] + list(features) +
+                                 ([] if lazy_display else list(display_vars))))
+    # ordered by index, so that ties between equally close bars always break the same way
+    recs = session.query(*[getattr(Chocolates, col) for col in columns]).order_by(
+        getattr(Chocolates, bar_index))
+    data = pd.read_sql(recs.statement, session.bind)
+    snapshot = build_snapshot(data, model, features, display_vars, bar_index, version, preprocessor,
+                              model_version, display)
+    logger.info("Catalog snapshot loaded with %i chocolate bars", len(snapshot))
+    return snapshot
+
+
+class CatalogStore:
+    """
+    Process-wide holder of the current catalog snapshot. The snapshot is rebuilt when it is
+    older than ``ttl`` seconds, or when the version probe, run at most every
+    ``probe_interval`` seconds, reports that the table has changed. ``depends_on`` returns the
+    versions of the artifacts the snapshot is built with, e.g. the model, and a change of them
+    rebuilds the snapshot as well.
+    """
+
+    def __init__(self, loader, probe, ttl=300, probe_interval=30, depends_on=None):
+        self._loader = loader
+        self._probe = probe
+        self._depends_on = depends_on
+        self._dependencies = None
+        self.ttl = ttl
+        self.probe_interval = probe_interval
+        self._snapshot = None
+        self._probed_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load a fresh snapshot and make it the current one"""
+        with self._lock:
+            self._swap()
+        return self._snapshot
+
+    def get(self):
+        """Return the current snapshot, refreshing it first if it is stale"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.load()
+
+        if self._is_stale(snapshot) and self._lock.acquire(blocking=False):
+            # only one request refreshes, the others keep serving the previous snapshot
+            try:
+                if self._snapshot is snapshot:
+                    self._swap()
+            except Exception as errors:
+                # back off for a full ttl instead of retrying on every request
+                snapshot.loaded_at = time.monotonic()
+                logger.error("Catalog refresh failed, keep serving version %s: %s",
+                             snapshot.version, errors)
+            finally:
+                self._lock.release()
+
+        return self._snapshot
+
+    def _is_stale(self, snapshot):
+        if self._depends_on is not None and self._depends_on() != self._dependencies:
+            return True
+        now = time.monotonic()
+        if self.ttl is not None and now - snapshot.loaded_at >= self.ttl:
+            return True
+        if self.probe_interval is None or now - self._probed_at < self.probe_interval:
+            return False
+
+        self._probed_at = now
+        try:
+            return self._probe() != snapshot.version
+        except Exception as errors:
+            logger.warning("Catalog version probe failed: %s", errors)
+            return False
+
+    def _swap(self):
+        if self._depends_on is not None:
+            self._dependencies = self._depends_on()
+        snapshot = self._loader()
+        self._probed_at = time.monotonic()
+        self._snapshot = snapshot
+        logger.debug("Catalog snapshot swapped to version %s", snapshot.version)
@@ -1,24 +1,95 @@
 import logging
+import os
+import shutil
 
+import numpy as np
 import pandas as pd
+from joblib import dump, load
 from sklearn.preprocessing import StandardScaler
 
 logger = logging.getLogger(__name__)
 
+# bump whenever the layout of the saved preprocessing artifact changes
+PREPROCESSOR_VERSION = 1
 
-def read_data(local_path, index_col_num):
-    """Read in data and return the dataframe"""
+
+def _csv_source(local_path, compression):
+    """The path, or for s3:// paths a stream of the object, and the compression left to pandas"""
+    if str(local_path).startswith('s3://'):
+        # imported here so that reading local files does not need boto3
+        from src.s3 import open_s3_stream
+        return open_s3_stream(local_path, compression=compression), None
+    return local_path, compression
+
+
+def read_data(local_path, index_col_num, compression='infer'):
+    """Read in data and return the dataframe, s3:// paths are streamed without a local copy"""
     try:
-        data = pd.read_csv(local_path, index_col=[index_col_num])
+        source, compression = _csv_source(local_path, compression)
+        data = pd.read_csv(source, index_col=[index_col_num], compression=compression)
     except FileNotFoundError:
         logger.error("File %s is not found", local_path)
 
     return data
 
 
-def clean(data, enc_features, store_path, clean_features, binary_word):
+def read_data_chunks(local_path, index_col_num, chunksize, dtypes=None, compression='infer'):
+    """Read in data as an iterator of dataframes of at most ``chunksize`` rows
+
+    An s3:// path is streamed from the bucket while the chunks are parsed, so the raw data is
+    never written to local disk.
+
+    Args:
+        local_path (str): the path of the csv, local or s3://bucket/key
+        index_col_num (int): the position of the index column, no index column if None
+        chunksize (int): number of rows per chunk
+        dtypes (:obj:`dictionary`): explicit dtype per column, inferred per chunk if None
+        compression (str): 'gzip' or None, 'infer' decides from the file name
+
+    Returns:
+        chunks (:obj:`pandas.io.parsers.TextFileReader`): iterator of the chunks
+    """
+    index_col = None if index_col_num is None else [index_col_num]
+    source, compression = _csv_source(local_path, compression)
+    return pd.read_csv(source, index_col=index_col, chunksize=chunksize, dtype=dtypes,
+                       compression=compression)
+
+
+def encode_binary(data, enc_features, binary_word):
+    """Convert binary variables into 1 or 0, 0 if the value contains ``binary_word``
+
+    Args:
+        data (:obj:`DataFrame <pandas.DataFrame>`): the raw data, encoded in place
+        enc_features (:obj:`list`): list of binary variables that needs to be encodes into 1 or 0
+        binary_word (str): the word for binary conversion
+
+    Returns:
+        data (:obj:`DataFrame <pandas.DataFrame>`): the data with encoded binary variables
+    """
+    for var in enc_features:
+        col = data[var]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            # only the handful of categories are searched, rows are mapped through their codes
+            without_word = ~col.cat.categories.str.contains(binary_word, regex=False)
+            codes = col.cat.codes.to_numpy()
+            missing = codes < 0
+            encoded = np.asarray(without_word)[codes]
+        else:
+            contains = col.str.contains(binary_word, regex=False)
+            missing = contains.isna().to_numpy()
+            encoded = ~contains.fillna(True).to_numpy(dtype=bool)
+        if missing.any():
+            raise ValueError("Binary variable %s has %i missing values" % (var, missing.sum()))
+        data[var] = encoded.astype(np.int64)
+
+    return data
+
+
+def clean(data, enc_features, store_path, clean_features, binary_word, bar_index='index'):
     """
-    clean up raw dataframe and save cleaned data into data folder
+    clean up raw dataframe and save cleaned data into data folder. Every bar gets an id in
+    ``bar_index``, numbered from 1 in file order like the chocolates table numbers its rows,
+    unless the raw data already has that column.
 
     Args:
         data (:obj:`DataFrame <pandas.DataFrame>`): the raw data
@@ -26,14 +97,16 @@ def clean(data, enc_features, store_path, clean_features, binary_word):
         store_path (str): the path to store cleaned data
         clean_features (:obj:`list`): list of variables in cleaned data
         binary_word (str): the word for binary conversion
+        bar_index (str): the column name for chocolate bar index
 
     Returns:
         data (:obj:`DataFrame <pandas.DataFrame>`): the cleaned data
     """
 
     # convert binary cols to 1 or 0
-    for var in enc_features:
-        data[var] = data[var].apply(lambda x: 0 if binary_word in x else 1)
+    encode_binary(data, enc_features, binary_word)
+    if bar_index not in data:
+        data = data.assign(**{bar_index: np.arange(1, len(data) + 1)})
 
     logger.info("Data has %i observations", data.shape[0])
     logger.info("Data has %i columns", data.shape[1])
@@ -48,6 +121,49 @@ def clean(data, enc_features, store_path, clean_features, binary_word):
     return data
 
 
+def clean_streaming(chunks, enc_features, store_path, clean_features, binary_word, features=None,
+                    save_path=None, bar_index='index'):
+    """
+    clean up raw data chunk by chunk and append every cleaned chunk to the data folder, so
+    memory stays bounded by the chunk size. When ``features`` are given the standard scalar
+    statistics are accumulated on the way with ``partial_fit``. Bar ids are numbered across
+    chunks like in :func:`clean`.
+
+    Args:
+        chunks (:obj:`iterable`): the raw data as dataframes, see :func:`read_data_chunks`
+        enc_features (:obj:`list`): list of binary variables that needs to be encodes into 1 or 0
+        store_path (str): the path to store cleaned data
+        clean_features (:obj:`list`): list of variables in cleaned data
+        binary_word (str): the word for binary conversion
+        features (:obj:`list`): list of features to fit the scalar on, no scalar if None
+        save_path (str): the path to save the preprocessing artifact, not saved if None
+        bar_index (str): the column name for chocolate bar index
+
+    Returns:
+        n_rows (int): the number of cleaned observations
+        preprocessor (:obj:`dict`): the preprocessing artifact, None if no features are given
+    """
+    scalar = None if features is None else StandardScaler()
+    n_rows = 0
+    for chunk in chunks:
+        chunk = encode_binary(chunk, enc_features, binary_word)
+        if bar_index not in chunk:
+            chunk = chunk.assign(**{bar_index: np.arange(n_rows + 1, n_rows + len(chunk) + 1)})
+        chunk = chunk[clean_features]
+        chunk.to_csv(store_path, index=False, mode='w' if n_rows == 0 else 'a', header=n_rows == 0)
+        if scalar is not None:
+            scalar.partial_fit(chunk[features].values)
+        n_rows += len(chunk)
+        logger.debug("%i observations cleaned", n_rows)
+
+    logger.info("Data has %i observations", n_rows)
+    logger.info('Data is saved to path %s', store_path)
+
+    if scalar is None:
+        return n_rows, None
+    return n_rows, _save_preprocessor(scalar, features, save_path)
+
+
 def standardization(data, features):
     """Standardize the cleaned raw dataframe
 
@@ -82,3 +198,108 @@ def get_standard_scalar(data, features):
     scalar = StandardScaler().fit(feature_df.values)
     return scalar
 
+
+def fit_preprocessor(data, features, save_path=None):
+    """Fit the preprocessing step once at training time, so that serving only has to transform
+
+    Args:
+        data (:obj:`DataFrame <pandas.DataFrame>`): the cleaned dataframe for fitting the scalar
+        features (:obj:`list`): list of features, in the order the model expects them
+        save_path (str): the path to save the preprocessing artifact, not saved if None
+
+    Returns:
+        preprocessor (:obj:`dict`): the artifact version, feature order and fitted standard scalar
+    """
+    return _save_preprocessor(get_standard_scalar(data, features), features, save_path)
+
+
+def _save_preprocessor(scalar, features, save_path):
+    """bundle the fitted scalar with the feature order and save it if a path is given"""
+    preprocessor = {'version': PREPROCESSOR_VERSION,
+                    'features': list(features),
+                    'scalar': scalar}
+
+    if save_path is not None:
+        dump(preprocessor, save_path)
+        logger.info("Preprocessor is saved to path %s", save_path)
+
+    return preprocessor
+
+
+def load_preprocessor(save_path):
+    """Load the preprocessing artifact saved by :func:`fit_preprocessor`
+
+    Args:
+        save_path (str): the path of the preprocessing artifact
+
+    Returns:
+        preprocessor (:obj:`dict`): the artifact version, feature order and fitted standard scalar
+    """
+    preprocessor = load(save_path)
+    if not isinstance(preprocessor, dict) or preprocessor.get('version') != PREPROCESSOR_VERSION:
+        raise ValueError("Preprocessor at %s is not a version %i artifact, please rerun "
+                         "run_modeling" % (save_path, PREPROCESSOR_VERSION))
+    logger.info("Preprocessor is loaded from %s", save_path)
+    return preprocessor
+
+
+def transform_features(data, preprocessor):
+    """Scale the features of new rows with the fitted preprocessor, without refitting
+
+    Args:
+        data (:obj:`DataFrame <pandas.DataFrame>`): the rows to be scaled
+        preprocessor (:obj:`dict`): the fitted preprocessing artifact
+
+    Returns:
+        scaled (:obj:`numpy.ndarray`): the scaled features in the preprocessor feature order
+    """
+    values = data[preprocessor['features']].to_numpy(dtype=np.float64)
+    return np.ascontiguousarray(preprocessor['scalar'].transform(values))
+
+
+def apply_preprocessor(data, preprocessor):
+    """Standardize the cleaned dataframe with the fitted preprocessor
+
+    Args:
+        data (:obj:`DataFrame <pandas.DataFrame>`): the dataframe to be standardized
+        preprocessor (:obj:`dict`): the fitted preprocessing artifact
+
+    Returns:
+        df_scale (:obj:`DataFrame <pandas.DataFrame>`): the dataframe after standardized
+    """
+    df_scale = data.copy(deep=True)
+    df_scale[preprocessor['features']] = transform_features(data, preprocessor)
+    return df_scale
+
+
+def save_scaled_chunks(chunks, preprocessor, save_path):
+    """Scale the cleaned data chunk by chunk into a ``.npy`` file and open it memory-mapped, so
+    that neither the dataframe nor the scaled matrix has to fit in memory
+
+    Args:
+        chunks (:obj:`iterable`): the cleaned data as dataframes, see :func:`read_data_chunks`
+        preprocessor (:obj:`dict`): the fitted preprocessing artifact
+        save_path (str): the path of the ``.npy`` file
+
+    Returns:
+        values (:obj:`numpy.memmap`): the scaled features in the preprocessor feature order
+    """
+    # the rows are counted on the way, the header with the final shape is written afterwards
+    n_rows = 0
+    with open(save_path + '.part', 'wb') as f:
+        for chunk in chunks:
+            transform_features(chunk, preprocessor).tofile(f)
+            n_rows += len(chunk)
+    if n_rows == 0:
+        os.remove(save_path + '.part')
+        raise ValueError("No rows to scale into %s" % save_path)
+
+    with open(save_path, 'wb') as f, open(save_path + '.part', 'rb') as part:
+        header = {'descr': np.dtype(np.float64).str, 'fortran_order': False,
+                  'shape': (n_rows, len(preprocessor['features']))}
+        np.lib.format.write_array_header_1_0(f, header)
+        shutil.copyfileobj(part, f)
+    os.remove(save_path + '.part')
+    logger.info("%i scaled observations are saved to path %s", n_rows, save_path)
+
+    return np.load(save_path, mmap_mode='r')
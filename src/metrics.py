@@ -0,0 +1,358 @@
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows, the peak RSS is not recorded
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# seconds, from half a millisecond up to the batch timeout of the web app
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _labels(names, values):
+    """Prometheus label set of a sample, empty without labels"""
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                             for name, value in zip(names, values))
+
+
+class Counter:
+    """Monotonic counter, one value per combination of label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Add ``amount`` to the counter of the given label values"""
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Current value of the counter of the given label values"""
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def dump(self):
+        """The values by label values, as json"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, values):
+        """Add values written by :meth:`dump`, e.g. of another process"""
+        with self._lock:
+            for key, value in values:
+                self._values[tuple(key)] = self._values.get(tuple(key), 0) + value
+
+    def reset(self):
+        """Forget every value"""
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['%s_total%s %s' % (self.name, _labels(self.labelnames, key), _number(value))
+                for key, value in values]
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values with fixed bucket bounds, one per combination of
+    label values. Observing a value is a bisect and an increment under a lock, cheap enough for
+    every stage of every request.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Count one observed value"""
+        key = tuple(labels[name] for name in self.labelnames)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, the +Inf bucket, and the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[slot] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds the block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        """Number of values observed with the given label values"""
+        counts = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return 0 if counts is None else sum(counts[:-1])
+
+    def dump(self):
+        """The bucket counts and sum by label values, as json"""
+        with self._lock:
+            return [[list(key), list(counts)] for key, counts in self._values.items()]
+
+    def merge(self, values):
+        """Add bucket counts and sums written by :meth:`dump`, e.g. of another process"""
+        with self._lock:
+            for key, counts in values:
+                if len(counts) != len(self.buckets) + 2:
+                    raise ValueError("Histogram %s has %i buckets, not %i" % (
+                        self.name, len(self.buckets), len(counts) - 2))
+                merged = self._values.setdefault(tuple(key), [0] * (len(self.buckets) + 1) + [0.0])
+                for i, count in enumerate(counts):
+                    merged[i] += count
+
+    def reset(self):
+        """Forget every observed value"""
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %i' % (self.name, _labels(self.labelnames + ('le',),
+                                                                    key + (_number(bound),)),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labelnames, key),
+                                          _number(counts[-1])))
+            lines.append('%s_count%s %i' % (self.name, _labels(self.labelnames, key), cumulative))
+        return lines
+
+
+def _number(value):
+    """Prometheus text format of a sample value"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    The metrics of one process, rendered in the Prometheus text exposition format.
+
+    With a ``directory``, every process writes its values to ``directory/<pid>.json`` at most
+    every ``flush_interval`` seconds, a flush within that time is done by a timer once it is
+    over, and :meth:`render` sums the files of all processes, so that
+    any gunicorn worker serves the metrics of all of them. Values recorded before a fork are
+    dropped in the child by :func:`reset_after_fork`, the master's own are not counted by every
+    worker again.
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._flushed = 0.0
+        self._timer = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            _shared_registries.add(self)
+
+    def counter(self, name, documentation, labelnames=()):
+        """Register a :class:`Counter`, or return the one registered under ``name``"""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Register a :class:`Histogram`, or return the one registered under ``name``"""
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def _register(self, kind, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = kind(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, kind):
+                raise ValueError("Metric %s is already registered as a %s" % (name, metric.kind))
+            return metric
+
+    def _reset(self):
+        """forget the values inherited from the parent process, and its locks"""
+        self._lock = threading.Lock()
+        self._flushed = 0.0
+        self._timer = None
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def flush(self, force=False):
+        """Write the values of this process to the shared directory
+
+        Args:
+            force (bool): write even if the last write is less than ``flush_interval`` seconds old,
+                otherwise the write is left to a timer
+
+        Returns:
+            bool: True if the values were written
+        """
+        if self.directory is None:
+            return False
+        with self._lock:
+            wait = self._flushed + self.flush_interval - time.monotonic()
+            if not force and wait > 0:
+                # the last values are written even if no further flush comes
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self._flush_pending)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return False
+            self._flushed = time.monotonic()
+            metrics = sorted(self._metrics.items())
+        state = {name: {'kind': metric.kind, 'documentation': metric.documentation,
+                        'labelnames': list(metric.labelnames),
+                        'buckets': list(getattr(metric, 'buckets', ())), 'values': metric.dump()}
+                 for name, metric in metrics}
+        path = os.path.join(self.directory, '%i.json' % os.getpid())
+        # one temporary file per thread, the rename makes the new values appear at once
+        tmp = '%s.%i.tmp' % (path, threading.get_ident())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, path)
+        except OSError as errors:
+            logger.warning("Metrics could not be written to %s: %s", path, errors)
+            return False
+        return True
+
+    def _flush_pending(self):
+        """write the values held back by :meth:`flush`"""
+        with self._lock:
+            self._timer = None
+        self.flush(force=True)
+
+    def _collect(self):
+        """the metrics summed over the files of every process in the shared directory"""
+        merged = MetricsRegistry()
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json'))):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                logger.warning("Metrics file %s could not be read, it is skipped", path)
+                continue
+            for name, entry in state.items():
+                if entry['kind'] == Histogram.kind:
+                    metric = merged.histogram(name, entry['documentation'], entry['labelnames'],
+                                              entry['buckets'])
+                else:
+                    metric = merged.counter(name, entry['documentation'], entry['labelnames'])
+                metric.merge(entry['values'])
+        return merged._metrics
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format, of every process with a
+        shared directory"""
+        if self.directory is None:
+            metrics = self._metrics
+        else:
+            self.flush(force=True)
+            metrics = self._collect()
+        lines = []
+        for name, metric in sorted(metrics.items()):
+            lines.append('# HELP %s %s' % (name, metric.documentation))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+# the registries with a directory, reset in a forked child. Weak, so that they are not kept alive
+_shared_registries = weakref.WeakSet()
+
+
+def reset_after_fork():
+    """Forget the values of every registry with a directory that this process inherited from
+    the one it was forked from. Runs by itself after a fork on Python 3.7 and later, servers on
+    older ones call it in the child, e.g. gunicorn in its ``post_fork`` hook"""
+    for registry in list(_shared_registries):
+        registry._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process so far in MB, None where it cannot be read"""
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class StageTimer:
+    """
+    Wall time and memory of the stages of a pipeline run, saved as a csv. The peak RSS of a
+    process only grows, so every stage records how much it raised it (``peak_rss_delta_mb``, 0
+    if the stage stayed below the peak of an earlier one) next to the peak of the process so far
+    (``process_peak_rss_mb``).
+    """
+
+    def __init__(self):
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        """Record the block as a stage, the yielded record can be annotated by the block"""
+        record = {'stage': name}
+        start, start_rss = time.perf_counter(), peak_rss_mb()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['process_peak_rss_mb'] = peak_rss_mb()
+            record['peak_rss_delta_mb'] = None if start_rss is None else \
+                round(record['process_peak_rss_mb'] - start_rss, 1)
+            self.records.append(record)
+            logger.info("Stage %s took %.3f seconds, raised the peak RSS by %s MB to %s MB", name,
+                        record['seconds'], record['peak_rss_delta_mb'],
+                        record['process_peak_rss_mb'])
+
+    def save(self, save_path):
+        """Save the stage records
+
+        Args:
+            save_path (str): the path of the csv
+
+        Returns:
+            metrics (:obj:`DataFrame <pandas.DataFrame>`): one row per stage
+        """
+        metrics = pd.DataFrame(self.records)
+        metrics.to_csv(save_path, index=False)
+        logger.info("Pipeline metrics are saved to path %s", save_path)
+        return metrics
@@ -1,31 +1,58 @@
 import logging
+import time
 
 import numpy as np
 import pandas as pd
-from joblib import dump, load
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score, pairwise_distances
+from joblib import Parallel, delayed, dump, load
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score, pairwise_distances
 
-from src.clean_data import standardization, get_standard_scalar
+from src.clean_data import get_standard_scalar, load_preprocessor, transform_features
 
 logger = logging.getLogger(__name__)
 
 
-def generate_kmeans(data, features, n_cluster, seed, model_save_path):
+def generate_kmeans(data, features, n_cluster, seed, model_save_path, engine='kmeans',
+                    batch_size=10000, n_epochs=1):
     """Initialize the k-means clustering model
 
     Args:
-        data (:obj:`DataFrame <pandas.DataFrame>`): the data used for generate k means clustering
+        data (:obj:`DataFrame <pandas.DataFrame>`): the standardized data used for generate k means
+            clustering. With the minibatch engine this can also be a function that returns a fresh
+            iterator of standardized chunks on every call, so the data never has to fit in memory
         features (:obj:`list`): list of features
         n_cluster (int): number of clusters
         seed (int): the random state
         model_save_path (str): the path to save k means model
+        engine (str): 'kmeans' for a full fit in memory, 'minibatch' for MiniBatchKMeans fitted
+            with partial_fit chunk by chunk
+        batch_size (int): number of rows per chunk for the minibatch engine
+        n_epochs (int): number of passes over the chunks for the minibatch engine
 
     Returns:
         model (:obj:`joblib`): the k means clustering model
     """
-    scale_df = standardization(data, features)
-    model = KMeans(n_clusters=n_cluster, random_state=seed).fit(scale_df[features])
+    if engine == 'kmeans':
+        # data is scaled by the fitted preprocessor already, so it is not standardized again here
+        model = KMeans(n_clusters=n_cluster, random_state=seed).fit(data[features].values)
+    elif engine == 'minibatch':
+        if callable(data):
+            read_chunks = data
+        else:
+            def read_chunks():
+                return (data.iloc[lo:lo + batch_size] for lo in range(0, len(data), batch_size))
+
+        model = MiniBatchKMeans(n_clusters=n_cluster, random_state=seed, batch_size=batch_size)
+        for epoch in range(n_epochs):
+            for chunk in read_chunks():
+                model.partial_fit(chunk[features].values)
+            logger.debug("Mini-batch k-means epoch %i done", epoch + 1)
+
+        # labels of every row, like a full fit, for the evaluation and the cluster index
+        model.labels_ = np.concatenate([model.predict(chunk[features].values)
+                                        for chunk in read_chunks()])
+    else:
+        raise ValueError("Unknown k-means engine %s, use 'kmeans' or 'minibatch'" % engine)
 
     # save model to joblib
     dump(model, model_save_path)
@@ -34,20 +61,28 @@ def generate_kmeans(data, features, n_cluster, seed, model_save_path):
     return model
 
 
-def model_evaluation(data, model, features, metric_save_path):
-    """Evaluate k-means clustering using silhouette score
+def model_evaluation(data, model, features, metric_save_path, sample_size=None, seed=None, n_jobs=1,
+                     block_size=1024):
+    """Evaluate k-means clustering using silhouette score, Davies-Bouldin and Calinski-Harabasz
 
     Args:
         data (:obj:`DataFrame <pandas.DataFrame>`): the scaled records of chocolate bars
         model (:obj:`sklearn.cluster._kmeans.KMeans`): the k-means clustering model
         features (:obj:`list`): list of features used for clustering
         metric_save_path (str): path for the performance metric
+        sample_size (int): number of records the silhouette score is computed on, all if None
+        seed (int): the random state for drawing the sample
+        n_jobs (int): number of blocks of the silhouette score computed in parallel
+        block_size (int): number of records per block of the silhouette score
 
     Returns:
-        None
+        metrics (:obj:`DataFrame <pandas.DataFrame>`): value and compute time of every metric
     """
+    values = data[features].values
+    labels = model.labels_ if len(model.labels_) == len(values) else model.predict(values)
 
-    si_score = silhouette_score(data[features], model.labels_)
+    metrics = evaluate_clusters(values, labels, sample_size, seed, n_jobs, block_size)
+    si_score = metrics.loc[metrics['metric'] == 'silhouette score', 'value'].iloc[0]
     if si_score >= 0.4:
         logger.info('The model has silhouette score %f ', si_score)
     else:
@@ -55,20 +90,103 @@ def model_evaluation(data, model, features, metric_save_path):
                        'products well', si_score)
 
     # save performance metric
-    pd.DataFrame({'silhouette score:': [si_score]}).to_csv(metric_save_path)
+    metrics.to_csv(metric_save_path, index=False)
     logger.info('The performance metric is saved to path %s', metric_save_path)
 
+    return metrics
+
+
+def evaluate_clusters(values, labels, sample_size=None, seed=None, n_jobs=1, block_size=1024):
+    """Compute the clustering metrics and the time each of them takes
+
+    Args:
+        values (:obj:`numpy.ndarray`): the scaled features, one row per record
+        labels (:obj:`numpy.ndarray`): the cluster label of every record
+        sample_size (int): number of records the silhouette score is computed on, all if None
+        seed (int): the random state for drawing the sample
+        n_jobs (int): number of blocks of the silhouette score computed in parallel
+        block_size (int): number of records per block of the silhouette score
+
+    Returns:
+        metrics (:obj:`DataFrame <pandas.DataFrame>`): value and compute time of every metric
+    """
+    labels = np.asarray(labels)
+    if sample_size is not None and sample_size < len(values):
+        sample = np.random.RandomState(seed).choice(len(values), sample_size, replace=False)
+    else:
+        sample = np.arange(len(values))
+
+    records = []
+    for name, metric, rows in [('silhouette score', silhouette_blocks, sample),
+                               ('davies bouldin score', davies_bouldin_score, None),
+                               ('calinski harabasz score', calinski_harabasz_score, None)]:
+        start = time.perf_counter()
+        if rows is None:
+            value = metric(values, labels)
+        else:
+            value = metric(values[rows], labels[rows], n_jobs=n_jobs, block_size=block_size)
+        records.append([name, value, time.perf_counter() - start, len(values if rows is None else rows)])
+        logger.debug('%s computed in %.3f seconds', name, records[-1][2])
+
+    return pd.DataFrame(records, columns=['metric', 'value', 'seconds', 'n_records'])
+
+
+def silhouette_blocks(values, labels, n_jobs=1, block_size=1024):
+    """Mean silhouette coefficient computed block by block, so memory is ``block_size`` x n
+
+    Args:
+        values (:obj:`numpy.ndarray`): the scaled features, one row per record
+        labels (:obj:`numpy.ndarray`): the cluster label of every record
+        n_jobs (int): number of blocks computed in parallel
+        block_size (int): number of records per block
+
+    Returns:
+        score (float): the mean silhouette coefficient
+    """
+    clusters, labels = np.unique(labels, return_inverse=True)
+    if not 2 <= len(clusters) < len(values):
+        raise ValueError("Number of labels is %i. Valid values are 2 to n_samples - 1 "
+                         "(inclusive)" % len(clusters))
+    onehot = np.zeros((len(values), len(clusters)))
+    onehot[np.arange(len(values)), labels] = 1.0
+    counts = onehot.sum(axis=0)
+
+    blocks = [np.arange(lo, min(lo + block_size, len(values)))
+              for lo in range(0, len(values), block_size)]
+    # the distance blocks are numpy matrix products, which release the GIL
+    scores = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_silhouette_block)(values, onehot, counts, labels, rows) for rows in blocks)
+
+    return float(np.mean(np.concatenate(scores)))
+
+
+def _silhouette_block(values, onehot, counts, labels, rows):
+    """silhouette coefficient of the records in one block"""
+    cluster_dists = pairwise_distances(values[rows], values) @ onehot
+    own = labels[rows]
+    pos = np.arange(len(rows))
+
+    intra = cluster_dists[pos, own] / np.maximum(counts[own] - 1, 1)
+    cluster_dists[pos, own] = np.inf
+    inter = np.min(cluster_dists / counts, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = (inter - intra) / np.maximum(intra, inter)
+    scores[counts[own] == 1] = 0.0
+    return np.nan_to_num(scores)
+
 
 def predict_user_input(data, user_input, model_save_path, store_path, features, top, clean_vars,
                        web_display_vars, cluster_labels='cluster_label', bar_index='index',
-                       preset_index='999999'):
+                       preset_index='999999', preprocessor_save_path=None, model=None,
+                       writer=None):
     """Cluster the user input product information and format the prediction result
 
     Args:
         data (:obj:`DataFrame <pandas.DataFrame>`): the records of chocolate bars
         user_input (:obj:`DataFrame <pandas.DataFrame>`): one row dataframe that contains user input
         model_save_path (str): path for the model joblib file
-        store_path (str): the path to store the recommendation table
+        store_path (str): the path to store the recommendation table, not stored if None
         features (:obj:`list`): the list of features for recommendation generation
         top (int) : choose the top n products for recommendation
         clean_vars (:obj:`list`): the list of features stored in cleaned data
@@ -76,22 +194,36 @@ def predict_user_input(data, user_input, model_save_path, store_path, features,
         cluster_labels (str): the column name for storing cluster label
         bar_index (str): the column name for chocolate bar index
         preset_index (str): the preset index for user input chocolate bar information
+        preprocessor_save_path (str): path for the preprocessing artifact saved at training time,
+            the scalar is refitted on data if None
+        model (:obj:`sklearn.cluster._kmeans.KMeans`): the k-means clustering model already held
+            in memory, loaded from model_save_path if None
+        writer (callable): called with the recommendation table to persist it some other way
 
     Returns:
         result (:obj:`DataFrame <pandas.DataFrame>`): the recommendation table
     """
     clean_df = data[clean_vars]
     df_web_display = data[web_display_vars]
-    scale_df = standardization(clean_df, features)
-
-    try:
-        model = load(model_save_path)
-        logger.info("Model is loaded from %s", model_save_path)
-    except OSError:
-        logger.error("Model at the specified path %s is noy found", model_save_path)
+    if preprocessor_save_path is not None:
+        preprocessor = load_preprocessor(preprocessor_save_path)
+        features = preprocessor['features']
+        scalar = preprocessor['scalar']
+    else:
+        scalar = get_standard_scalar(clean_df, features)
+    scale_df = clean_df.copy(deep=True)
+    scale_df[features] = scalar.transform(clean_df[features].values)
+
+    if model is None:
+        try:
+            model = load(model_save_path)
+            logger.info("Model is loaded from %s", model_save_path)
+        except OSError:
+            logger.error("Model at the specified path %s is not found", model_save_path)
+            raise
 
     # scale and concat user input data
-    scale_user_array = get_standard_scalar(clean_df, features).transform(user_input[features])
+    scale_user_array = scalar.transform(user_input[features].values)
     scale_user = user_input.copy(deep=True)
     scale_user[features] = scale_user_array
 
@@ -105,11 +237,182 @@ def predict_user_input(data, user_input, model_save_path, store_path, features,
     logger.debug('User input is classified as %i', int(clean_df[clean_df[bar_index] ==
                                                                 preset_index][cluster_labels]))
 
-    result = formatting_preds(clean_df, df_web_display, features, top, store_path)
+    result = formatting_preds(clean_df, df_web_display, features, top, store_path, writer=writer)
 
     return result
 
 
+def predict_from_snapshot(snapshot, user_input, model, top,
+                          rec_product_name='chocolate_bar', rank_name='rank', bar_index='index'):
+    """Cluster the user input product information against an in-memory catalog snapshot
+
+    Args:
+        snapshot (:obj:`CatalogSnapshot <src.catalog.CatalogSnapshot>`): the catalog snapshot
+        user_input (:obj:`DataFrame <pandas.DataFrame>`): one row dataframe that contains user input
+        model (:obj:`sklearn.cluster._kmeans.KMeans`): the k-means clustering model, the one the
+            snapshot was labelled with if None
+        top (int) : choose the top n products for recommendation
+        rec_product_name (str): the name of product to be recommended
+        rank_name (str): the rank of products to be recommended
+        bar_index (str): the column name for chocolate bar index
+
+    Returns:
+        result (:obj:`Recommendations`): the recommendation table
+    """
+    if model is None:
+        model = snapshot.model
+    scale_user = transform_features(user_input, snapshot.preprocessor)
+    input_cluster = int(model.predict(scale_user)[0])
+    logger.debug('User input is classified as %i', input_cluster)
+
+    # one distance pass over the bars of the user input cluster, then top-k
+    top_recs, _ = snapshot.index.query(scale_user[0], input_cluster, top)
+
+    return snapshot_recs(snapshot, top_recs, rec_product_name, rank_name, bar_index)
+
+
+def predict_batch_from_snapshot(snapshot, user_inputs, top, block_size=1024,
+                                rec_product_name='chocolate_bar', rank_name='rank',
+                                bar_index='index', timings=None):
+    """Cluster many user inputs against an in-memory catalog snapshot in one vectorized call
+
+    Args:
+        snapshot (:obj:`CatalogSnapshot <src.catalog.CatalogSnapshot>`): the catalog snapshot
+        user_inputs (:obj:`DataFrame <pandas.DataFrame>`): the user inputs, one per row
+        top (int) : choose the top n products for recommendation
+        block_size (int): the number of user inputs scored together in one matrix product
+        rec_product_name (str): the name of product to be recommended
+        rank_name (str): the rank of products to be recommended
+        bar_index (str): the column name for chocolate bar index
+        timings (:obj:`dict`): filled with the seconds spent scaling, predicting the clusters,
+            in the distance and top-k search and assembling the tables, if given
+
+    Returns:
+        results (:obj:`list`): the :obj:`Recommendations` of every user input
+    """
+    start = time.perf_counter()
+    scale_users = transform_features(user_inputs, snapshot.preprocessor)
+    scaled = time.perf_counter()
+    input_clusters = snapshot.model.predict(scale_users)
+    predicted = time.perf_counter()
+    positions, _ = snapshot.index.query_batch(scale_users, input_clusters, top, block_size)
+    searched = time.perf_counter()
+
+    results = snapshot_batch_recs(snapshot, positions, rec_product_name, rank_name, bar_index)
+    if timings is not None:
+        timings.update(scale=scaled - start, predict=predicted - scaled, topk=searched - predicted,
+                       assemble=time.perf_counter() - searched)
+    return results
+
+
+def snapshot_recs(snapshot, top_recs, rec_product_name='chocolate_bar', rank_name='rank',
+                  bar_index='index'):
+    """Build the recommendation table from catalog positions of a snapshot"""
+    return Recommendations(snapshot.ids[top_recs], _display_columns(snapshot, top_recs, bar_index),
+                           _display_names(snapshot, bar_index), rec_product_name, rank_name)
+
+
+def snapshot_batch_recs(snapshot, positions, rec_product_name='chocolate_bar', rank_name='rank',
+                        bar_index='index'):
+    """Build the recommendation tables of many user inputs with one gather of the display columns
+
+    Args:
+        snapshot (:obj:`CatalogSnapshot <src.catalog.CatalogSnapshot>`): the catalog snapshot
+        positions (:obj:`numpy.ndarray`): catalog positions of the recommendations per user input,
+            padded with -1
+        rec_product_name (str): the name of product to be recommended
+        rank_name (str): the rank of products to be recommended
+        bar_index (str): the column name for chocolate bar index
+
+    Returns:
+        results (:obj:`list`): the :obj:`Recommendations` of every user input
+    """
+    found = positions >= 0
+    flat = positions[found]
+    # one gather, or one database query with lazy display columns, for the whole batch
+    bars = snapshot.ids[flat]
+    display = _display_columns(snapshot, flat, bar_index)
+    names = _display_names(snapshot, bar_index)
+    counts = found.sum(axis=1)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    return [Recommendations(bars[start:end], display[start:end], names, rec_product_name, rank_name)
+            for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def _display_names(snapshot, bar_index):
+    """Display columns of a snapshot without the chocolate bar index, which is shown as the bar"""
+    return [var for var in snapshot.display_vars if var != bar_index]
+
+
+def _display_columns(snapshot, positions, bar_index):
+    """Display columns of the bars at the given catalog positions, without the bar index"""
+    rows = np.asarray(snapshot.display_rows(positions), dtype=object).reshape(
+        len(positions), len(snapshot.display_vars))
+    if bar_index not in snapshot.display_vars:
+        return rows
+    return np.delete(rows, snapshot.display_vars.index(bar_index), axis=1)
+
+
+def _native(value):
+    """Plain Python value of a NumPy scalar, so that records can be serialized to json"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class Recommendations:
+    """
+    Recommendation table of one user input held as arrays in rank order: the chocolate bar
+    indexes and a 2d array of their display columns. Building it is a gather, with none of the
+    overhead of a DataFrame; :meth:`records` gives the rows with named fields for the web page
+    and the JSON API, :meth:`to_frame` the DataFrame for storing it.
+    """
+
+    __slots__ = ('bars', 'display', 'display_vars', 'rec_product_name', 'rank_name')
+
+    def __init__(self, bars, display, display_vars, rec_product_name='chocolate_bar', rank_name='rank'):
+        self.bars = bars
+        self.display = display
+        self.display_vars = list(display_vars)
+        self.rec_product_name = rec_product_name
+        self.rank_name = rank_name
+
+    def __len__(self):
+        return len(self.bars)
+
+    def __repr__(self):
+        return "<Recommendations of %i chocolate bars>" % len(self)
+
+    @property
+    def columns(self):
+        return [self.rank_name, self.rec_product_name] + self.display_vars
+
+    @property
+    def ranks(self):
+        return np.arange(1, len(self.bars) + 1)
+
+    def __getitem__(self, name):
+        """One column of the table as an array"""
+        if name == self.rank_name:
+            return self.ranks
+        if name == self.rec_product_name:
+            return self.bars
+        return self.display[:, self.display_vars.index(name)]
+
+    def records(self):
+        """The rows of the table as dictionaries of plain Python values, best ranked first"""
+        columns = self.columns
+        return [dict(zip(columns, [rank, bar] + [_native(cell) for cell in row]))
+                for rank, bar, row in zip(range(1, len(self.bars) + 1), self.bars.tolist(),
+                                          self.display.tolist())]
+
+    def to_frame(self):
+        """The table as a DataFrame, with the rank and the chocolate bar first"""
+        result = pd.DataFrame(self.display, columns=self.display_vars)
+        result.insert(0, self.rank_name, self.ranks)
+        result.insert(1, self.rec_product_name, self.bars)
+        return result
+
+
 def get_userinput(cocoa, rating, beans, cocoa_butter, vanilla, lecithin, salt, sugar,
                   sweetener_without_sugar, input_cols, preset_index, replace_dict):
     """Formatting user input data from flask app
@@ -140,10 +443,10 @@ def get_userinput(cocoa, rating, beans, cocoa_butter, vanilla, lecithin, salt, s
     return input_value
 
 
-def formatting_preds(preds, raw_df, features, top, store_path, choco_index='index',
+def formatting_preds(preds, raw_df, features, top, store_path=None, choco_index='index',
                      user_input_index='999999', cluster_labels='cluster_label',
                      rec_product_name='chocolate_bar', rank_name='rank',
-                     join_method='inner', drop_idx1='index_x', drop_idx2='index_y'):
+                     join_method='inner', writer=None):
     """Formatting prediction dataframe, calculate the relative distance matrix, and generate a
     recommendation table with top 10 recommended products
 
@@ -152,55 +455,87 @@ def formatting_preds(preds, raw_df, features, top, store_path, choco_index='inde
         raw_df (:obj:`DataFrame <pandas.DataFrame>`): the raw dataframe that contain raw features
         features (:obj:`list`): the list of features in preds dataframe
         top (int): the top n products to be recommended
-        store_path (str): the path that store recommendation table
+        store_path (str): the path that store recommendation table, not stored if None
         choco_index (str): the index column name
         user_input_index (str): the value for user input in the index column
         cluster_labels (str): the column name for cluster label
         rec_product_name (str): the name of product to be recommended
         rank_name (str): the rank of products to be recommended
-        join_method (str): the join method for merging prediction dataframe with raw dataframe
-        drop_idx1 (str): the 1st index column to be dropped after merging
-        drop_idx2 (str): the 2nd index column to be dropped after merging
+        join_method (str): 'inner' to leave out recommended bars missing from the raw dataframe,
+            'left' to keep them with empty display columns
+        writer (callable): called with the recommendation table to persist it some other way,
+            e.g. an :obj:`AuditLog <src.audit.AuditLog>`
 
     Returns:
         rec_result (:obj:`DataFrame <pandas.DataFrame>`): the recommendation table
     """
-    # get distance matrix
+    # get distances from the user input to the bars in its cluster, the user input is kept first
     input_cluster = int(preds[preds[choco_index] == user_input_index][cluster_labels])
     clusters = preds[preds[cluster_labels] == input_cluster].reset_index(drop=True)
-    dist_matrix = pairwise_distances(clusters[features])
+    user_pos = np.flatnonzero((clusters[choco_index] == user_input_index).to_numpy())[:1]
+    dist_row = pairwise_distances(clusters.iloc[user_pos][features], clusters[features])[0]
+    dist_row[user_pos] = -np.inf
 
-    # get top n chocolate bars for user input
-    top_recs = np.argsort(dist_matrix)[:, :(top + 1)]
-    ref_dicts = clusters[choco_index].to_dict()
-    vectorization = np.vectorize(ref_dicts.get)(top_recs)
-    df_recs = pd.DataFrame(vectorization, columns=[choco_index] + [f'chocolate{i}'
-                                                                   for i in range(1, top+1)])
-    df_recs = df_recs[df_recs[choco_index] == int(user_input_index)]
+    # get top n chocolate bars for user input, ranked by position
+    top_recs = np.argsort(dist_row, kind='stable')[1:(top + 1)]
+    bars = clusters[choco_index].to_numpy()[top_recs].astype(np.int64)
+    ranked = pd.DataFrame({rank_name: np.arange(1, len(bars) + 1), rec_product_name: bars})
 
-    # melt and map result dataframe
-    melts = melting_dataset(df_recs, choco_index, rank_name, rec_product_name)
-    rec_result = mapping(melts, rec_product_name, raw_df, choco_index, join_method, drop_idx1,
-                         drop_idx2)
+    # gather the display columns of the recommended bars
+    rec_result = mapping(ranked, rec_product_name, raw_df, choco_index, join_method)
 
     # store recommendation to csv
-    rec_result.to_csv(store_path, index=False)
+    if store_path is not None:
+        rec_result.to_csv(store_path, index=False)
+    if writer is not None:
+        writer(rec_result)
 
     return rec_result
 
 
-def mapping(melts, rec_product_name, raw_df, choco_index, join_method, drop_idx1, drop_idx2):
-    """mapping chocolate bars by reference number"""
-    melts[rec_product_name] = [int(x) for x in melts[rec_product_name]]
-    mapped_df = pd.merge(melts, raw_df, left_on=rec_product_name, right_on=choco_index,
-                         how=join_method).drop([drop_idx1, drop_idx2], axis=1)
+def mapping(melts, rec_product_name, raw_df, choco_index, join_method='inner'):
+    """mapping chocolate bars by reference number
 
-    return mapped_df
+    The rows of ``raw_df`` are gathered by position through an index of the chocolate bar
+    numbers instead of merging the frames, so the bar numbers must be unique in ``raw_df``.
+
+    Args:
+        melts (:obj:`DataFrame <pandas.DataFrame>`): the ranked recommendations
+        rec_product_name (str): the column name of the recommended chocolate bar numbers
+        raw_df (:obj:`DataFrame <pandas.DataFrame>`): the display columns of the chocolate bars
+        choco_index (str): the column name of the chocolate bar numbers in raw_df
+        join_method (str): 'inner' to leave out bars missing from raw_df, 'left' to keep them
+            with empty display columns
+
+    Returns:
+        mapped_df (:obj:`DataFrame <pandas.DataFrame>`): the recommendations with their display
+        columns
+    """
+    if join_method not in ('inner', 'left'):
+        raise ValueError("join_method must be 'inner' or 'left', got %r" % join_method)
+    bars = melts[rec_product_name].to_numpy(dtype=np.int64)
+    catalog = pd.Index(raw_df[choco_index].to_numpy(dtype=np.int64))
+    if not catalog.is_unique:
+        raise ValueError("Chocolate bar numbers in column %s are not unique" % choco_index)
+    rows = catalog.get_indexer(bars)
+    if join_method == 'inner':
+        keep = rows >= 0
+        bars, rows, melts = bars[keep], rows[keep], melts[keep]
+
+    mapped_df = melts.drop(columns=choco_index, errors='ignore').reset_index(drop=True)
+    mapped_df[rec_product_name] = bars
+    # bars missing from raw_df are at -1, which gives rows of NaN like a left merge
+    display = raw_df.drop(columns=choco_index).reset_index(drop=True).reindex(rows)
+    return pd.concat([mapped_df, display.reset_index(drop=True)], axis=1)
 
 
 def melting_dataset(df_recs, choco_idx, rank_name, rec_product_name, product_str='chocolate'):
     """melting dataframe and ranking products in dataframe"""
-    df_melted = df_recs.melt(id_vars=[choco_idx], var_name=rank_name, value_name=rec_product_name).\
-        drop_duplicates()
-    df_melted[rank_name] = [int(x.replace(product_str, '')) for x in df_melted[rank_name]]
-    return df_melted
+    rank_cols = [col for col in df_recs.columns if col != choco_idx]
+    # the rank is parsed once per column, then repeated for every row like a melt
+    ranks = np.array([int(col.replace(product_str, '')) for col in rank_cols], dtype=np.int64)
+    n_rows = len(df_recs)
+    df_melted = pd.DataFrame({choco_idx: np.tile(df_recs[choco_idx].to_numpy(), len(rank_cols)),
+                              rank_name: np.repeat(ranks, n_rows),
+                              rec_product_name: df_recs[rank_cols].to_numpy().T.ravel()})
+    return df_melted.drop_duplicates()
@@ -1,15 +1,30 @@
+import hashlib
 import logging.config
+import time
 
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Float, Integer, String
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Float, Index, Integer, String, func
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 logger.setLevel("INFO")
 Base = declarative_base()
 
+# the chocolate bar id, inserted from the clean data when it has one so that the table and the
+# catalogs built from the clean data agree on it
+BAR_INDEX = 'index'
+# columns filled by the loader to recognize a row across loads and the load that last wrote it,
+# they are not in the clean data
+KEY_COLUMNS = ['row_key', 'row_hash', 'row_version']
+# columns the recommendations are computed from, covered by one index so that the serving query
+# is answered from the index alone
+FEATURE_COLUMNS = ['cocoa_percent', 'rating', 'beans', 'cocoa_butter', 'vanilla', 'lecithin', 'salt',
+                   'sugar', 'sweetener_without_sugar']
+
+# engines created by get_engine, one per connection string and options
+_engines = {}
+
 
 class Chocolates(Base):
 
@@ -32,28 +47,89 @@ class Chocolates(Base):
     sweetener_without_sugar = Column(String(25), unique=False, nullable=False)
     first_taste = Column(String(25), unique=False, nullable=False)
     second_taste = Column(String(25), unique=False, nullable=False)
+    row_key = Column(String(40), unique=False, nullable=True, index=True)
+    row_hash = Column(String(40), unique=False, nullable=True)
+    row_version = Column(Integer, unique=False, nullable=True)
+
+    __table_args__ = (Index('ix_chocolates_features', *FEATURE_COLUMNS),)
 
     def __repr__(self):
         return "<Chocolate Bar No. %i>" % self.index
 
 
-def create_db(engine_string):
+def get_engine(engine_string, **engine_options):
+    """Return the engine of a connection string, created once per process so its pool is reused
+
+    Args:
+        engine_string (str): Engine string
+        **engine_options: keyword arguments of :func:`sqlalchemy.create_engine`, e.g. pool_size
+
+    Returns:
+        engine (:obj:`sqlalchemy.engine.Engine`): the engine
+    """
+    key = (engine_string, tuple(sorted(engine_options.items())))
+    if key not in _engines:
+        _engines[key] = sqlalchemy.create_engine(engine_string, **engine_options)
+    return _engines[key]
+
+
+def create_db(engine_string, engine_options=None):
     """
     Create database from provided engine string
 
     Args:
         engine_string (str): Engine string
+        engine_options (:obj:`dict`): keyword arguments of :func:`sqlalchemy.create_engine`
 
     Returns: 
         None
     """
-    engine = sqlalchemy.create_engine(engine_string)
+    engine = get_engine(engine_string, **(engine_options or {}))
 
     Base.metadata.create_all(engine)
+    migrate_db(engine)
     logger.info(engine)
     logger.info("Database created.")
 
 
+def migrate_db(engine):
+    """Add the columns and indexes that a chocolates table created by an earlier version lacks
+
+    ``create_all`` only creates missing tables, it does not change existing ones. The added
+    columns are empty until the next load fills them.
+
+    Args:
+        engine (:obj:`sqlalchemy.engine.Engine`): engine for the database
+
+    Returns:
+        added (:obj:`list`): the names of the added columns and indexes
+    """
+    table = Chocolates.__table__
+    inspector = sqlalchemy.inspect(engine)
+    if table.name not in inspector.get_table_names():
+        return []
+    columns = {col['name'] for col in inspector.get_columns(table.name)}
+    indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+    preparer = engine.dialect.identifier_preparer
+
+    added = []
+    with engine.begin() as conn:
+        for col in table.columns:
+            if col.name not in columns:
+                conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    preparer.format_table(table), preparer.format_column(col),
+                    col.type.compile(dialect=engine.dialect)))
+                added.append(col.name)
+    for index in table.indexes:
+        if index.name not in indexes:
+            index.create(bind=engine)
+            added.append(index.name)
+
+    if added:
+        logger.info("Chocolates table is migrated, %s added", ", ".join(added))
+    return added
+
+
 def add_rows(file_path, session):
     """Add rows of chocolate bar records into the RDS database
 
@@ -89,30 +165,264 @@ def add_rows(file_path, session):
     logger.debug("Session commit complete")
 
 
-def upload_to_rds(file_path, engine_string):
+def _source_types():
+    """python types of the chocolates columns that are read from the clean data"""
+    return {col.name: col.type.python_type for col in Chocolates.__table__.columns
+            if not col.primary_key and col.name not in KEY_COLUMNS}
+
+
+def _hash_columns(chunk, columns):
+    """sha1 of the given columns of every row"""
+    joined = chunk[columns[0]].astype(str)
+    for name in columns[1:]:
+        joined = joined + '\x1f' + chunk[name].astype(str)
+    return [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in joined]
+
+
+def _next_row_version(engine):
+    """the row version of a new load, one more than the last load of the table"""
+    table = Chocolates.__table__
+    with engine.connect() as conn:
+        latest = conn.execute(sqlalchemy.select([func.max(table.c.row_version)])).scalar()
+    return (latest or 0) + 1
+
+
+def _read_chunks(file_path, batch_size, key_columns=None):
+    """Stream the clean data typed like the chocolates table, with row key and content hash. The
+    header is checked before the first chunk is asked for."""
+    col_types = _source_types()
+    key_columns = list(key_columns or col_types)
+    header = pd.read_csv(file_path, nrows=0).columns
+    missing = [name for name in col_types if name not in header]
+    if missing:
+        raise ValueError("%s has no column %s of the chocolates table" % (file_path, missing))
+    types = dict(col_types, **{BAR_INDEX: int}) if BAR_INDEX in header else col_types
+
+    def chunks():
+        for chunk in pd.read_csv(file_path, usecols=list(types), chunksize=batch_size):
+            chunk = chunk.astype(types)
+            chunk['row_key'] = _hash_columns(chunk, key_columns)
+            chunk['row_hash'] = _hash_columns(chunk, list(col_types))
+            yield chunk
+
+    return chunks()
+
+
+def _executemany(conn, statement, chunk, names):
+    """Run a statement once per row of the chunk with SQLAlchemy's executemany"""
+    # plain python values column by column, the DB drivers do not accept numpy scalars
+    params = [dict(zip(names, row)) for row in zip(*[chunk[name].tolist() for name in names])]
+    conn.execute(statement, params)
+    return len(params)
+
+
+def _log_rate(action, total, start):
+    elapsed = time.perf_counter() - start
+    logger.info("%i rows %s in %.2f seconds (%.0f rows per second)", total, action, elapsed,
+                total / elapsed if elapsed > 0 else float('inf'))
+
+
+def _taken_bar_ids(file_path, batch_size, engine):
+    """bar ids of the csv that are already in the table, none if the csv has no ids"""
+    if BAR_INDEX not in pd.read_csv(file_path, nrows=0).columns:
+        return []
+    table = Chocolates.__table__
+    with engine.connect() as conn:
+        existing = {bar for bar, in conn.execute(sqlalchemy.select([table.c.index]))}
+    if not existing:
+        return []
+    return [bar for chunk in pd.read_csv(file_path, usecols=[BAR_INDEX], chunksize=batch_size)
+            for bar in chunk[BAR_INDEX].tolist() if bar in existing]
+
+
+def bulk_add_rows(file_path, engine, batch_size=10000, key_columns=None):
+    """Stream chocolate bar records from a csv into the database in batches
+
+    Every chunk of ``batch_size`` rows is written with one executemany insert and committed on
+    its own, so memory stays bounded by the batch size instead of the file size. Bars keep the
+    id of the ``index`` column of the csv if it has one, and nothing is inserted if the table
+    already holds any of those ids, e.g. when the file was loaded before.
+
+    Args:
+        file_path (str): local recommendation table to be written into database
+        engine (:obj:`sqlalchemy.engine.Engine`): engine for the database
+        batch_size (int): number of rows inserted and committed together
+        key_columns (:obj:`list`): columns hashed into the row key, all columns if None
+
+    Returns:
+        total (int): number of rows added
+    """
+    # whole batches are handed to the driver's executemany
+    statement = Chocolates.__table__.insert()
+
+    chunks = _read_chunks(file_path, batch_size, key_columns)
+    taken = _taken_bar_ids(file_path, batch_size, engine)
+    if taken:
+        raise ValueError("%i chocolate bars of %s are already in the table (ids %s), load the file "
+                         "with --mode upsert to update them" % (len(taken), file_path,
+                                                                 ', '.join(map(str, taken[:5]))))
+    row_version = _next_row_version(engine)
+
+    total = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        chunk['row_version'] = row_version
+        with engine.begin() as conn:
+            total += _executemany(conn, statement, chunk, list(chunk.columns))
+        logger.debug("%i rows committed", total)
+
+    _log_rate("added", total, start)
+    return total
+
+
+def _moved_bar_ids(file_path, batch_size, key_columns, existing, keyed):
+    """First pass over a csv with bar ids: the table rows that hold the id of another bar
+
+    Returns:
+        moved (set): ids of bars that are in the csv under another id
+        taken (set): ids of table rows that are in the way of a csv bar and are not moved
+    """
+    plan = pd.concat([chunk[[BAR_INDEX, 'row_key']]
+                      for chunk in _read_chunks(file_path, batch_size, key_columns)]
+                     or [pd.DataFrame(columns=[BAR_INDEX, 'row_key'])])
+    plan = plan.drop_duplicates('row_key')
+    if plan[BAR_INDEX].duplicated().any():
+        raise ValueError("Bar ids in %s are not unique" % file_path)
+
+    plan = plan.merge(keyed[['row_key', 'b_index']], on='row_key', how='left')
+    placed = plan[BAR_INDEX] == plan['b_index']
+    moved = set(plan.loc[plan['b_index'].notna() & ~placed, 'b_index'].astype(int))
+    taken = set(existing.loc[existing['index'].isin(plan.loc[~placed, BAR_INDEX]), 'index'])
+    return moved, taken - moved
+
+
+def upsert_rows(file_path, engine, batch_size=10000, key_columns=None, delete_missing=False):
+    """Load only the difference between the clean data and the chocolates table
+
+    Rows are matched on a sha1 of ``key_columns``. Rows with a new key are inserted, rows whose
+    content hash changed are updated in place, and with ``delete_missing`` rows that are no
+    longer in the csv (including duplicates and rows loaded without a key) are deleted. Every
+    written row gets the ``row_version`` of this load, so that a changed table is noticed even
+    if the number of rows stays the same.
+
+    If the csv has an ``index`` column the bars end up under those ids: a bar whose id changed
+    is written again under the new one, and a row that holds the id of another bar of the csv is
+    deleted even without ``delete_missing``.
+
+    Args:
+        file_path (str): local recommendation table to be written into database
+        engine (:obj:`sqlalchemy.engine.Engine`): engine for the database
+        batch_size (int): number of rows written and committed together
+        key_columns (:obj:`list`): columns hashed into the row key, all columns if None
+        delete_missing (bool): whether to delete rows that are missing from the csv
+
+    Returns:
+        counts (:obj:`dict`): number of rows inserted, updated, unchanged and deleted
+    """
+    table = Chocolates.__table__
+    existing = pd.read_sql(sqlalchemy.select([table.c.index, table.c.row_key, table.c.row_hash]),
+                           engine).sort_values('index')
+    keyed = existing.dropna(subset=['row_key']).drop_duplicates('row_key', keep='first')
+    keyed = keyed.rename(columns={'index': 'b_index', 'row_hash': 'old_hash'})
+
+    columns = list(_source_types()) + KEY_COLUMNS
+    insert = table.insert()
+    update = table.update().where(table.c.index == sqlalchemy.bindparam('b_index'))
+
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+    start = time.perf_counter()
+    has_ids = BAR_INDEX in pd.read_csv(file_path, nrows=0).columns
+    moved, taken = set(), set()
+    if has_ids:
+        moved, taken = _moved_bar_ids(file_path, batch_size, key_columns, existing, keyed)
+        if taken and not delete_missing:
+            logger.warning("%i rows are deleted as their id belongs to another bar", len(taken))
+        freed = sorted(moved | taken)
+        for lo in range(0, len(freed), batch_size):
+            with engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.index.in_(freed[lo:lo + batch_size])))
+        counts['deleted'] += len(taken)
+
+    seen = set()
+    row_version = _next_row_version(engine)
+    for chunk in _read_chunks(file_path, batch_size, key_columns):
+        chunk['row_version'] = row_version
+        duplicated = chunk['row_key'].duplicated() | chunk['row_key'].isin(seen)
+        if duplicated.any():
+            logger.warning("%i rows with a duplicated key are skipped", duplicated.sum())
+            chunk = chunk[~duplicated]
+        seen.update(chunk['row_key'])
+
+        merged = chunk.merge(keyed, on='row_key', how='left')
+        if has_ids:
+            # new bars and bars whose id changed, the rows of the latter were deleted above
+            new_rows = merged[merged['b_index'] != merged[BAR_INDEX]]
+            n_moved = int(new_rows['b_index'].notna().sum())
+            new_columns = [BAR_INDEX] + columns
+        else:
+            new_rows = merged[merged['b_index'].isna()]
+            n_moved = 0
+            new_columns = columns
+        changed = merged[merged['b_index'].notna() & (merged['old_hash'] != merged['row_hash'])
+                         & ~merged.index.isin(new_rows.index)]
+        with engine.begin() as conn:
+            if len(new_rows):
+                _executemany(conn, insert, new_rows, new_columns)
+            if len(changed):
+                changed = changed.astype({'b_index': int})
+                _executemany(conn, update, changed, columns + ['b_index'])
+        counts['inserted'] += len(new_rows) - n_moved
+        counts['updated'] += len(changed) + n_moved
+        counts['unchanged'] += len(merged) - len(new_rows) - len(changed)
+
+    if delete_missing:
+        stale = existing.loc[~existing['index'].isin(keyed['b_index']), 'index']
+        missing = keyed.loc[~keyed['row_key'].isin(seen), 'b_index']
+        stale = [bar for bar in pd.concat([stale, missing]).astype(int).tolist()
+                 if bar not in moved and bar not in taken]
+        for lo in range(0, len(stale), batch_size):
+            with engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.index.in_(stale[lo:lo + batch_size])))
+        counts['deleted'] += len(stale)
+
+    _log_rate("compared", sum(counts.values()) - counts['deleted'], start)
+    logger.info("%(inserted)i rows inserted, %(updated)i updated, %(unchanged)i unchanged and "
+                "%(deleted)i deleted", counts)
+    return counts
+
+
+def upload_to_rds(file_path, engine_string, batch_size=10000, mode='append', key_columns=None,
+                  delete_missing=False, engine_options=None):
     """ Create database in RDS for the chocolate bar table 
 
     Args:
         file_path (str): input file path
         engine_string (str): engine string for the RDS database
-        
+        batch_size (int): number of rows inserted and committed together
+        mode (str): 'append' to add every row of the file, 'upsert' to only load the difference
+        key_columns (:obj:`list`): columns hashed into the row key, all columns if None
+        delete_missing (bool): whether upsert deletes rows that are missing from the file
+        engine_options (:obj:`dict`): keyword arguments of :func:`sqlalchemy.create_engine`
+
     Returns:
         None
     """
 
     # generate engine string
-    engine_string = sqlalchemy.create_engine(engine_string)
-    logger.info(engine_string)
-
-    Session = sessionmaker(bind=engine_string)
-    session = Session()
+    engine = get_engine(engine_string, **(engine_options or {}))
+    logger.info(engine)
 
     # write records into table
     try:
-        # write records into table
-        add_rows(file_path, session)
-        logger.info("Database created successfully with all records added")
+        if mode == 'upsert':
+            upsert_rows(file_path, engine, batch_size, key_columns, delete_missing)
+            logger.info("Database updated successfully with the changed records")
+        else:
+            bulk_add_rows(file_path, engine, batch_size, key_columns)
+            logger.info("Database created successfully with all records added")
     except Exception as errors:
         logger.error(errors)
+        raise
     finally:
-        session.close()
+        # close the pooled connections, the engine can still be used again
+        engine.dispose()
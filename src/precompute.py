@@ -0,0 +1,198 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.clean_data import transform_features
+
+logger = logging.getLogger(__name__)
+
+PRECOMPUTED_VERSION = 1
+
+
+def grid_axis(start, stop, step):
+    """Evenly spaced values from ``start`` to ``stop``, both included"""
+    if step <= 0 or stop < start:
+        raise ValueError("Grid from %s to %s needs a positive step, got %s" % (start, stop, step))
+    return np.round(start + step * np.arange(int(round((stop - start) / step)) + 1), 6)
+
+
+def catalog_fingerprint(snapshot):
+    """Fingerprint of the chocolate bars, their cluster labels and the model of a snapshot
+
+    Recommendations precomputed for one catalog are only served from a snapshot with the same
+    fingerprint.
+
+    Args:
+        snapshot (:obj:`CatalogSnapshot <src.catalog.CatalogSnapshot>`): the catalog snapshot
+
+    Returns:
+        fingerprint (str): the sha256 hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(snapshot.ids, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(snapshot.labels, dtype=np.int32).tobytes())
+    # single precision, so that the same data read from csv or from the database match
+    digest.update(np.ascontiguousarray(snapshot.features, dtype=np.float32).tobytes())
+    digest.update(str(snapshot.model_version).encode())
+    return digest.hexdigest()
+
+
+class PrecomputedRecs:
+    """
+    Recommendations of every point of a grid of user inputs: every cocoa percent and rating of
+    the grid combined with every combination of the binary flags. The point of a user input is
+    found arithmetically, so a lookup takes the same time for any grid size.
+    """
+
+    def __init__(self, positions, cocoa, rating, n_flags, fingerprint, created_at=None):
+        self.positions = positions
+        self.cocoa = cocoa
+        self.rating = rating
+        self.n_flags = n_flags
+        self.fingerprint = fingerprint
+        self.created_at = created_at
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return "<Precomputed recommendations of %i user inputs>" % len(self)
+
+    def point(self, user_input, snap=True):
+        """Row of the grid point of a user input
+
+        Args:
+            user_input (:obj:`tuple`): cocoa percent, rating and the binary flags as 0 or 1
+            snap (bool): whether an input between grid points takes the nearest one, otherwise
+                only inputs on the grid are found
+
+        Returns:
+            row (int): the row of the grid point, None if the input is not covered by the grid
+        """
+        cocoa, rating, flags = user_input[0], user_input[1], user_input[2:]
+        if len(flags) != self.n_flags or any(flag not in (0, 1) for flag in flags):
+            return None
+        i = _axis_position(self.cocoa, cocoa, snap)
+        j = _axis_position(self.rating, rating, snap)
+        if i is None or j is None:
+            return None
+        code = 0
+        for flag in flags:
+            code = (code << 1) | int(flag)
+        return (i * len(self.rating) + j) * (1 << self.n_flags) + code
+
+    def lookup(self, user_input, snap=True):
+        """Catalog positions of the recommendations of a user input, nearest first
+
+        Returns:
+            positions (:obj:`numpy.ndarray`): the catalog positions, None if the input is not
+                covered by the grid
+        """
+        row = self.point(user_input, snap)
+        if row is None:
+            return None
+        positions = self.positions[row]
+        return positions[positions >= 0]
+
+
+def _axis_position(axis, value, snap):
+    """Position of the grid value nearest to ``value``, None outside of the grid"""
+    step = axis[1] - axis[0] if len(axis) > 1 else 0.0
+    offset = (value - axis[0]) / step if step else 0.0
+    i = int(round(offset))
+    # more than half a step outside of the grid is not covered, even when snapping
+    if i < 0 or i >= len(axis) or (not snap and abs(axis[i] - value) > 1e-6):
+        return None
+    return i
+
+
+def grid_inputs(features, cocoa, rating):
+    """Every user input of the grid, in the row order of :class:`PrecomputedRecs`
+
+    Args:
+        features (:obj:`list`): the features of the user input, cocoa percent and rating first,
+            then the binary flags
+        cocoa (:obj:`numpy.ndarray`): the cocoa percents of the grid
+        rating (:obj:`numpy.ndarray`): the ratings of the grid
+
+    Returns:
+        user_inputs (:obj:`DataFrame <pandas.DataFrame>`): one row per grid point
+    """
+    n_flags = len(features) - 2
+    flags = np.array(list(itertools.product([0, 1], repeat=n_flags)), dtype=np.float64)
+    numeric = np.array(list(itertools.product(cocoa, rating)), dtype=np.float64)
+    values = np.hstack([np.repeat(numeric, len(flags), axis=0), np.tile(flags, (len(numeric), 1))])
+    return pd.DataFrame(values, columns=features)
+
+
+def precompute_recs(snapshot, features, cocoa_percent, rating, top, save_path, block_size=1024):
+    """Score every point of the grid of user inputs against a catalog snapshot and save the
+    recommendations
+
+    Args:
+        snapshot (:obj:`CatalogSnapshot <src.catalog.CatalogSnapshot>`): the catalog snapshot,
+            with the model it was labelled with
+        features (:obj:`list`): the features of the user input, cocoa percent and rating first,
+            then the binary flags
+        cocoa_percent (:obj:`dict`): start, stop and step of the cocoa percents of the grid
+        rating (:obj:`dict`): start, stop and step of the ratings of the grid
+        top (int): the top n products to be recommended
+        save_path (str): the path of the recommendations
+        block_size (int): the number of user inputs scored together in one matrix product
+
+    Returns:
+        recs (:obj:`PrecomputedRecs`): the recommendations of every grid point
+    """
+    start = time.perf_counter()
+    cocoa, rating = grid_axis(**cocoa_percent), grid_axis(**rating)
+    user_inputs = grid_inputs(features, cocoa, rating)
+    scaled = transform_features(user_inputs, snapshot.preprocessor)
+    clusters = snapshot.model.predict(scaled)
+    positions, _ = snapshot.index.query_batch(scaled, clusters, top, block_size)
+    # the catalog positions fit in 32 bits for any realistic catalog, half the file size
+    dtype = np.int32 if len(snapshot) < np.iinfo(np.int32).max else np.int64
+    recs = PrecomputedRecs(positions.astype(dtype), cocoa, rating, len(features) - 2,
+                           catalog_fingerprint(snapshot), time.time())
+    logger.info("Recommendations of %i user inputs computed in %.2f seconds", len(recs),
+                time.perf_counter() - start)
+    save_precomputed(recs, save_path)
+    return recs
+
+
+def save_precomputed(recs, save_path):
+    """Save precomputed recommendations as one uncompressed npz file, replaced atomically"""
+    meta = {'version': PRECOMPUTED_VERSION, 'n_flags': recs.n_flags,
+            'fingerprint': recs.fingerprint, 'created_at': recs.created_at}
+    tmp_path = save_path + '.tmp.npz'
+    np.savez(tmp_path, positions=recs.positions, cocoa=recs.cocoa, rating=recs.rating,
+             meta=np.array(json.dumps(meta)))
+    os.replace(tmp_path, save_path)
+    logger.info("Precomputed recommendations are saved to path %s", save_path)
+
+
+def load_precomputed(save_path):
+    """Load the recommendations saved by :func:`precompute_recs`
+
+    Args:
+        save_path (str): the path of the recommendations
+
+    Returns:
+        recs (:obj:`PrecomputedRecs`): the recommendations of every grid point
+    """
+    with np.load(save_path) as saved:
+        meta = json.loads(str(saved['meta']))
+        if meta['version'] != PRECOMPUTED_VERSION:
+            raise ValueError("Precomputed recommendations at %s are version %s, expected %i, "
+                             "please rerun precompute_recs" % (save_path, meta['version'],
+                                                               PRECOMPUTED_VERSION))
+        recs = PrecomputedRecs(saved['positions'], saved['cocoa'], saved['rating'],
+                               meta['n_flags'], meta['fingerprint'], meta['created_at'])
+    logger.info("Precomputed recommendations of %i user inputs are loaded from %s", len(recs),
+                save_path)
+    return recs
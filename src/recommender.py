@@ -0,0 +1,317 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from joblib import dump, load
+
+from src.clean_data import load_preprocessor, transform_features
+
+logger = logging.getLogger(__name__)
+
+
+class ClusterIndex:
+    """
+    Nearest-neighbour index over the scaled catalog, grouped by k-means cluster. The rows of every
+    cluster are stored as one contiguous block, so a query is a single distance pass over the
+    members of one cluster followed by an ``argpartition`` top-k.
+    """
+
+    def __init__(self, positions, features, sq_norms, offsets):
+        self.positions = positions
+        self.features = features
+        self.sq_norms = sq_norms
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return "<Cluster index of %i chocolate bars in %i clusters>" % (len(self), self.n_clusters)
+
+    @property
+    def n_clusters(self):
+        return len(self.offsets) - 1
+
+    def members(self, cluster):
+        """Return the catalog positions of the chocolate bars in a cluster"""
+        return self.positions[self.offsets[cluster]:self.offsets[cluster + 1]]
+
+    def query(self, scaled_row, cluster, top):
+        """Find the chocolate bars closest to one scaled row within its cluster
+
+        Args:
+            scaled_row (:obj:`numpy.ndarray`): the scaled features of the user input
+            cluster (int): the cluster label of the user input
+            top (int): the top n products to be recommended
+
+        Returns:
+            positions (:obj:`numpy.ndarray`): catalog positions of the recommendations, nearest first
+            distances (:obj:`numpy.ndarray`): euclidean distances of the recommendations
+        """
+        start, stop = self.offsets[cluster], self.offsets[cluster + 1]
+        scaled_row = np.asarray(scaled_row, dtype=np.float64).ravel()
+
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2, with |x|^2 precomputed at build time
+        sq_dists = self.sq_norms[start:stop] - 2.0 * (self.features[start:stop] @ scaled_row)
+        sq_dists += scaled_row @ scaled_row
+        np.maximum(sq_dists, 0.0, out=sq_dists)
+
+        nearest = _top_k(sq_dists, self.positions[start:stop], top)
+        return self.positions[start:stop][nearest], np.sqrt(sq_dists[nearest])
+
+    def query_batch(self, scaled_rows, clusters, top, block_size=1024):
+        """Find the closest chocolate bars for many scaled rows at once
+
+        Args:
+            scaled_rows (:obj:`numpy.ndarray`): the scaled features of the user inputs, one per row
+            clusters (:obj:`numpy.ndarray`): the cluster label of every user input
+            top (int): the top n products to be recommended
+            block_size (int): the number of user inputs scored together in one matrix product
+
+        Returns:
+            positions (:obj:`numpy.ndarray`): catalog positions of the recommendations, nearest first,
+                padded with -1 when a cluster has fewer than ``top`` bars
+            distances (:obj:`numpy.ndarray`): euclidean distances of the recommendations, padded
+                with nan
+        """
+        scaled_rows = np.asarray(scaled_rows, dtype=np.float64)
+        clusters = np.asarray(clusters)
+        positions = np.full((len(scaled_rows), top), -1, dtype=np.int64)
+        distances = np.full((len(scaled_rows), top), np.nan)
+
+        for cluster in np.unique(clusters):
+            start, stop = self.offsets[cluster], self.offsets[cluster + 1]
+            k = min(top, stop - start)
+            if k <= 0:
+                continue
+            members = self.positions[start:stop]
+            block = self.features[start:stop]
+            rows = np.flatnonzero(clusters == cluster)
+
+            for lo in range(0, len(rows), block_size):
+                chunk = rows[lo:lo + block_size]
+                queries = scaled_rows[chunk]
+                sq_dists = self.sq_norms[start:stop] - 2.0 * (queries @ block.T)
+                sq_dists += np.einsum('ij,ij->i', queries, queries)[:, None]
+                np.maximum(sq_dists, 0.0, out=sq_dists)
+
+                if k < stop - start:
+                    candidates = np.argpartition(sq_dists, k - 1, axis=1)[:, :k]
+                else:
+                    candidates = np.broadcast_to(np.arange(k), (len(chunk), k))
+                cand_dists = np.take_along_axis(sq_dists, candidates, axis=1)
+                cand_positions = members[candidates]
+                # equally close bars are ordered by position, whatever rounding the matrix
+                # product of this block of user inputs had
+                order = np.lexsort((cand_positions, np.round(cand_dists, 9)))
+
+                positions[chunk, :k] = np.take_along_axis(cand_positions, order, axis=1)
+                distances[chunk, :k] = np.sqrt(np.take_along_axis(cand_dists, order, axis=1))
+
+        return positions, distances
+
+
+def _top_k(sq_dists, positions, top):
+    """Indexes of the ``top`` smallest distances, sorted by distance then catalog position"""
+    top = min(top, len(sq_dists))
+    if top <= 0:
+        return np.empty(0, dtype=np.intp)
+    if top < len(sq_dists):
+        candidates = np.argpartition(sq_dists, top - 1)[:top]
+    else:
+        candidates = np.arange(len(sq_dists))
+    return candidates[np.lexsort((positions[candidates], np.round(sq_dists[candidates], 9)))]
+
+
+def build_cluster_index(features, labels, n_clusters=0):
+    """Build the per-cluster nearest-neighbour index
+
+    Args:
+        features (:obj:`numpy.ndarray`): the scaled features of the catalog, one row per bar
+        labels (:obj:`numpy.ndarray`): the cluster label of every bar
+        n_clusters (int): the number of clusters of the model, so that empty clusters are kept
+
+    Returns:
+        index (:obj:`ClusterIndex`): the cluster index
+    """
+    features = np.asarray(features, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.int64)
+    if features.ndim != 2 or len(features) != len(labels):
+        raise ValueError("Features must be a 2d array with one cluster label per row")
+
+    positions = np.argsort(labels, kind='stable')
+    grouped = np.ascontiguousarray(features[positions])
+    counts = np.bincount(labels, minlength=n_clusters)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    return ClusterIndex(positions, grouped, np.einsum('ij,ij->i', grouped, grouped), offsets)
+
+
+def save_cluster_index(index, save_path):
+    """Save the cluster index built at training time
+
+    Args:
+        index (:obj:`ClusterIndex`): the cluster index
+        save_path (str): the path to save the cluster index
+
+    Returns:
+        None
+    """
+    dump(index, save_path)
+    logger.info("Cluster index is saved to path %s", save_path)
+
+
+def load_cluster_index(save_path):
+    """Load the cluster index saved by :func:`save_cluster_index`
+
+    Args:
+        save_path (str): the path of the cluster index
+
+    Returns:
+        index (:obj:`ClusterIndex`): the cluster index
+    """
+    index = load(save_path)
+    logger.info("Cluster index is loaded from %s", save_path)
+    return index
+
+
+def read_profiles(file_path):
+    """Read user profiles for batch recommendation from a csv or a jsonl file
+
+    Args:
+        file_path (str): path of the profiles, read as json lines if it ends with .jsonl
+
+    Returns:
+        profiles (:obj:`DataFrame <pandas.DataFrame>`): one user profile per row
+    """
+    if file_path.endswith('.jsonl'):
+        profiles = pd.read_json(file_path, lines=True)
+    else:
+        profiles = pd.read_csv(file_path)
+    logger.info("%i user profiles are loaded from %s", len(profiles), file_path)
+    return profiles
+
+
+def recommend_batch(profiles, model, preprocessor, index, top, replace_dict, block_size=1024):
+    """Recommend chocolate bars for many user profiles with one vectorized call
+
+    Args:
+        profiles (:obj:`DataFrame <pandas.DataFrame>`): the user profiles, one per row
+        model (:obj:`sklearn.cluster._kmeans.KMeans`): the k-means clustering model
+        preprocessor (:obj:`dict`): the preprocessing artifact saved at training time
+        index (:obj:`ClusterIndex`): the cluster index of the catalog
+        top (int): the top n products to be recommended
+        replace_dict (:obj:`dictionary`): the dictionary that map 'yes' and 'no' into 1 and 0
+        block_size (int): the number of user inputs scored together in one matrix product
+
+    Returns:
+        clusters (:obj:`numpy.ndarray`): the cluster label of every user profile
+        positions (:obj:`numpy.ndarray`): catalog positions of the recommendations per profile
+        distances (:obj:`numpy.ndarray`): euclidean distances of the recommendations per profile
+    """
+    inputs = profiles[preprocessor['features']].replace(replace_dict)
+
+    scaled = transform_features(inputs, preprocessor)
+    clusters = model.predict(scaled)
+    positions, distances = index.query_batch(scaled, clusters, top, block_size)
+
+    return clusters, positions, distances
+
+
+def format_batch_recs(profile_ids, positions, distances, catalog, bar_ids, profile_name='profile_id',
+                      rank_name='rank', rec_product_name='chocolate_bar', distance_name='distance'):
+    """Format batch recommendations into a long table with one row per profile and rank
+
+    Args:
+        profile_ids (:obj:`numpy.ndarray`): the id of every user profile
+        positions (:obj:`numpy.ndarray`): catalog positions of the recommendations per profile
+        distances (:obj:`numpy.ndarray`): euclidean distances of the recommendations per profile
+        catalog (:obj:`DataFrame <pandas.DataFrame>`): the display columns of the catalog, in the
+            same row order as the cluster index
+        bar_ids (:obj:`numpy.ndarray`): the chocolate bar id of every catalog row
+        profile_name (str): the column name for the user profile id
+        rank_name (str): the rank of products to be recommended
+        rec_product_name (str): the name of product to be recommended
+        distance_name (str): the column name for the distance to the user profile
+
+    Returns:
+        rec_result (:obj:`DataFrame <pandas.DataFrame>`): the recommendation table
+    """
+    if len(bar_ids) != len(catalog):
+        raise ValueError("Catalog has %i rows but %i bar ids" % (len(catalog), len(bar_ids)))
+    found = positions >= 0
+    rows, ranks = np.nonzero(found)
+    bars = positions[found]
+
+    rec_result = catalog.iloc[bars].reset_index(drop=True)
+    rec_result.insert(0, profile_name, np.asarray(profile_ids)[rows])
+    rec_result.insert(1, rank_name, ranks + 1)
+    rec_result.insert(2, rec_product_name, np.asarray(bar_ids)[bars])
+    rec_result.insert(3, distance_name, distances[found])
+
+    return rec_result
+
+
+def score_profiles(input_path, output_path, model_save_path, preprocessor_save_path, index_save_path,
+                   catalog_path, display_vars, replace_dict, top, block_size=1024,
+                   profile_name='profile_id', artifact_dir=None, bar_index='index'):
+    """Score a file of user profiles against the trained model and write the recommendations
+
+    Every recommendation carries the id of the chocolate bar in the catalog, the same id as in
+    the chocolates table.
+
+    Args:
+        input_path (str): path of the user profiles, csv or jsonl
+        output_path (str): path to write the recommendation table to
+        model_save_path (str): path for the model joblib file
+        preprocessor_save_path (str): path for the preprocessing artifact
+        index_save_path (str): path for the cluster index
+        catalog_path (str): path of the cleaned data the cluster index was built on
+        display_vars (:obj:`list`): the list of catalog columns written with every recommendation
+        replace_dict (:obj:`dictionary`): the dictionary that map 'yes' and 'no' into 1 and 0
+        top (int): the top n products to be recommended
+        block_size (int): the number of user inputs scored together in one matrix product
+        profile_name (str): the column name for the user profile id, row numbers are used if the
+            profiles do not have it
+        artifact_dir (str): directory of the memory-mapped catalog written by run_modeling, used
+            instead of the preprocessor, the cluster index and the catalog csv if given
+        bar_index (str): the column name for chocolate bar index in the catalog csv
+
+    Returns:
+        rec_result (:obj:`DataFrame <pandas.DataFrame>`): the recommendation table
+    """
+    model = load(model_save_path)
+    if artifact_dir is not None:
+        # imported here, src.artifacts builds on this module
+        from src.artifacts import load_catalog
+        from src.registry import file_hash
+        snapshot = load_catalog(artifact_dir, model, file_hash(model_save_path))
+        preprocessor, index = snapshot.preprocessor, snapshot.index
+        catalog = pd.DataFrame(snapshot.display_rows(np.arange(len(snapshot))),
+                               columns=snapshot.display_vars)[display_vars]
+        bar_ids = snapshot.ids
+    else:
+        preprocessor = load_preprocessor(preprocessor_save_path)
+        index = load_cluster_index(index_save_path)
+        if bar_index not in pd.read_csv(catalog_path, nrows=0).columns:
+            raise ValueError("Catalog %s has no %s column of bar ids, please rerun the clean "
+                             "stage of run_modeling" % (catalog_path, bar_index))
+        catalog = pd.read_csv(catalog_path, usecols=[bar_index] + display_vars)
+        bar_ids = catalog[bar_index].to_numpy()
+        catalog = catalog[display_vars]
+    if len(catalog) != len(index):
+        raise ValueError("Catalog %s has %i rows but the cluster index was built on %i, please "
+                         "rerun run_modeling" % (catalog_path, len(catalog), len(index)))
+
+    profiles = read_profiles(input_path)
+    profile_ids = profiles[profile_name] if profile_name in profiles else profiles.index
+    _, positions, distances = recommend_batch(profiles, model, preprocessor, index, top,
+                                              replace_dict, block_size)
+
+    rec_result = format_batch_recs(profile_ids, positions, distances, catalog, bar_ids,
+                                   profile_name)
+    rec_result.to_csv(output_path, index=False)
+    logger.info("Recommendations for %i user profiles are saved to path %s", len(profiles),
+                output_path)
+
+    return rec_result
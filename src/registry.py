@@ -0,0 +1,110 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from joblib import load
+
+logger = logging.getLogger(__name__)
+
+
+class ModelVersion:
+    """One loaded version of a model artifact"""
+
+    def __init__(self, model, version, path):
+        self.model = model
+        self.version = version
+        self.path = path
+        self.loaded_at = time.time()
+
+    def __repr__(self):
+        return "<Model %s version %s>" % (self.path, self.version)
+
+
+def file_hash(path, block_size=1 << 20):
+    """sha256 of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """
+    Keeps a model artifact in memory and swaps it atomically when the file on disk changes. The
+    file is only looked at every ``check_interval`` seconds: its mtime and size are compared
+    first, and it is reloaded only if its content hash differs from the version in memory. The
+    version it replaces is kept for :meth:`rollback`.
+    """
+
+    def __init__(self, path, loader=load, check_interval=10):
+        self.path = path
+        self.check_interval = check_interval
+        self.current = None
+        self.previous = None
+        self._loader = loader
+        self._stat = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return None if self.current is None else self.current.version
+
+    def load(self):
+        """Check the file now and return the current version, raise if nothing can be loaded"""
+        with self._lock:
+            self._refresh()
+        if self.current is None:
+            raise FileNotFoundError("Model at the specified path %s is not found" % self.path)
+        return self.current
+
+    def get(self):
+        """Return the current version, reloading it first if the file has changed"""
+        now = time.monotonic()
+        if (self._checked_at is None or now - self._checked_at >= self.check_interval) \
+                and self._lock.acquire(blocking=False):
+            try:
+                self._refresh()
+            finally:
+                self._lock.release()
+        return self.current
+
+    def rollback(self):
+        """Swap back to the previously loaded version, it stays until the file changes again"""
+        with self._lock:
+            if self.previous is None:
+                raise ValueError("No previous version of %s to roll back to" % self.path)
+            self.current, self.previous = self.previous, self.current
+            logger.warning("Model %s rolled back to version %s", self.path, self.current.version)
+        return self.current
+
+    def _refresh(self):
+        self._checked_at = time.monotonic()
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            logger.error("Model at the specified path %s is not found", self.path)
+            return
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if stat == self._stat:
+            return
+
+        version = file_hash(self.path)
+        if version == self.version:
+            self._stat = stat
+            return
+
+        try:
+            model = self._loader(self.path)
+        except Exception as errors:
+            # e.g. the file is still being written, try again at the next check
+            logger.error("Model %s could not be loaded, keep serving version %s: %s", self.path,
+                         self.version, errors)
+            return
+
+        self._stat = stat
+        self.previous, self.current = self.current, ModelVersion(model, version, self.path)
+        logger.info("Model is loaded from %s, version %s", self.path, version[:12])
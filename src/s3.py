@@ -1,12 +1,20 @@
+import gzip
+import hashlib
+import io
 import logging
+import math
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import botocore
+from boto3.s3.transfer import TransferConfig
 
 
-logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    level=logging.DEBUG)
+# the entry points configure the handlers, only the chatty AWS libraries are quietened here
 logging.getLogger("botocore").setLevel(logging.ERROR)
 logging.getLogger("s3transfer").setLevel(logging.ERROR)
 logging.getLogger("urllib3").setLevel(logging.ERROR)
@@ -16,6 +24,8 @@ logging.getLogger("aiobotocore").setLevel(logging.ERROR)
 logging.getLogger("s3fs").setLevel(logging.ERROR)
 logger = logging.getLogger('s3')
 
+MB = 1024 * 1024
+
 
 def parse_s3(s3path):
     """
@@ -38,55 +48,318 @@ def parse_s3(s3path):
     return s3bucket, s3path
 
 
-def upload_file_to_s3(local_path, s3path):
+def transfer_config(multipart_threshold=8, multipart_chunksize=8, max_concurrency=10):
+    """
+    Transfer settings for uploads and downloads
+
+    Args:
+        multipart_threshold (int): files of at least this many MB are transferred in parts
+        multipart_chunksize (int): the size of every part in MB
+        max_concurrency (int): number of threads transferring the parts of one file
+
+    Returns:
+        config (:obj:`boto3.s3.transfer.TransferConfig`): the transfer settings
+    """
+    return TransferConfig(multipart_threshold=multipart_threshold * MB,
+                          multipart_chunksize=multipart_chunksize * MB,
+                          max_concurrency=max_concurrency)
+
+
+def local_etag(local_path, multipart_threshold=8 * MB, multipart_chunksize=8 * MB, parts=None):
+    """
+    Compute the ETag S3 gives a file uploaded without encryption: the md5 of the file, or for a
+    multipart upload the md5 of the md5 digests of its parts followed by the number of parts
+
+    Args:
+        local_path (str): the path of the local file
+        multipart_threshold (int): files of at least this many bytes were uploaded in parts
+        multipart_chunksize (int): the size of every part in bytes
+        parts (int): the number of parts of the remote object, 1 for a single part upload,
+            decided by the size and ``multipart_threshold`` if None
+
+    Returns:
+        etag (str): the ETag, without quotes
+    """
+    size = os.path.getsize(local_path)
+    if parts is None and size < multipart_threshold:
+        parts = 1
+    if parts == 1:
+        digest = hashlib.md5()
+        with open(local_path, 'rb') as f:
+            for block in iter(lambda: f.read(MB), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    digests = []
+    with open(local_path, 'rb') as f:
+        for block in iter(lambda: f.read(multipart_chunksize), b''):
+            digests.append(hashlib.md5(block).digest())
+    return '%s-%i' % (hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+def is_unchanged(local_path, head, config=None):
+    """
+    Whether a local file has the same size and ETag as an S3 object
+
+    The ETag of a multipart object is computed with the part size of ``config`` first. If the
+    object was uploaded with other settings, the whole MB part size that fits it in the same
+    number of parts is tried as well.
+
+    Args:
+        local_path (str): the path of the local file
+        head (:obj:`dict`): the head_object response of the S3 object, None if it does not exist
+        config (:obj:`boto3.s3.transfer.TransferConfig`): the transfer settings of the upload
+
+    Returns:
+        bool: True if the local file and the object have the same content
+    """
+    if head is None or not os.path.exists(local_path):
+        return False
+    size = os.path.getsize(local_path)
+    if size != head['ContentLength']:
+        return False
+    config = config or transfer_config()
+    etag = head['ETag'].strip('"')
+    parts = int(etag.split('-')[1]) if '-' in etag else 1
+    if parts == 1:
+        return local_etag(local_path, parts=1) == etag
+
+    if math.ceil(size / config.multipart_chunksize) == parts and \
+            local_etag(local_path, config.multipart_threshold, config.multipart_chunksize, parts) == etag:
+        return True
+    guess = math.ceil(size / parts / MB) * MB
+    return guess != config.multipart_chunksize and \
+        local_etag(local_path, config.multipart_threshold, guess, parts) == etag
+
+
+class TransferProgress:
+    """
+    Callback for boto3 transfers that logs the progress and the throughput of one file at most
+    every ``interval`` seconds, and once more when it is done
+    """
+
+    def __init__(self, label, total, interval=5.0):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.transferred = 0
+        self._started = time.monotonic()
+        self._logged = self._started
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.transferred += bytes_amount
+            now = time.monotonic()
+            if now - self._logged >= self.interval:
+                self._logged = now
+                self._log(logging.DEBUG)
+
+    def done(self):
+        """Log the size and throughput of the finished transfer"""
+        self._log(logging.INFO)
+
+    def _log(self, level):
+        seconds = max(time.monotonic() - self._started, 1e-9)
+        logger.log(level, "%s: %.1f of %.1f MB (%.0f%%) at %.1f MB/s", self.label,
+                   self.transferred / MB, self.total / MB,
+                   100.0 * self.transferred / self.total if self.total else 100.0,
+                   self.transferred / MB / seconds)
+
+
+def _head(client, s3bucket, key):
+    """head_object of an S3 object, None if it does not exist"""
+    try:
+        return client.head_object(Bucket=s3bucket, Key=key)
+    except botocore.exceptions.ClientError as errors:
+        if errors.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+
+def upload_file_to_s3(local_path, s3path, config=None, skip_unchanged=True, client=None):
     """
     Upload local file to s3 bucket
 
     Args:
         local_path (str): the path that points to the local data
         s3path (str): the s3 path that the data will be uploaded to
-        
-    Returns: None
+        config (:obj:`boto3.s3.transfer.TransferConfig`): the transfer settings
+        skip_unchanged (bool): whether to skip the upload if the object has the same content
+        client (:obj:`botocore.client.S3`): the S3 client, a new one if None
+
+    Returns:
+        bool: True if the file was uploaded, False if it was skipped
     """
 
     s3bucket, s3_just_path = parse_s3(s3path)
-
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(s3bucket)
+    config = config or transfer_config()
+    client = client or boto3.client("s3")
 
     try:
-        bucket.upload_file(local_path, s3_just_path)
+        if skip_unchanged and is_unchanged(local_path, _head(client, s3bucket, s3_just_path),
+                                           config):
+            logger.info('%s is unchanged at %s, upload skipped', local_path, s3path)
+            return False
+        progress = TransferProgress(local_path, os.path.getsize(local_path))
+        client.upload_file(local_path, s3bucket, s3_just_path, Config=config, Callback=progress)
     except botocore.exceptions.NoCredentialsError:
         logger.error('Please provide AWS credentials via AWS_ACCESS_KEY_ID and AWS_SECRET_'
                      'ACCESS_KEY env variables.')
+        return False
     else:
+        progress.done()
         logger.info('Data uploaded from %s to %s', local_path, s3path)
+        return True
 
 
-def download_file_from_s3(local_path, s3path):
+def download_file_from_s3(local_path, s3path, config=None, skip_unchanged=True, client=None):
     """
     Download data from s3
 
     Args:
         local_path (str): the path that points to the local data
         s3path (str): the s3 path that the data will be downloaded from
+        config (:obj:`boto3.s3.transfer.TransferConfig`): the transfer settings
+        skip_unchanged (bool): whether to skip the download if the local file has the same content
+        client (:obj:`botocore.client.S3`): the S3 client, a new one if None
 
-    Returns: None
+    Returns:
+        bool: True if the file was downloaded, False if it was skipped
     """
 
     s3bucket, s3_just_path = parse_s3(s3path)
-
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket(s3bucket)
+    config = config or transfer_config()
+    client = client or boto3.client("s3")
 
     try:
-        bucket.download_file(s3_just_path, local_path)
+        head = _head(client, s3bucket, s3_just_path)
+        if skip_unchanged and is_unchanged(local_path, head, config):
+            logger.info('%s is unchanged from %s, download skipped', local_path, s3path)
+            return False
+        progress = TransferProgress(s3path, head['ContentLength'] if head else 0)
+        client.download_file(s3bucket, s3_just_path, local_path, Config=config, Callback=progress)
     except botocore.exceptions.NoCredentialsError:
         logger.error('Please provide AWS credentials via AWS_ACCESS_KEY_ID and '
                      'AWS_SECRET_ACCESS_KEY env variables.')
+        return False
     else:
+        progress.done()
         logger.info('Data downloaded from %s to %s', s3path, local_path)
+        return True
+
 
+def _sync(transfer, pairs, config, skip_unchanged, max_workers):
+    """Run one transfer per (local path, s3 path) pair on a thread pool"""
+    client = boto3.client("s3")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        done = list(executor.map(lambda pair: transfer(pair[0], pair[1], config, skip_unchanged,
+                                                       client), pairs))
+    counts = {'transferred': sum(done), 'skipped': len(done) - sum(done)}
+    logger.info("%(transferred)i files transferred, %(skipped)i unchanged files skipped", counts)
+    return counts
 
 
+def sync_to_s3(local_dir, s3prefix, config=None, skip_unchanged=True, max_workers=8):
+    """
+    Upload every file under a local directory to an s3 prefix, several files at a time
+
+    Args:
+        local_dir (str): the local directory
+        s3prefix (str): the s3 path the directory is uploaded to
+        config (:obj:`boto3.s3.transfer.TransferConfig`): the transfer settings of every file
+        skip_unchanged (bool): whether to skip the files that are unchanged in s3
+        max_workers (int): number of files transferred at the same time
+
+    Returns:
+        counts (:obj:`dict`): the number of files transferred and skipped
+    """
+    pairs = []
+    for root, _, files in os.walk(local_dir):
+        for name in sorted(files):
+            local_path = os.path.join(root, name)
+            key = os.path.relpath(local_path, local_dir).replace(os.sep, '/')
+            pairs.append((local_path, s3prefix.rstrip('/') + '/' + key))
+    return _sync(upload_file_to_s3, pairs, config, skip_unchanged, max_workers)
+
+
+def sync_from_s3(s3prefix, local_dir, config=None, skip_unchanged=True, max_workers=8):
+    """
+    Download every object under an s3 prefix to a local directory, several objects at a time
+
+    Args:
+        s3prefix (str): the s3 path of the objects
+        local_dir (str): the local directory the objects are downloaded to
+        config (:obj:`boto3.s3.transfer.TransferConfig`): the transfer settings of every object
+        skip_unchanged (bool): whether to skip the objects that are unchanged locally
+        max_workers (int): number of objects transferred at the same time
+
+    Returns:
+        counts (:obj:`dict`): the number of files transferred and skipped
+    """
+    s3bucket, prefix = parse_s3(s3prefix)
+    prefix = prefix.rstrip('/') + '/'
+    pairs = []
+    pages = boto3.client("s3").get_paginator('list_objects_v2').paginate(Bucket=s3bucket,
+                                                                        Prefix=prefix)
+    for page in pages:
+        for obj in page.get('Contents', []):
+            local_path = os.path.join(local_dir, *obj['Key'][len(prefix):].split('/'))
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            pairs.append((local_path, 's3://%s/%s' % (s3bucket, obj['Key'])))
+    return _sync(download_file_from_s3, pairs, config, skip_unchanged, max_workers)
+
+
+class _BodyReader(io.RawIOBase):
+    """Raw file object over the chunks of a streaming s3 object body"""
+
+    def __init__(self, body, chunk_size):
+        self._body = body
+        self._chunks = body.iter_chunks(chunk_size)
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._pending:
+            self._pending = next(self._chunks, b'')
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        self._body.close()
+        super().close()
+
+
+def open_s3_stream(s3path, chunk_size=MB, compression='infer', client=None):
+    """
+    Open an s3 object as a binary file object that is read from the network ``chunk_size`` bytes
+    at a time, so that it can be parsed while it is downloaded and is never written to disk
+
+    Args:
+        s3path (str): the s3 path of the object
+        chunk_size (int): number of bytes read from the network at a time
+        compression (str): 'gzip' or None, 'infer' decompresses objects whose key ends with .gz
+            or that are stored with gzip content encoding
+        client (:obj:`botocore.client.S3`): the S3 client, a new one if None
+
+    Returns:
+        stream (:obj:`io.BufferedIOBase`): the (decompressed) content of the object
+    """
+    s3bucket, s3_just_path = parse_s3(s3path)
+    client = client or boto3.client("s3")
+    response = client.get_object(Bucket=s3bucket, Key=s3_just_path)
+    logger.info('Streaming %.1f MB from %s', response['ContentLength'] / MB, s3path)
 
+    stream = io.BufferedReader(_BodyReader(response['Body'], chunk_size), buffer_size=chunk_size)
+    if compression == 'infer':
+        compression = 'gzip' if s3_just_path.endswith('.gz') or \
+            response.get('ContentEncoding') == 'gzip' else None
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif compression is not None:
+        raise ValueError("Compression %s is not supported, use 'gzip' or None" % compression)
+    return stream
@@ -0,0 +1,164 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+
+from src.registry import file_hash
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+
+def input_hash(path):
+    """Content hash of a stage input: the sha256 of a local file, or the ETag of an s3 object
+
+    Args:
+        path (str): the local path or s3:// path of the input
+
+    Returns:
+        digest (str): the content hash
+    """
+    if str(path).startswith('s3://'):
+        # imported here so that local inputs do not need boto3
+        import boto3
+        from src.s3 import parse_s3
+        s3bucket, s3_just_path = parse_s3(path)
+        head = boto3.client('s3').head_object(Bucket=s3bucket, Key=s3_just_path)
+        return 'etag:%s:%i' % (head['ETag'].strip('"'), head['ContentLength'])
+    return file_hash(path)
+
+
+def code_version(*modules):
+    """Hash of the source files of the modules that implement a stage"""
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(inspect.getsourcefile(module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Content-addressed cache of the outputs of pipeline stages. A stage is identified by the
+    fingerprint of its inputs, its configuration and the version of its code; its output files
+    are copied to ``directory/<fingerprint>/`` after it runs and copied back instead of running
+    it again. Fingerprints of upstream stages are inputs of the downstream ones, so a change only
+    invalidates the stages after it. Only the ``keep`` most recently used entries are kept.
+    """
+
+    def __init__(self, directory, enabled=True, keep=None):
+        self.directory = directory
+        self.enabled = enabled
+        self.keep = keep
+
+    def fingerprint(self, stage, config, inputs=(), code=''):
+        """Fingerprint of a stage run
+
+        Args:
+            stage (str): the name of the stage
+            config (:obj:`dict`): the configuration of the stage
+            inputs (:obj:`list`): content hashes of the input files and fingerprints of the
+                upstream stages
+            code (str): the version of the code of the stage, see :func:`code_version`
+
+        Returns:
+            fingerprint (str): the fingerprint
+        """
+        payload = json.dumps({'stage': stage, 'config': config, 'inputs': list(inputs),
+                              'code': code}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def restore(self, fingerprint, outputs):
+        """Put the cached outputs of a stage run in place
+
+        Args:
+            fingerprint (str): the fingerprint of the stage run
+            outputs (:obj:`dict`): the path of every output, by name
+
+        Returns:
+            bool: True if every output was cached, False if the stage has to run
+        """
+        if not self.enabled:
+            return False
+        entry = os.path.join(self.directory, fingerprint)
+        try:
+            with open(os.path.join(entry, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if set(manifest) != set(outputs):
+            return False
+
+        for name, path in outputs.items():
+            if os.path.exists(path) and file_hash(path) == manifest[name]:
+                continue
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            shutil.copyfile(os.path.join(entry, name), path)
+        # the entry was used now, so that it is evicted last
+        os.utime(entry)
+        return True
+
+    def store(self, fingerprint, outputs):
+        """Copy the outputs of a stage run into the cache
+
+        Args:
+            fingerprint (str): the fingerprint of the stage run
+            outputs (:obj:`dict`): the path of every output, by name
+        """
+        if not self.enabled:
+            return
+        entry = os.path.join(self.directory, fingerprint)
+        tmp = entry + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        manifest = {}
+        for name, path in outputs.items():
+            shutil.copyfile(path, os.path.join(tmp, name))
+            manifest[name] = file_hash(path)
+        with open(os.path.join(tmp, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+        # the manifest is written last, and the entry appears in one rename
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        """Remove all but the ``keep`` most recently used entries, nothing if ``keep`` is None
+
+        Returns:
+            removed (:obj:`list`): the fingerprints of the removed entries
+        """
+        if self.keep is None or not os.path.isdir(self.directory):
+            return []
+        entries = [name for name in os.listdir(self.directory)
+                   if os.path.isdir(os.path.join(self.directory, name)) and not name.endswith('.tmp')]
+        entries.sort(key=lambda name: os.path.getmtime(os.path.join(self.directory, name)),
+                     reverse=True)
+        for name in entries[self.keep:]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            logger.debug("Stage cache entry %s is evicted", name[:12])
+        return entries[self.keep:]
+
+    def run(self, stage, fingerprint, outputs, compute):
+        """Restore the outputs of a stage run, or run it and cache its outputs
+
+        Args:
+            stage (str): the name of the stage, for logging
+            fingerprint (str): the fingerprint of the stage run
+            outputs (:obj:`dict`): the path of every output, by name
+            compute (:obj:`callable`): runs the stage and writes its outputs
+
+        Returns:
+            bool: True if the stage ran, False if its outputs were restored from the cache
+        """
+        if self.restore(fingerprint, outputs):
+            logger.info("Stage %s is unchanged (%s), outputs restored from the cache", stage,
+                        fingerprint[:12])
+            return False
+        logger.info("Running stage %s (%s)", stage, fingerprint[:12])
+        compute()
+        self.store(fingerprint, outputs)
+        return True
@@ -0,0 +1,89 @@
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from joblib import dump
+from sklearn.cluster import KMeans
+
+from src.modeling import evaluate_clusters
+
+logger = logging.getLogger(__name__)
+
+# metrics computed by evaluate_clusters, and those where a lower value is better
+METRICS = ['silhouette score', 'davies bouldin score', 'calinski harabasz score']
+LOWER_IS_BETTER = ['davies bouldin score']
+
+
+def _fit_one(values_path, n_cluster, seed, sample_size, block_size):
+    """Fit and score one grid point in a worker process"""
+    # every worker maps the same file read-only, the matrix is never pickled
+    values = np.load(values_path, mmap_mode='r')
+
+    start = time.perf_counter()
+    model = KMeans(n_clusters=n_cluster, random_state=seed).fit(values)
+    fit_seconds = time.perf_counter() - start
+
+    metrics = evaluate_clusters(values, model.labels_, sample_size, seed, 1, block_size)
+    result = {'n_cluster': n_cluster, 'seed': seed, 'fit seconds': fit_seconds}
+    result.update(zip(metrics['metric'], metrics['value']))
+
+    return result, model
+
+
+def sweep_kmeans(data, features, n_clusters, seeds, model_save_path, results_save_path,
+                 select_metric='silhouette score', n_workers=None, sample_size=None,
+                 block_size=1024):
+    """Fit k-means over a grid of cluster numbers and seeds on a process pool and keep the best
+
+    Args:
+        data (:obj:`DataFrame <pandas.DataFrame>`): the standardized data used for clustering
+        features (:obj:`list`): list of features
+        n_clusters (:obj:`list`): the numbers of clusters to try
+        seeds (:obj:`list`): the random states to try for every number of clusters
+        model_save_path (str): the path the best k means model is promoted to
+        results_save_path (str): the path to save the metrics of every grid point
+        select_metric (str): the metric the best model is chosen by
+        n_workers (int): number of worker processes, all cores if None
+        sample_size (int): number of records the silhouette score is computed on, all if None
+        block_size (int): number of records per block of the silhouette score
+
+    Returns:
+        model (:obj:`sklearn.cluster._kmeans.KMeans`): the best k means clustering model
+        results (:obj:`DataFrame <pandas.DataFrame>`): the metrics of every grid point
+    """
+    if select_metric not in METRICS:
+        raise ValueError("Unknown metric %s, use one of %s" % (select_metric, METRICS))
+    grid = [(n_cluster, seed) for n_cluster in n_clusters for seed in seeds]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        values_path = os.path.join(tmp_dir, 'values.npy')
+        np.save(values_path, np.ascontiguousarray(data[features].values, dtype=np.float64))
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_fit_one, values_path, n_cluster, seed, sample_size,
+                                       block_size) for n_cluster, seed in grid]
+            fitted = []
+            for future in futures:
+                fitted.append(future.result())
+                result = fitted[-1][0]
+                logger.info("k-means with %i clusters and seed %i has %s %f", result['n_cluster'],
+                            result['seed'], select_metric, result[select_metric])
+
+    results = pd.DataFrame([result for result, _ in fitted])
+    ascending = select_metric in LOWER_IS_BETTER
+    best = results[select_metric].idxmin() if ascending else results[select_metric].idxmax()
+    results['best'] = results.index == best
+
+    results.sort_values(select_metric, ascending=ascending).to_csv(results_save_path, index=False)
+    logger.info("Sweep results are saved to path %s", results_save_path)
+
+    model = fitted[best][1]
+    dump(model, model_save_path)
+    logger.info("Best model with %i clusters and seed %i is promoted to path %s",
+                results.loc[best, 'n_cluster'], results.loc[best, 'seed'], model_save_path)
+
+    return model, results
@@ -0,0 +1,118 @@
+import json
+import shutil
+
+import pandas as pd
+import pytest
+
+from app import create_app
+from src.more_chocolate_plz import bulk_add_rows, create_db, get_engine
+
+FORM = {'cocoa_percent': 70, 'rating': 3.5, 'beans': 'Yes', 'cocoa_butter': 'Yes', 'vanilla': 'No',
+        'lecithin': 'No', 'salt': 'No', 'sugar': 'Yes', 'sweetener_without_sugar': 'No'}
+
+
+@pytest.fixture
+def make_client(tmp_path):
+    """Build the app on a database of the first clean chocolate bars, return a function giving its
+    test client"""
+    file_path = str(tmp_path / 'clean_data.csv')
+    pd.read_csv('data/clean_data.csv', nrows=200).to_csv(file_path, index=False)
+    db_path = str(tmp_path / 'chocolates.db')
+    create_db('sqlite:///%s' % db_path)
+    engine = get_engine('sqlite:///%s' % db_path)
+    bulk_add_rows(file_path, engine)
+    engine.dispose()
+
+    def make(**settings):
+        settings.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///%s' % db_path)
+        return create_app(**settings).test_client()
+    return make
+
+
+def test_create_app(make_client):
+    """test if the app is warm and ready once created, and serves the web form"""
+    client = make_client()
+
+    ready = client.get('/ready')
+    submit = client.post('/submit', data=FORM)
+
+    assert client.get('/healthz').get_json() == {'status': 'ok'}
+    assert ready.status_code == 200
+    assert ready.get_json()['status'] == 'ready'
+    assert ready.get_json()['chocolate_bars'] > 0
+    assert submit.status_code == 200
+    assert 'Server-Timing' in submit.headers
+
+
+def test_create_app_unhappy(make_client, tmp_path):
+    """test if /ready answers 503 until the chocolates table can be read, and 200 after"""
+    db_path = str(tmp_path / 'empty.db')
+    client = make_client(SQLALCHEMY_DATABASE_URI='sqlite:///%s' % db_path)
+
+    assert client.get('/healthz').status_code == 200
+    assert client.get('/ready').status_code == 503
+    shutil.copy(str(tmp_path / 'chocolates.db'), db_path)
+    assert client.get('/ready').status_code == 200
+
+
+def test_api_recommend(make_client):
+    """test if /api/recommend answers one profile and a batch, and serves a repeated one from the cache"""
+    client = make_client()
+
+    single = client.post('/api/recommend', json=FORM)
+    batch = client.post('/api/recommend', json=[FORM, dict(FORM, rating=4.0)])
+
+    assert single.status_code == 200
+    recs = single.get_json()['recommendations']
+    assert [rec['rank'] for rec in recs] == list(range(1, len(recs) + 1))
+    assert {'chocolate_bar', 'company', 'rating'}.issubset(recs[0])
+    assert single.headers['X-Cache-Hits'] == '0'
+    assert 'total;dur=' in single.headers['Server-Timing']
+    assert batch.status_code == 200
+    assert len(batch.get_json()) == 2
+    assert batch.get_json()[0] == single.get_json()
+    assert (batch.headers['X-Cache-Hits'], batch.headers['X-Batch-Size']) == ('1', '1')
+    # a quarter-point rating is scored as it is, not as the rating rounded to one decimal
+    quarter = client.post('/api/recommend', json=[dict(FORM, rating=3.2), dict(FORM, rating=3.25)])
+    assert quarter.headers['X-Cache-Hits'] == '0'
+
+
+def test_api_recommend_unhappy(make_client):
+    """test if /api/recommend rejects profiles with missing fields and bodies that are not json"""
+    client = make_client()
+
+    missing = client.post('/api/recommend', json=[FORM, {'cocoa_percent': 70}])
+    empty = client.post('/api/recommend', json=[])
+    text = client.post('/api/recommend', data='cocoa_percent=70')
+
+    assert missing.status_code == 400
+    assert "'rating'" in missing.get_json()['error']
+    assert empty.status_code == 400
+    assert text.status_code == 400
+
+
+def test_metrics(make_client, tmp_path):
+    """test if /metrics serves the requests of this worker summed with the other workers'"""
+    metrics_dir = tmp_path / 'metrics'
+    client = make_client(METRICS_DIR=str(metrics_dir))
+    assert client.post('/api/recommend', json=FORM).status_code == 200
+    # another worker whose /submit failed once
+    (metrics_dir / '1.json').write_text(json.dumps({'chocolate_errors': {
+        'kind': 'counter', 'documentation': 'Requests that failed',
+        'labelnames': ['endpoint', 'status'], 'buckets': [], 'values': [[['submit', '500'], 1]]}}))
+
+    response = client.get('/metrics')
+    text = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain')
+    assert 'chocolate_request_seconds_count{endpoint="api_recommend"} 1\n' in text
+    assert 'chocolate_errors_total{endpoint="submit",status="500"} 1\n' in text
+
+
+def test_metrics_unhappy(make_client):
+    """test if /metrics counts a request with missing fields as an error"""
+    client = make_client()
+    assert client.post('/api/recommend', json={'cocoa_percent': 70}).status_code == 400
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'chocolate_errors_total{endpoint="api_recommend",status="400"} 1\n' in text
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.cluster import KMeans
+
+from src.artifacts import catalog_meta, load_catalog, probe_artifacts, save_catalog
+from src.clean_data import fit_preprocessor
+
+features = ['cocoa_percent', 'rating', 'beans']
+display_vars = ['index', 'company', 'rating']
+
+df_in = pd.DataFrame([[3, '5150', 76.0, 3.75, 1],
+                      [5, 'A. Morin', 63.0, 3.5, 0],
+                      [6, 'Zotter', 70.0, 3.0, 1],
+                      [9, 'Soma', 72.0, 4.0, 0]],
+                     columns=['index', 'company', 'cocoa_percent', 'rating', 'beans'])
+
+
+def test_save_catalog(tmp_path):
+    """test if a saved catalog, from a dataframe or from chunks, is opened memory-mapped with the labels of the same model version"""
+    preprocessor = fit_preprocessor(df_in, features)
+    model = KMeans(n_clusters=2, random_state=12, n_init=10).fit(preprocessor['scalar'].transform(df_in[features]))
+
+    for _ in range(3):
+        save_catalog(df_in, model, preprocessor, str(tmp_path), display_vars, model_version='v1', keep=2)
+    snapshot = load_catalog(str(tmp_path), model, 'v1')
+
+    assert len([name for name in os.listdir(str(tmp_path)) if name != 'CURRENT']) == 2
+    assert snapshot.version == probe_artifacts(str(tmp_path))
+    assert isinstance(snapshot.features, np.memmap)
+    assert isinstance(snapshot.labels, np.memmap)
+    np.testing.assert_array_equal(snapshot.ids, [3, 5, 6, 9])
+    np.testing.assert_array_equal(snapshot.labels, model.labels_)
+    assert snapshot.display_rows(np.array([1, 3])).tolist() == [[5, 'A. Morin', 3.5], [9, 'Soma', 4.0]]
+
+    # the same catalog from chunks of the data
+    save_catalog(lambda: (df_in.iloc[lo:lo + 3] for lo in range(0, 4, 3)), model, preprocessor, str(tmp_path),
+                 display_vars, model_version='v1', block_size=3)
+    chunked = load_catalog(str(tmp_path), model, 'v1')
+    np.testing.assert_array_equal(chunked.ids, snapshot.ids)
+    np.testing.assert_array_equal(chunked.labels, snapshot.labels)
+    np.testing.assert_allclose(chunked.features, snapshot.features)
+    assert chunked.display_rows(np.arange(4)).tolist() == snapshot.display_rows(np.arange(4)).tolist()
+
+
+def test_save_catalog_unhappy(tmp_path):
+    """test if a catalog saved under another model version is relabelled, and a missing one or one without bar ids raises"""
+    with pytest.raises(FileNotFoundError):
+        load_catalog(str(tmp_path), None)
+
+    preprocessor = fit_preprocessor(df_in, features)
+    scaled = preprocessor['scalar'].transform(df_in[features])
+    with pytest.raises(ValueError):
+        save_catalog(df_in.drop(columns='index'), KMeans(n_clusters=2, random_state=12, n_init=10).fit(scaled),
+                     preprocessor, str(tmp_path), display_vars)
+    save_catalog(df_in, KMeans(n_clusters=2, random_state=12, n_init=10).fit(scaled), preprocessor,
+                 str(tmp_path), display_vars, model_version='v1')
+    model = KMeans(n_clusters=1, n_init=1).fit(scaled)
+
+    snapshot = load_catalog(str(tmp_path), model, 'v2')
+    np.testing.assert_array_equal(snapshot.labels, np.zeros(4))
+    assert snapshot.index.n_clusters == 1
+
+
+def test_catalog_meta(tmp_path):
+    """test if catalog_meta() returns the fingerprint and model version of the current catalog"""
+    preprocessor = fit_preprocessor(df_in, features)
+    model = KMeans(n_clusters=2, random_state=12, n_init=10).fit(preprocessor['scalar'].transform(df_in[features]))
+    save_catalog(df_in, model, preprocessor, str(tmp_path), display_vars, model_version='v1', fingerprint='a')
+    save_catalog(df_in, model, preprocessor, str(tmp_path), display_vars, model_version='v2', fingerprint='b')
+
+    meta = catalog_meta(str(tmp_path))
+
+    assert meta['fingerprint'] == 'b'
+    assert meta['model_version'] == 'v2'
+    assert meta['rows'] == 4
+
+
+def test_catalog_meta_unhappy(tmp_path):
+    """test if catalog_meta() returns None when no catalog was saved yet"""
+    assert catalog_meta(str(tmp_path)) is None
+    assert catalog_meta(str(tmp_path / 'missing')) is None
@@ -0,0 +1,25 @@
+import json
+
+from src.audit import AuditLog
+
+
+def test_audit_log(tmp_path):
+    """test if AuditLog appends the queued records as json lines when it is closed"""
+    path = str(tmp_path / 'audit.jsonl')
+    audit = AuditLog(path, flush_interval=60)
+    for i in range(3):
+        audit.write({'input': [70.0, 3.5], 'recommendations': [i, i + 1]})
+    audit.close()
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert records == [{'input': [70.0, 3.5], 'recommendations': [i, i + 1]} for i in range(3)]
+    assert audit.written == 3
+
+
+def test_audit_log_unhappy(tmp_path):
+    """test if AuditLog neither raises nor blocks when the log cannot be written"""
+    audit = AuditLog(str(tmp_path / 'not_a_dir' / 'audit.jsonl'), flush_interval=0)
+    audit.write({'input': [70.0, 3.5]})
+    audit.close()
+    assert audit.written == 0
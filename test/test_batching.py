@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+from src.batching import MicroBatcher
+
+
+def test_micro_batcher():
+    """test if MicroBatcher runs concurrent submissions in one batch and splits the results back"""
+    batches = []
+    entered = threading.Event()
+    release = threading.Event()
+
+    def handler(items):
+        entered.set()
+        release.wait(5)
+        batches.append(list(items))
+        return [item * 10 for item in items]
+
+    batcher = MicroBatcher(handler, max_wait=0, max_batch=100)
+    first = batcher.submit([1])
+    entered.wait(5)
+    # the second and third submissions queue while the first batch is still running
+    second = batcher.submit([2, 3])
+    third = batcher.submit([4])
+    release.set()
+
+    assert first.result(5) == [10]
+    assert second.result(5) == [20, 30]
+    assert third.result(5) == [40]
+    assert batches == [[1], [2, 3, 4]]
+    assert third.batch_size == 3
+
+
+def test_micro_batcher_unhappy():
+    """test if MicroBatcher hands the error of a failed batch to every request in it"""
+    def handler(items):
+        raise ValueError("cannot score %s" % items)
+
+    batcher = MicroBatcher(handler, max_wait=0)
+    with pytest.raises(ValueError):
+        batcher([1], timeout=5)
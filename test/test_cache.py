@@ -0,0 +1,56 @@
+import pytest
+
+from src.cache import ResultCache, cache_key, normalize_input
+
+replace_dict = {'No': 0, 'Yes': 1}
+
+
+def test_normalize_input():
+    """test if normalize_input() maps yes/no to 1/0 and keeps the numeric inputs as they are"""
+    user_input = normalize_input(['70.04', '3.25', 'Yes', 'No'], replace_dict)
+    assert user_input == (70.04, 3.25, 1.0, 0.0)
+    assert user_input == normalize_input([70.04, 3.25, 1, 'No'], replace_dict)
+
+
+def test_normalize_input_unhappy():
+    """test if a non numeric input is provided to normalize_input()"""
+    with pytest.raises(ValueError):
+        normalize_input(['seventy', '3.5'], replace_dict)
+
+
+def test_cache_key():
+    """test if cache_key() rounds to two decimals, which keeps the quarter-point ratings apart"""
+    assert cache_key((70.004, 3.25, 1.0)) == cache_key((70.0, 3.25, 1.0)) == (70.0, 3.25, 1.0)
+    assert cache_key((70.0, 3.75, 1.0)) != cache_key((70.0, 3.8, 1.0))
+    assert cache_key((70.04, 3.25), decimals=0) == (70.0, 3.0)
+
+
+def test_cache_key_unhappy():
+    """test if an input that was not normalized is provided to cache_key()"""
+    with pytest.raises(TypeError):
+        cache_key(('70', 'Yes'))
+
+
+def test_result_cache():
+    """test if ResultCache counts hits and misses and evicts the least recently used entry"""
+    cache = ResultCache(maxsize=2, ttl=None)
+    assert cache.get_or_compute(('a',), 1, lambda: 'A') == 'A'
+    assert cache.get_or_compute(('a',), 1, lambda: 'not computed') == 'A'
+    cache.put(('b',), 1, 'B')
+    cache.put(('c',), 1, 'C')
+
+    assert cache.get(('a',), 1) is None
+    assert cache.get(('c',), 1) == 'C'
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'size': 2}
+
+
+def test_result_cache_unhappy():
+    """test if ResultCache drops its entries when the version changes or they expire"""
+    cache = ResultCache(maxsize=2, ttl=None)
+    cache.put(('a',), 1, 'A')
+    assert cache.get(('a',), 2) is None
+    assert len(cache) == 0
+
+    expired = ResultCache(maxsize=2, ttl=0)
+    expired.put(('a',), 1, 'A')
+    assert expired.get(('a',), 1) is None
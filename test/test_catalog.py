@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+from sklearn.cluster import KMeans
+from sqlalchemy.orm import sessionmaker
+
+from src.catalog import CatalogStore, build_snapshot, load_snapshot, probe_catalog
+from src.more_chocolate_plz import Base, bulk_add_rows, upsert_rows
+
+features = ['cocoa_percent', 'rating', 'beans']
+display_vars = ['index', 'company', 'rating']
+
+df_in = pd.DataFrame([[1, '5150', 76.0, 3.75, 1],
+                      [2, 'A. Morin', 63.0, 3.5, 0],
+                      [3, 'Zotter', 70.0, 3.0, 1],
+                      [4, 'Soma', 72.0, 4.0, 0]],
+                     columns=['index', 'company', 'cocoa_percent', 'rating', 'beans'])
+
+
+def test_build_snapshot():
+    """test if build_snapshot() stores scaled features, cluster labels and display columns as arrays"""
+    model = KMeans(n_clusters=2, random_state=12, n_init=10).fit(
+        (df_in[features] - df_in[features].mean()) / df_in[features].std(ddof=0))
+
+    snapshot = build_snapshot(df_in, model, features, display_vars, version=(4, 4))
+
+    assert len(snapshot) == 4
+    assert snapshot.features.flags['C_CONTIGUOUS']
+    np.testing.assert_allclose(snapshot.features.mean(axis=0), np.zeros(3), atol=1e-12)
+    np.testing.assert_array_equal(snapshot.ids, np.array([1, 2, 3, 4]))
+    np.testing.assert_array_equal(snapshot.labels, model.predict(snapshot.features))
+    assert snapshot.display[1].tolist() == [2, 'A. Morin', 3.5]
+
+
+def test_build_snapshot_unhappy():
+    """test if dataframe is not provided to build_snapshot()"""
+    with pytest.raises(AttributeError):
+        build_snapshot("not a df", None, features, display_vars)
+
+
+def test_load_snapshot_lazy_display(tmp_path):
+    """test if load_snapshot() with lazy_display fetches the display columns of the recommended bars only"""
+    file_path = str(tmp_path / 'clean_data.csv')
+    df_db = df_in.drop(columns='index').assign(specific_bean_origin_or_bar_name='bar', cocoa_butter=1, vanilla=0,
+                                               lecithin=0, salt=0, sugar=1, sweetener_without_sugar=0,
+                                               first_taste='cocoa', second_taste='nutty')
+    df_db.to_csv(file_path, index=False)
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+    Base.metadata.create_all(engine)
+    bulk_add_rows(file_path, engine)
+    session = sessionmaker(bind=engine)()
+    model = KMeans(n_clusters=1, n_init=1).fit(df_in[features])
+
+    snapshot = load_snapshot(session, model, features, display_vars, lazy_display=True)
+
+    assert snapshot.version is None
+    assert callable(snapshot.display)
+    np.testing.assert_array_equal(snapshot.ids, np.array([1, 2, 3, 4]))
+    assert snapshot.display_rows(np.array([3, 1])).tolist() == [[4, 'Soma', 4.0], [2, 'A. Morin', 3.5]]
+    session.close()
+
+
+def test_load_snapshot_lazy_display_unhappy(tmp_path):
+    """test if session is not provided to load_snapshot(), and if a bar deleted after the read is left empty"""
+    with pytest.raises(AttributeError):
+        load_snapshot("not a session", None, features, display_vars, lazy_display=True)
+
+    file_path = str(tmp_path / 'clean_data.csv')
+    df_in.assign(specific_bean_origin_or_bar_name='bar', cocoa_butter=1, vanilla=0, lecithin=0, salt=0, sugar=1,
+                 sweetener_without_sugar=0, first_taste='cocoa', second_taste='nutty').to_csv(file_path, index=False)
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+    Base.metadata.create_all(engine)
+    bulk_add_rows(file_path, engine)
+    session = sessionmaker(bind=engine)()
+    model = KMeans(n_clusters=1, n_init=1).fit(df_in[features])
+    snapshot = load_snapshot(session, model, features, display_vars, lazy_display=True)
+    with engine.begin() as conn:
+        conn.execute('DELETE FROM chocolates WHERE "index" = 4')
+
+    assert snapshot.display_rows(np.array([3, 1])).tolist() == [[4, None, None], [2, 'A. Morin', 3.5]]
+    session.close()
+
+
+def test_probe_catalog(tmp_path):
+    """test if probe_catalog() changes when a load updates a row in place"""
+    file_path = str(tmp_path / 'clean_data.csv')
+    df_db = df_in.assign(specific_bean_origin_or_bar_name='bar', cocoa_butter=1, vanilla=0, lecithin=0, salt=0,
+                         sugar=1, sweetener_without_sugar=0, first_taste='cocoa', second_taste='nutty')
+    df_db.to_csv(file_path, index=False)
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+    Base.metadata.create_all(engine)
+    bulk_add_rows(file_path, engine, key_columns=['company'])
+    session = sessionmaker(bind=engine)()
+    version = probe_catalog(session)
+
+    # Zotter is re-rated, the number of rows and the largest index stay the same
+    df_db.assign(rating=[3.75, 3.5, 3.25, 4.0]).to_csv(file_path, index=False)
+    upsert_rows(file_path, engine, key_columns=['company'])
+
+    assert version == (4, 4, 1)
+    assert probe_catalog(session) == (4, 4, 2)
+    session.close()
+
+
+def test_probe_catalog_unhappy(tmp_path):
+    """test if probe_catalog() falls back on a table without row_version and fails without the table"""
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+    session = sessionmaker(bind=engine)()
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        probe_catalog(session)
+
+    with engine.begin() as conn:
+        conn.execute('CREATE TABLE chocolates ("index" INTEGER PRIMARY KEY, company VARCHAR(25))')
+        conn.execute('INSERT INTO chocolates ("index", company) VALUES (3, \'5150\'), (7, \'Soma\')')
+    assert probe_catalog(session) == (2, 7, None)
+    session.close()
+
+
+def test_catalog_store_refresh():
+    """test if CatalogStore reloads the snapshot only when the version probe changes"""
+    versions = [1]
+    loads = []
+
+    def loader():
+        loads.append(versions[0])
+        return build_snapshot(df_in, KMeans(n_clusters=1, n_init=1).fit(df_in[features]), features,
+                              display_vars, version=versions[0])
+
+    store = CatalogStore(loader, lambda: versions[0], ttl=None, probe_interval=0)
+    first = store.get()
+    assert store.get() is first
+
+    versions[0] = 2
+    second = store.get()
+    assert second is not first
+    assert second.version == 2
+    assert loads == [1, 2]
+
+
+def test_catalog_store_model_swap():
+    """test if CatalogStore relabels the snapshot when the model it depends on is swapped"""
+    model_versions = ['a']
+
+    def loader():
+        model = KMeans(n_clusters=len(model_versions), n_init=1, random_state=12).fit(df_in[features])
+        return build_snapshot(df_in, model, features, display_vars, version=1,
+                              model_version=model_versions[-1])
+
+    store = CatalogStore(loader, lambda: 1, ttl=None, probe_interval=None,
+                         depends_on=lambda: model_versions[-1])
+    first = store.get()
+    assert store.get() is first
+
+    model_versions.append('b')
+    second = store.get()
+    assert second.model_version == 'b'
+    assert second.model.n_clusters == 2
+
+
+def test_catalog_store_refresh_unhappy():
+    """test if CatalogStore keeps serving the previous snapshot when a refresh fails"""
+    calls = []
+
+    def loader():
+        calls.append(1)
+        if len(calls) > 1:
+            raise ConnectionError("database is gone")
+        return build_snapshot(df_in, KMeans(n_clusters=1, n_init=1).fit(df_in[features]), features,
+                              display_vars, version=1)
+
+    store = CatalogStore(loader, lambda: 2, ttl=None, probe_interval=0)
+    first = store.get()
+    assert store.get() is first
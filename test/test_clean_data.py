@@ -1,7 +1,18 @@
+import gzip
+
+import boto3
+import numpy as np
 import pandas as pd
 import pytest
+from joblib import dump
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
 
-from src.clean_data import clean, standardization
+from src.clean_data import clean, standardization, fit_preprocessor, load_preprocessor, apply_preprocessor, \
+    clean_streaming, encode_binary, read_data, read_data_chunks, save_scaled_chunks, transform_features
 
 
 def test_clean():
@@ -64,3 +75,127 @@ def test_standardization_unhappy():
     
     with pytest.raises(AttributeError):
         standardization(df_in, features)
+
+
+def test_fit_preprocessor(tmp_path):
+    """test if the saved preprocessor transforms new rows the same way standardization() scales the training data"""
+    features = ['feature1', 'feature2', 'feature3']
+    df_in = pd.DataFrame([[1, 1, 2], [3, 4, 3], [2, 2, 2]], columns=features)
+    save_path = str(tmp_path / 'preprocessor.joblib')
+
+    fit_preprocessor(df_in, features, save_path)
+    preprocessor = load_preprocessor(save_path)
+
+    assert preprocessor['features'] == features
+    pd.testing.assert_frame_equal(standardization(df_in, features), apply_preprocessor(df_in, preprocessor),
+                                  check_dtype=False)
+
+
+def test_load_preprocessor_unhappy(tmp_path):
+    """test if an artifact that is not a preprocessor is rejected by load_preprocessor()"""
+    save_path = str(tmp_path / 'kmeans.joblib')
+    dump({'scalar': None}, save_path)
+
+    with pytest.raises(ValueError):
+        load_preprocessor(save_path)
+
+
+def test_encode_binary():
+    """test if encode_binary() gives the same encoding for object and categorical columns"""
+    df_in = pd.DataFrame({'beans': ["have_not_bean", "have_bean", "have_bean"],
+                          'salt': ["have_salt", "have_not_salt", "have_salt"]})
+    df_cat = df_in.astype('category')
+
+    df_true = pd.DataFrame({'beans': [0, 1, 1], 'salt': [1, 0, 1]})
+
+    pd.testing.assert_frame_equal(df_true, encode_binary(df_in, ['beans', 'salt'], 'not'))
+    pd.testing.assert_frame_equal(df_true, encode_binary(df_cat, ['beans', 'salt'], 'not'))
+
+
+def test_encode_binary_unhappy():
+    """test if a binary variable with missing values is rejected by encode_binary()"""
+    df_in = pd.DataFrame({'beans': ["have_not_bean", None]}).astype('category')
+
+    with pytest.raises(ValueError):
+        encode_binary(df_in, ['beans'], 'not')
+
+
+def test_clean_streaming(tmp_path):
+    """test if clean_streaming() writes the same data, bar ids and scalar as clean() and fit_preprocessor()"""
+    raw_path = str(tmp_path / 'raw.csv')
+    features = ['cocoa_percent', 'beans', 'salt']
+    pd.DataFrame([[0, 'msia company', 72.0, "have_not_bean", "have_salt"],
+                  [1, 'avc company', 55.9, "have_bean", "have_not_salt"],
+                  [2, 'hanyu company', 78.2, "have_bean", "have_salt"],
+                  [3, 'evanston company', 60.0, "have_not_bean", "have_salt"],
+                  [4, 'zoom company', 65.5, "have_bean", "have_not_salt"]],
+                 columns=['', 'company'] + features).to_csv(raw_path, index=False)
+    kwargs = dict(enc_features=['beans', 'salt'], clean_features=['index', 'company'] + features, binary_word='not')
+
+    df_true = clean(pd.read_csv(raw_path, index_col=[0]), store_path=str(tmp_path / 'clean.csv'), **kwargs)
+    chunks = read_data_chunks(raw_path, 0, chunksize=2, dtypes={'beans': 'category', 'salt': 'category'})
+    n_rows, preprocessor = clean_streaming(chunks, store_path=str(tmp_path / 'clean_streaming.csv'),
+                                           features=features, **kwargs)
+
+    assert n_rows == 5
+    assert df_true['index'].tolist() == [1, 2, 3, 4, 5]
+    pd.testing.assert_frame_equal(df_true.reset_index(drop=True), pd.read_csv(str(tmp_path / 'clean_streaming.csv')))
+    pd.testing.assert_frame_equal(apply_preprocessor(df_true, fit_preprocessor(df_true, features)),
+                                  apply_preprocessor(df_true, preprocessor))
+
+
+def test_clean_streaming_unhappy(tmp_path):
+    """test if chunks that are not dataframes are rejected by clean_streaming()"""
+    with pytest.raises(TypeError):
+        clean_streaming(["not a df"], enc_features=['beans'], store_path=str(tmp_path / 'clean.csv'),
+                        clean_features=['beans'], binary_word='not')
+
+
+def test_save_scaled_chunks(tmp_path):
+    """test if save_scaled_chunks() writes the same scaled features as transform_features() into a memory-mapped array"""
+    features = ['feature1', 'feature2']
+    df_in = pd.DataFrame([[1, 1, 'a'], [3, 4, 'b'], [2, 2, 'c'], [5, 0, 'd'], [4, 3, 'e']],
+                         columns=features + ['company'])
+    preprocessor = fit_preprocessor(df_in, features)
+
+    values = save_scaled_chunks((df_in.iloc[lo:lo + 2] for lo in range(0, 5, 2)), preprocessor,
+                                str(tmp_path / 'values.npy'))
+
+    assert isinstance(values, np.memmap)
+    np.testing.assert_allclose(values, transform_features(df_in, preprocessor))
+
+
+def test_save_scaled_chunks_unhappy(tmp_path):
+    """test if save_scaled_chunks() rejects data without rows and leaves no partial file"""
+    preprocessor = fit_preprocessor(pd.DataFrame([[1], [2]], columns=['feature1']), ['feature1'])
+
+    with pytest.raises(ValueError):
+        save_scaled_chunks(iter([]), preprocessor, str(tmp_path / 'values.npy'))
+    assert not list(tmp_path.iterdir())
+
+
+def test_read_data_chunks_s3(tmp_path, monkeypatch):
+    """test if read_data_chunks() and read_data() stream a gzip csv from s3 like the local file"""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    raw_path = str(tmp_path / 'raw.csv')
+    pd.DataFrame({'company': ['msia', 'avc', 'hanyu'], 'rating': [4.5, 4.0, 3.5]}).to_csv(raw_path)
+
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='example-bucket')
+        with open(raw_path, 'rb') as f:
+            client.put_object(Bucket='example-bucket', Key='raw.csv.gz', Body=gzip.compress(f.read()))
+
+        chunks = list(read_data_chunks('s3://example-bucket/raw.csv.gz', 0, chunksize=2))
+        assert [len(chunk) for chunk in chunks] == [2, 1]
+        pd.testing.assert_frame_equal(pd.concat(chunks), read_data(raw_path, 0))
+        pd.testing.assert_frame_equal(read_data('s3://example-bucket/raw.csv.gz', 0),
+                                      read_data(raw_path, 0))
+
+
+def test_read_data_chunks_s3_unhappy():
+    """test if read_data_chunks() is provided an s3 path that is not valid"""
+    with pytest.raises(AttributeError):
+        read_data_chunks('s3://', 0, chunksize=2)
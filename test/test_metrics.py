@@ -0,0 +1,139 @@
+import json
+import multiprocessing
+import time
+
+import pandas as pd
+import pytest
+
+from src.metrics import MetricsRegistry, StageTimer, reset_after_fork
+
+
+def test_metrics_registry():
+    """test if MetricsRegistry renders counters and cumulative histogram buckets"""
+    metrics = MetricsRegistry()
+    errors = metrics.counter('errors', 'Requests that failed', ['endpoint'])
+    seconds = metrics.histogram('stage_seconds', 'Seconds per stage', ['stage'], buckets=(0.25, 1.0))
+    errors.inc(endpoint='submit')
+    errors.inc(2, endpoint='submit')
+    seconds.observe(0.25, stage='predict')
+    seconds.observe(0.5, stage='predict')
+    with seconds.time(stage='render'):
+        pass
+
+    assert metrics.counter('errors', 'Requests that failed', ['endpoint']) is errors
+    assert errors.value(endpoint='submit') == 3
+    assert seconds.count(stage='predict') == 2
+    text = metrics.render()
+    assert '# TYPE errors counter\nerrors_total{endpoint="submit"} 3\n' in text
+    assert 'stage_seconds_bucket{stage="predict",le="0.25"} 1\n' in text
+    assert 'stage_seconds_bucket{stage="predict",le="1.0"} 2\n' in text
+    assert 'stage_seconds_bucket{stage="predict",le="+Inf"} 2\n' in text
+    assert 'stage_seconds_sum{stage="predict"} 0.75\n' in text
+    assert 'stage_seconds_count{stage="render"} 1\n' in text
+
+
+def test_metrics_registry_unhappy():
+    """test if a metric is registered twice with different types or observed without its labels"""
+    metrics = MetricsRegistry()
+    seconds = metrics.histogram('seconds', 'Seconds', ['stage'])
+    with pytest.raises(ValueError):
+        metrics.counter('seconds', 'Seconds')
+    with pytest.raises(KeyError):
+        seconds.observe(0.1)
+
+
+def record_in_child(metrics):
+    """Observe a request in a forked process and write it to the shared directory"""
+    metrics.counter('requests', 'Requests served', ['endpoint']).inc(endpoint='submit')
+    metrics.histogram('seconds', 'Seconds', buckets=(1.0,)).observe(0.5)
+    metrics.flush(force=True)
+
+
+def test_metrics_registry_directory(tmp_path):
+    """test if MetricsRegistry sums the values of every process sharing its directory, once"""
+    metrics = MetricsRegistry(str(tmp_path), flush_interval=0.05)
+    requests = metrics.counter('requests', 'Requests served', ['endpoint'])
+    seconds = metrics.histogram('seconds', 'Seconds', buckets=(1.0,))
+    requests.inc(endpoint='submit')
+    child = multiprocessing.get_context('fork').Process(target=record_in_child, args=(metrics,))
+    child.start()
+    child.join()
+    seconds.observe(2.0)
+
+    assert child.exitcode == 0
+    text = metrics.render()
+    assert 'requests_total{endpoint="submit"} 2\n' in text
+    assert 'seconds_bucket{le="1.0"} 1\n' in text
+    assert 'seconds_count 2\n' in text
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        ['%i.json' % child.pid, '%i.json' % multiprocessing.current_process().pid])
+
+    # a flush right after another one is written by a timer
+    requests.inc(endpoint='submit')
+    assert not metrics.flush()
+    time.sleep(0.2)
+    state = json.loads((tmp_path / ('%i.json' % multiprocessing.current_process().pid)).read_text())
+    assert state['requests']['values'] == [[['submit'], 2]]
+
+
+def test_metrics_registry_directory_unhappy(tmp_path):
+    """test if an unreadable file is skipped and histograms with other buckets are not summed"""
+    metrics = MetricsRegistry(str(tmp_path))
+    metrics.counter('requests', 'Requests served').inc()
+    (tmp_path / '1.json').write_text('{"requests"')
+    assert 'requests_total 1\n' in metrics.render()
+
+    (tmp_path / '2.json').write_text('{"seconds": {"kind": "histogram", "documentation": "Seconds", '
+                                     '"labelnames": [], "buckets": [1.0], '
+                                     '"values": [[[], [1, 0]]]}}')
+    with pytest.raises(ValueError):
+        metrics.render()
+
+
+def test_reset_after_fork(tmp_path):
+    """test if reset_after_fork forgets the values of a registry with a directory"""
+    metrics = MetricsRegistry(str(tmp_path))
+    requests = metrics.counter('requests', 'Requests served')
+    requests.inc(3)
+
+    reset_after_fork()
+    requests.inc()
+
+    assert requests.value() == 1
+    assert 'requests_total 1\n' in metrics.render()
+
+
+def test_reset_after_fork_unhappy():
+    """test if reset_after_fork leaves a registry without a directory alone, it is not shared"""
+    metrics = MetricsRegistry()
+    requests = metrics.counter('requests', 'Requests served')
+    requests.inc(3)
+
+    reset_after_fork()
+
+    assert requests.value() == 3
+
+
+def test_stage_timer(tmp_path):
+    """test if StageTimer saves the wall time and peak RSS growth of every stage"""
+    timer = StageTimer()
+    with timer.stage('clean') as record:
+        record['ran'] = True
+    with timer.stage('fit'):
+        pass
+
+    metrics = timer.save(str(tmp_path / 'pipeline_metrics.csv'))
+    assert list(metrics['stage']) == ['clean', 'fit']
+    assert (metrics['seconds'] >= 0).all()
+    assert (metrics['peak_rss_delta_mb'] >= 0).all()
+    assert (metrics['process_peak_rss_mb'] >= metrics['peak_rss_delta_mb']).all()
+    pd.testing.assert_frame_equal(metrics, pd.read_csv(str(tmp_path / 'pipeline_metrics.csv')))
+
+
+def test_stage_timer_unhappy():
+    """test if StageTimer records a stage that raised"""
+    timer = StageTimer()
+    with pytest.raises(ValueError):
+        with timer.stage('clean'):
+            raise ValueError("bad data")
+    assert timer.records[0]['stage'] == 'clean'
@@ -1,7 +1,13 @@
+import numpy as np
 import pandas as pd
 import pytest
+from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
+from sklearn.preprocessing import StandardScaler
 
-from src.modeling import get_userinput, formatting_preds, melting_dataset, mapping
+from src.catalog import CatalogSnapshot
+from src.modeling import get_userinput, formatting_preds, melting_dataset, mapping, predict_from_snapshot, \
+    predict_batch_from_snapshot, snapshot_batch_recs, generate_kmeans, model_evaluation, silhouette_blocks
 
 
 def test_get_userinput():
@@ -59,6 +65,11 @@ def test_formatting_preds():
 
     pd.testing.assert_frame_equal(df_true, df_test)
 
+    # without a store path the table is only handed to the writer
+    written = []
+    formatting_preds(df_in, df_web_display, features, 2, None, writer=written.append)
+    pd.testing.assert_frame_equal(df_true, written[0])
+
 
 def test_formatting_preds_unhappy():
     """test if dataframe is not provided to formatting_preds()"""
@@ -106,7 +117,7 @@ def test_mapping():
                                    'first_taste', 'second_taste'])
 
     df_test = mapping(df_in, rec_product_name='chocolate_bar', raw_df=df_for_merging, choco_index='index',
-                      join_method='inner', drop_idx1='index_x', drop_idx2='index_y')
+                      join_method='inner')
 
     pd.testing.assert_frame_equal(df_true, df_test)
 
@@ -117,5 +128,163 @@ def test_mapping_unhappy():
     df_for_merging = "not a df either"
 
     with pytest.raises(TypeError):
-        mapping(df_in, rec_product_name='chocolate_bar', raw_df=df_for_merging, choco_index='index',join_method='inner',
-                drop_idx1='index_x', drop_idx2='index_y')
\ No newline at end of file
+        mapping(df_in, rec_product_name='chocolate_bar', raw_df=df_for_merging, choco_index='index',join_method='inner')
+
+    # only joins that keep the ranked bars are supported, and bar numbers must be unique
+    df_in = pd.DataFrame([[999999, 1, 1]], columns=['index', 'rank', 'chocolate_bar'])
+    df_for_merging = pd.DataFrame([[1, '5150'], [1, 'A. Morin']], columns=['index', 'company'])
+    with pytest.raises(ValueError):
+        mapping(df_in, rec_product_name='chocolate_bar', raw_df=df_for_merging.iloc[:1], choco_index='index',
+                join_method='outer')
+    with pytest.raises(ValueError):
+        mapping(df_in, rec_product_name='chocolate_bar', raw_df=df_for_merging, choco_index='index')
+
+def test_predict_from_snapshot():
+    """test if predict_from_snapshot() ranks bars of the user input cluster by distance"""
+    features = ['cocoa_percent', 'rating']
+    scalar = StandardScaler().fit(np.array([[0.0, 0.0], [2.0, 2.0]]))
+    snapshot = CatalogSnapshot(ids=np.array([10, 11, 12, 13]),
+                               features=np.array([[0.0, 0.0], [0.5, 0.5], [3.0, 3.0], [-0.4, -0.4]]),
+                               labels=np.array([0, 0, 1, 0]),
+                               display=np.array([[10, 'a'], [11, 'b'], [12, 'c'], [13, 'd']], dtype=object),
+                               display_vars=['index', 'company'],
+                               preprocessor={'version': 1, 'features': features, 'scalar': scalar}, version=1)
+    model = KMeans(n_clusters=2, n_init=1, init=np.array([[0.0, 0.0], [3.0, 3.0]])).fit(
+        np.array([[0.0, 0.0], [3.0, 3.0]]))
+    user_input = pd.DataFrame([[1.0, 1.0]], columns=features)
+
+    df_test = predict_from_snapshot(snapshot, user_input, model, 2).to_frame()
+
+    df_true = pd.DataFrame([[1, 10, 'a'], [2, 13, 'd']], columns=['rank', 'chocolate_bar', 'company'])
+
+    pd.testing.assert_frame_equal(df_true, df_test, check_dtype=False)
+
+
+def test_predict_from_snapshot_unhappy():
+    """test if catalog snapshot is not provided to predict_from_snapshot()"""
+    user_input = pd.DataFrame([[1.0, 1.0]], columns=['cocoa_percent', 'rating'])
+
+    with pytest.raises(AttributeError):
+        predict_from_snapshot("not a snapshot", user_input, None, 2)
+
+
+def test_predict_batch_from_snapshot():
+    """test if predict_batch_from_snapshot() gives every user input the same table as predict_from_snapshot()"""
+    features = ['cocoa_percent', 'rating']
+    scalar = StandardScaler().fit(np.array([[0.0, 0.0], [2.0, 2.0]]))
+    model = KMeans(n_clusters=2, n_init=1, init=np.array([[0.0, 0.0], [3.0, 3.0]])).fit(
+        np.array([[0.0, 0.0], [3.0, 3.0]]))
+    snapshot = CatalogSnapshot(ids=np.array([10, 11, 12, 13]),
+                               features=np.array([[0.0, 0.0], [0.5, 0.5], [3.0, 3.0], [-0.4, -0.4]]),
+                               labels=np.array([0, 0, 1, 0]),
+                               display=np.array([[10, 'a'], [11, 'b'], [12, 'c'], [13, 'd']], dtype=object),
+                               display_vars=['index', 'company'],
+                               preprocessor={'version': 1, 'features': features, 'scalar': scalar}, version=1,
+                               model=model)
+    user_inputs = pd.DataFrame([[1.0, 1.0], [7.0, 7.0]], columns=features)
+
+    df_tests = predict_batch_from_snapshot(snapshot, user_inputs, 2)
+
+    assert len(df_tests) == 2
+    for i, df_test in enumerate(df_tests):
+        pd.testing.assert_frame_equal(predict_from_snapshot(snapshot, user_inputs.iloc[[i]], None, 2).to_frame(),
+                                      df_test.to_frame())
+    assert df_tests[1]['chocolate_bar'].tolist() == [12]
+
+
+def test_predict_batch_from_snapshot_unhappy():
+    """test if catalog snapshot is not provided to predict_batch_from_snapshot()"""
+    user_inputs = pd.DataFrame([[1.0, 1.0]], columns=['cocoa_percent', 'rating'])
+
+    with pytest.raises(AttributeError):
+        predict_batch_from_snapshot("not a snapshot", user_inputs, 2)
+
+
+def test_snapshot_batch_recs():
+    """test if snapshot_batch_recs() gathers the bars of every user input into records with named fields"""
+    snapshot = CatalogSnapshot(ids=np.array([10, 11, 12]), features=np.zeros((3, 1)), labels=np.zeros(3),
+                               display=np.array([[10, 'a', 3.5], [11, 'b', 4.0], [12, 'c', 2.75]], dtype=object),
+                               display_vars=['index', 'company', 'rating'], preprocessor=None, version=1)
+
+    recs = snapshot_batch_recs(snapshot, np.array([[2, 0], [1, -1]]))
+
+    assert [len(rec) for rec in recs] == [2, 1]
+    assert recs[0].records() == [{'rank': 1, 'chocolate_bar': 12, 'company': 'c', 'rating': 2.75},
+                                 {'rank': 2, 'chocolate_bar': 10, 'company': 'a', 'rating': 3.5}]
+    assert recs[1]['chocolate_bar'].tolist() == [11]
+    pd.testing.assert_frame_equal(recs[1].to_frame(),
+                                  pd.DataFrame([[1, 11, 'b', 4.0]], columns=['rank', 'chocolate_bar', 'company',
+                                                                             'rating']), check_dtype=False)
+
+
+def test_snapshot_batch_recs_unhappy():
+    """test if a user input without any recommendation gets an empty table"""
+    snapshot = CatalogSnapshot(ids=np.array([10]), features=np.zeros((1, 1)), labels=np.zeros(1),
+                               display=np.array([[10, 'a']], dtype=object), display_vars=['index', 'company'],
+                               preprocessor=None, version=1)
+
+    recs = snapshot_batch_recs(snapshot, np.array([[-1, -1]]))
+
+    assert len(recs[0]) == 0
+    assert recs[0].records() == []
+
+
+def test_generate_kmeans_minibatch(tmp_path):
+    """test if the minibatch engine fits on streamed chunks and labels every row"""
+    rng = np.random.RandomState(12)
+    df_in = pd.DataFrame(np.concatenate([rng.normal(-5, 1, size=(60, 2)), rng.normal(5, 1, size=(60, 2))]),
+                         columns=['feature1', 'feature2'])
+
+    def read_chunks():
+        return (df_in.iloc[lo:lo + 25] for lo in range(0, len(df_in), 25))
+
+    model = generate_kmeans(read_chunks, ['feature1', 'feature2'], 2, 12, str(tmp_path / 'kmeans.joblib'),
+                            engine='minibatch', batch_size=25, n_epochs=2)
+
+    assert len(model.labels_) == 120
+    assert len(set(model.labels_[:60])) == 1
+    assert len(set(model.labels_[60:])) == 1
+    assert model.labels_[0] != model.labels_[-1]
+    np.testing.assert_array_equal(model.labels_, model.predict(df_in.values))
+
+
+def test_generate_kmeans_unhappy(tmp_path):
+    """test if an unknown engine is rejected by generate_kmeans()"""
+    df_in = pd.DataFrame([[1, 2], [3, 4]], columns=['feature1', 'feature2'])
+
+    with pytest.raises(ValueError):
+        generate_kmeans(df_in, ['feature1', 'feature2'], 2, 12, str(tmp_path / 'kmeans.joblib'), engine='spark')
+
+
+def test_silhouette_blocks():
+    """test if silhouette_blocks() matches the silhouette score of sklearn for any block size"""
+    rng = np.random.RandomState(12)
+    values = rng.normal(size=(150, 3))
+    labels = rng.randint(0, 4, size=150)
+    labels[0] = 5
+
+    si_true = silhouette_score(values, labels)
+
+    assert silhouette_blocks(values, labels, n_jobs=2, block_size=16) == pytest.approx(si_true)
+    assert silhouette_blocks(values, labels, block_size=1000) == pytest.approx(si_true)
+
+
+def test_silhouette_blocks_unhappy():
+    """test if a single cluster is rejected by silhouette_blocks()"""
+    with pytest.raises(ValueError):
+        silhouette_blocks(np.zeros((5, 2)), np.zeros(5))
+
+
+def test_model_evaluation(tmp_path):
+    """test if model_evaluation() writes every metric with its compute time on a sample"""
+    rng = np.random.RandomState(12)
+    df_in = pd.DataFrame(rng.normal(size=(100, 2)), columns=['feature1', 'feature2'])
+    model = KMeans(n_clusters=3, random_state=12, n_init=10).fit(df_in.values)
+    metric_save_path = str(tmp_path / 'performance_metric.csv')
+
+    metrics = model_evaluation(df_in, model, ['feature1', 'feature2'], metric_save_path, sample_size=40, seed=12)
+
+    pd.testing.assert_frame_equal(metrics, pd.read_csv(metric_save_path))
+    assert metrics['metric'].tolist() == ['silhouette score', 'davies bouldin score', 'calinski harabasz score']
+    assert metrics['n_records'].tolist() == [40, 100, 100]
+    assert (metrics['seconds'] >= 0).all()
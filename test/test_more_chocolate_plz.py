@@ -0,0 +1,159 @@
+import pandas as pd
+import pytest
+import sqlalchemy
+
+from src.more_chocolate_plz import KEY_COLUMNS, Base, Chocolates, bulk_add_rows, create_db, get_engine, migrate_db, \
+    upload_to_rds, upsert_rows
+
+clean_features = ['company', 'specific_bean_origin_or_bar_name', 'cocoa_percent', 'rating', 'beans', 'cocoa_butter',
+                  'vanilla', 'lecithin', 'salt', 'sugar', 'sweetener_without_sugar', 'first_taste', 'second_taste']
+
+
+def test_bulk_add_rows(tmp_path):
+    """test if bulk_add_rows() writes every row of the csv across several batches under its bar id"""
+    file_path = str(tmp_path / 'clean_data.csv')
+    pd.DataFrame([[2, "5150", "Bejofo Estate, batch 1", 76.0, 3.75, 1, 1, 0, 0, 0, 1, 0, 'cocoa', 'blackberry'],
+                  [5, "5150", "Zorzal, batch 1", 76.0, 3.5, 1, 1, 0, 0, 0, 1, 0, 'cocoa', 'vegetal'],
+                  [9, "A. Morin", "Peru", 63.0, 3.75, 1, 1, 0, 1, 0, 1, 0, 'fruity', 'melon']],
+                 columns=['index'] + clean_features).to_csv(file_path, index=False)
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+    Base.metadata.create_all(engine)
+
+    total = bulk_add_rows(file_path, engine, batch_size=2)
+
+    df_test = pd.read_sql('SELECT * FROM chocolates ORDER BY "index"', engine)
+    assert total == 3
+    assert df_test['index'].tolist() == [2, 5, 9]
+    assert df_test['specific_bean_origin_or_bar_name'].tolist() == ["Bejofo Estate, batch 1", "Zorzal, batch 1", "Peru"]
+    assert df_test['lecithin'].tolist() == ['0', '0', '1']
+
+
+def test_bulk_add_rows_unhappy(tmp_path):
+    """test if bulk_add_rows() rejects a csv without the chocolates columns, and one whose bar ids are already loaded"""
+    file_path = str(tmp_path / 'not_clean_data.csv')
+    pd.DataFrame([[1, 2]], columns=['a', 'b']).to_csv(file_path, index=False)
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+
+    with pytest.raises(ValueError):
+        bulk_add_rows(file_path, engine)
+
+    file_path = str(tmp_path / 'clean_data.csv')
+    pd.DataFrame([[2, "5150", "Zorzal, batch 1", 76.0, 3.5, 1, 1, 0, 0, 0, 1, 0, 'cocoa', 'vegetal']],
+                 columns=['index'] + clean_features).to_csv(file_path, index=False)
+    Base.metadata.create_all(engine)
+    bulk_add_rows(file_path, engine)
+    with pytest.raises(ValueError, match='--mode upsert'):
+        bulk_add_rows(file_path, engine)
+    assert pd.read_sql('SELECT COUNT(*) AS n FROM chocolates', engine)['n'].tolist() == [1]
+
+
+def test_upsert_rows(tmp_path):
+    """test if upsert_rows() inserts new bars, updates changed ones, deletes missing ones and keeps the bar ids of the csv"""
+    file_path = str(tmp_path / 'clean_data.csv')
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+    Base.metadata.create_all(engine)
+    rows = [[1, "5150", "Bejofo Estate, batch 1", 76.0, 3.75, 1, 1, 0, 0, 0, 1, 0, 'cocoa', 'blackberry'],
+            [2, "5150", "Zorzal, batch 1", 76.0, 3.5, 1, 1, 0, 0, 0, 1, 0, 'cocoa', 'vegetal'],
+            [3, "A. Morin", "Peru", 63.0, 3.75, 1, 1, 0, 1, 0, 1, 0, 'fruity', 'melon']]
+    pd.DataFrame(rows, columns=['index'] + clean_features).to_csv(file_path, index=False)
+    bulk_add_rows(file_path, engine, key_columns=['company', 'specific_bean_origin_or_bar_name'])
+
+    # Zorzal is re-rated and moves to the id of Peru, which is gone, and Chuao is new
+    rows[1][0], rows[1][4] = 3, 4.0
+    pd.DataFrame([rows[0], [2, "A. Morin", "Chuao", 70.0, 4.0, 1, 1, 0, 1, 0, 1, 0, 'oily', 'nut'], rows[1]],
+                 columns=['index'] + clean_features).to_csv(file_path, index=False)
+
+    counts = upsert_rows(file_path, engine, key_columns=['company', 'specific_bean_origin_or_bar_name'],
+                         delete_missing=True)
+
+    df_test = pd.read_sql('SELECT * FROM chocolates ORDER BY "index"', engine)
+    assert counts == {'inserted': 1, 'updated': 1, 'unchanged': 1, 'deleted': 1}
+    assert df_test['index'].tolist() == [1, 2, 3]
+    assert df_test['specific_bean_origin_or_bar_name'].tolist() == ["Bejofo Estate, batch 1", "Chuao", "Zorzal, batch 1"]
+    assert df_test['rating'].tolist() == [3.75, 4.0, 4.0]
+
+
+def test_upsert_rows_unhappy(tmp_path):
+    """test if upsert_rows() fails when the chocolates table does not exist"""
+    file_path = str(tmp_path / 'clean_data.csv')
+    pd.DataFrame([["5150", "Zorzal, batch 1", 76.0, 3.5, 1, 1, 0, 0, 0, 1, 0, 'cocoa', 'vegetal']],
+                 columns=clean_features).to_csv(file_path, index=False)
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        upsert_rows(file_path, engine)
+
+
+def test_migrate_db(tmp_path):
+    """test if migrate_db() adds the loader columns and indexes to a table created before them"""
+    file_path = str(tmp_path / 'clean_data.csv')
+    pd.DataFrame([[1, "5150", "Zorzal, batch 1", 76.0, 3.5, 1, 1, 0, 0, 0, 1, 0, 'cocoa', 'vegetal']],
+                 columns=['index'] + clean_features).to_csv(file_path, index=False)
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+    old = sqlalchemy.MetaData()
+    sqlalchemy.Table('chocolates', old, *[sqlalchemy.Column(col.name, col.type, primary_key=col.primary_key)
+                                          for col in Chocolates.__table__.columns if col.name not in KEY_COLUMNS])
+    old.create_all(engine)
+
+    added = migrate_db(engine)
+
+    assert sorted(added) == sorted(KEY_COLUMNS + ['ix_chocolates_features', 'ix_chocolates_row_key'])
+    assert migrate_db(engine) == []
+    assert upsert_rows(file_path, engine)['inserted'] == 1
+
+
+def test_migrate_db_unhappy(tmp_path):
+    """test if migrate_db() leaves a database without the chocolates table alone"""
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'chocolates.db'))
+
+    assert migrate_db(engine) == []
+    assert not sqlalchemy.inspect(engine).get_table_names()
+
+
+def test_get_engine(tmp_path):
+    """test if get_engine() reuses one engine per connection string and create_db() adds the covering index"""
+    engine_string = 'sqlite:///' + str(tmp_path / 'chocolates.db')
+    engine = get_engine(engine_string, pool_pre_ping=True)
+
+    create_db(engine_string, {'pool_pre_ping': True})
+
+    assert get_engine(engine_string, pool_pre_ping=True) is engine
+    assert get_engine(engine_string) is not engine
+    indexes = [index['name'] for index in sqlalchemy.inspect(engine).get_indexes('chocolates')]
+    assert 'ix_chocolates_features' in indexes
+
+
+def test_get_engine_unhappy():
+    """test if an invalid engine option is rejected by get_engine()"""
+    with pytest.raises(TypeError):
+        get_engine('sqlite://', not_an_option=1)
+
+
+def test_upload_to_rds(tmp_path):
+    """test if upload_to_rds() appends a csv to an empty table and upserts it into a loaded one"""
+    file_path = str(tmp_path / 'clean_data.csv')
+    engine_string = 'sqlite:///' + str(tmp_path / 'chocolates.db')
+    rows = [[1, "5150", "Zorzal, batch 1", 76.0, 3.5, 1, 1, 0, 0, 0, 1, 0, 'cocoa', 'vegetal']]
+    pd.DataFrame(rows, columns=['index'] + clean_features).to_csv(file_path, index=False)
+    create_db(engine_string)
+
+    upload_to_rds(file_path, engine_string)
+    rows[0][4] = 4.0
+    pd.DataFrame(rows, columns=['index'] + clean_features).to_csv(file_path, index=False)
+    upload_to_rds(file_path, engine_string, mode='upsert')
+
+    df_test = pd.read_sql('SELECT "index", rating FROM chocolates', get_engine(engine_string))
+    assert df_test.values.tolist() == [[1, 4.0]]
+
+
+def test_upload_to_rds_unhappy(tmp_path):
+    """test if upload_to_rds() raises instead of only logging when the csv is appended twice"""
+    file_path = str(tmp_path / 'clean_data.csv')
+    engine_string = 'sqlite:///' + str(tmp_path / 'chocolates.db')
+    pd.DataFrame([[1, "5150", "Zorzal, batch 1", 76.0, 3.5, 1, 1, 0, 0, 0, 1, 0, 'cocoa', 'vegetal']],
+                 columns=['index'] + clean_features).to_csv(file_path, index=False)
+    create_db(engine_string)
+    upload_to_rds(file_path, engine_string)
+
+    with pytest.raises(ValueError):
+        upload_to_rds(file_path, engine_string)
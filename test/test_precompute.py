@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.cluster import KMeans
+
+from src.catalog import build_snapshot
+from src.clean_data import fit_preprocessor
+from src.modeling import predict_batch_from_snapshot
+from src.precompute import (PrecomputedRecs, catalog_fingerprint, grid_axis, load_precomputed,
+                            precompute_recs)
+
+features = ['cocoa_percent', 'rating', 'beans', 'salt']
+display_vars = ['index', 'company', 'rating']
+
+df_in = pd.DataFrame([[1, '5150', 76.0, 3.75, 1, 0],
+                      [2, 'A. Morin', 63.0, 3.5, 0, 0],
+                      [3, 'Zotter', 70.0, 3.0, 1, 1],
+                      [4, 'Soma', 72.0, 4.0, 0, 1],
+                      [5, 'Valrhona', 64.0, 3.25, 1, 0],
+                      [6, 'Amedei', 70.0, 4.0, 0, 0]],
+                     columns=['index', 'company', 'cocoa_percent', 'rating', 'beans', 'salt'])
+
+
+def snapshot_of(data):
+    preprocessor = fit_preprocessor(data, features)
+    scaled = preprocessor['scalar'].transform(data[features].values)
+    model = KMeans(n_clusters=2, random_state=12, n_init=10).fit(scaled)
+    return build_snapshot(data, model, features, display_vars, preprocessor=preprocessor,
+                          model_version='v1')
+
+
+def test_precompute_recs(tmp_path):
+    """test if precompute_recs() saves the same recommendations as scoring the grid points"""
+    snapshot = snapshot_of(df_in)
+    save_path = str(tmp_path / 'precomputed_recs.npz')
+    recs = precompute_recs(snapshot, features, {'start': 60, 'stop': 80, 'step': 5},
+                           {'start': 3, 'stop': 4, 'step': 0.5}, top=3, save_path=save_path)
+    assert len(recs) == 5 * 3 * 4
+
+    loaded = load_precomputed(save_path)
+    assert loaded.fingerprint == catalog_fingerprint(snapshot)
+    for user_input in [(70.0, 3.5, 1.0, 0.0), (60.0, 4.0, 0.0, 1.0), (80.0, 3.0, 1.0, 1.0)]:
+        expected = predict_batch_from_snapshot(snapshot, pd.DataFrame([user_input], columns=features), 3)[0]
+        np.testing.assert_array_equal(snapshot.ids[loaded.lookup(user_input)], expected['chocolate_bar'])
+
+    # between grid points the nearest one is taken, unless snapping is off
+    np.testing.assert_array_equal(loaded.lookup((71.0, 3.4, 1, 0)), loaded.lookup((70.0, 3.5, 1, 0)))
+    assert loaded.lookup((71.0, 3.4, 1, 0), snap=False) is None
+
+
+def test_precompute_recs_unhappy(tmp_path):
+    """test if user inputs outside of the grid miss, and a changed catalog has another fingerprint"""
+    snapshot = snapshot_of(df_in)
+    recs = PrecomputedRecs(np.zeros((2 * 2 * 4, 3), dtype=np.int32), grid_axis(60, 65, 5),
+                           grid_axis(3, 4, 1), 2, catalog_fingerprint(snapshot))
+    assert recs.lookup((90.0, 3.0, 1, 0)) is None
+    assert recs.lookup((60.0, 3.0, 1, 0.5)) is None
+    assert recs.lookup((60.0, 3.0, 1)) is None
+
+    changed = df_in.assign(rating=df_in['rating'].where(df_in['index'] != 6, 3.0))
+    assert catalog_fingerprint(snapshot_of(changed)) != recs.fingerprint
+    with pytest.raises(ValueError):
+        grid_axis(60, 50, 5)
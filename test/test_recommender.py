@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.cluster import KMeans
+from sklearn.preprocessing import StandardScaler
+
+from src.recommender import build_cluster_index, format_batch_recs, recommend_batch
+
+
+def test_cluster_index_query():
+    """test if ClusterIndex.query() returns the nearest bars of one cluster in order of distance"""
+    rng = np.random.RandomState(12)
+    features = rng.normal(size=(200, 4))
+    labels = rng.randint(0, 3, size=200)
+    query = rng.normal(size=4)
+
+    index = build_cluster_index(features, labels, n_clusters=3)
+    positions, distances = index.query(query, 1, 5)
+
+    members = np.flatnonzero(labels == 1)
+    dists_true = np.linalg.norm(features[members] - query, axis=1)
+    positions_true = members[np.argsort(dists_true)[:5]]
+
+    np.testing.assert_array_equal(positions_true, positions)
+    np.testing.assert_allclose(np.sort(dists_true)[:5], distances)
+
+
+def test_cluster_index_query_small_cluster():
+    """test if ClusterIndex.query() returns every member when the cluster is smaller than top"""
+    features = np.array([[0.0, 0.0], [1.0, 1.0], [0.5, 0.5], [5.0, 5.0]])
+    labels = np.array([0, 0, 0, 1])
+
+    index = build_cluster_index(features, labels, n_clusters=3)
+
+    np.testing.assert_array_equal(index.query([0.9, 0.9], 0, 10)[0], np.array([1, 2, 0]))
+    assert len(index.query([0.9, 0.9], 2, 10)[0]) == 0
+
+
+def test_build_cluster_index_unhappy():
+    """test if cluster labels that do not match the features are rejected by build_cluster_index()"""
+    with pytest.raises(ValueError):
+        build_cluster_index(np.zeros((3, 2)), np.array([0, 1]))
+
+
+def test_cluster_index_query_batch():
+    """test if ClusterIndex.query_batch() gives the same recommendations as one query per row"""
+    rng = np.random.RandomState(12)
+    features = rng.normal(size=(300, 3))
+    labels = rng.randint(0, 4, size=300)
+    queries = rng.normal(size=(25, 3))
+    clusters = rng.randint(0, 4, size=25)
+
+    index = build_cluster_index(features, labels, n_clusters=4)
+    positions, distances = index.query_batch(queries, clusters, 6, block_size=7)
+
+    for row in range(25):
+        positions_true, distances_true = index.query(queries[row], clusters[row], 6)
+        np.testing.assert_array_equal(positions_true, positions[row])
+        np.testing.assert_allclose(distances_true, distances[row])
+
+
+def test_cluster_index_query_batch_unhappy():
+    """test if ClusterIndex.query_batch() rejects a cluster label the model does not have"""
+    index = build_cluster_index(np.zeros((3, 2)), np.array([0, 1, 1]), n_clusters=2)
+
+    with pytest.raises(IndexError):
+        index.query_batch(np.zeros((1, 2)), np.array([5]), 2)
+
+
+def test_recommend_batch():
+    """test if recommend_batch() clusters the profiles and pads recommendations of small clusters"""
+    features = ['cocoa_percent', 'beans']
+    catalog = np.array([[70.0, 1], [72.0, 1], [60.0, 0], [61.0, 0], [62.0, 0]])
+    preprocessor = {'version': 1, 'features': features, 'scalar': StandardScaler().fit(catalog)}
+    scaled = preprocessor['scalar'].transform(catalog)
+    model = KMeans(n_clusters=2, n_init=1, init=scaled[[0, 2]]).fit(scaled)
+    index = build_cluster_index(scaled, model.labels_, model.n_clusters)
+    profiles = pd.DataFrame([[71.0, 'Yes'], [62.0, 'No']], columns=features)
+
+    clusters, positions, _ = recommend_batch(profiles, model, preprocessor, index, 3, {'No': 0, 'Yes': 1})
+
+    assert clusters[0] != clusters[1]
+    np.testing.assert_array_equal(np.array([[0, 1, -1], [4, 3, 2]]), positions)
+
+
+def test_format_batch_recs():
+    """test if format_batch_recs() writes one row per profile and recommendation with its bar id"""
+    catalog = pd.DataFrame([['5150', 3.75], ['A. Morin', 3.5], ['Zotter', 3.0]], columns=['company', 'rating'])
+    positions = np.array([[2, 0], [1, -1]])
+    distances = np.array([[0.1, 0.2], [0.3, np.nan]])
+
+    df_test = format_batch_recs(np.array(['a', 'b']), positions, distances, catalog, np.array([101, 205, 307]))
+
+    df_true = pd.DataFrame([['a', 1, 307, 0.1, 'Zotter', 3.0],
+                            ['a', 2, 101, 0.2, '5150', 3.75],
+                            ['b', 1, 205, 0.3, 'A. Morin', 3.5]],
+                           columns=['profile_id', 'rank', 'chocolate_bar', 'distance', 'company', 'rating'])
+
+    pd.testing.assert_frame_equal(df_true, df_test, check_dtype=False)
+
+
+def test_format_batch_recs_unhappy():
+    """test if bar ids that do not match the catalog rows are rejected by format_batch_recs()"""
+    catalog = pd.DataFrame([['5150', 3.75], ['A. Morin', 3.5]], columns=['company', 'rating'])
+
+    with pytest.raises(ValueError):
+        format_batch_recs(np.array(['a']), np.array([[1, 0]]), np.array([[0.1, 0.2]]), catalog, np.array([101]))
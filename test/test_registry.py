@@ -0,0 +1,45 @@
+import os
+
+import pytest
+from joblib import dump
+
+from src.registry import ModelRegistry
+
+
+def test_model_registry(tmp_path):
+    """test if ModelRegistry swaps the model only when the file content changes and can roll back"""
+    path = str(tmp_path / 'model.joblib')
+    dump({'n_clusters': 2}, path)
+    registry = ModelRegistry(path, check_interval=0)
+    first = registry.load()
+    assert first.model == {'n_clusters': 2}
+
+    # same content rewritten: new mtime, same version
+    dump({'n_clusters': 2}, path)
+    assert registry.get() is first
+
+    dump({'n_clusters': 3}, path)
+    os.utime(path, ns=(0, 0))
+    second = registry.get()
+    assert second.model == {'n_clusters': 3}
+    assert second.version != first.version
+    assert registry.previous is first
+
+    assert registry.rollback() is first
+    assert registry.get() is first
+
+
+def test_model_registry_unhappy(tmp_path):
+    """test if ModelRegistry raises on a missing file and keeps serving after a broken write"""
+    with pytest.raises(FileNotFoundError):
+        ModelRegistry(str(tmp_path / 'not_a_model.joblib')).load()
+
+    path = str(tmp_path / 'model.joblib')
+    dump({'n_clusters': 2}, path)
+    registry = ModelRegistry(path, check_interval=0)
+    first = registry.load()
+    with open(path, 'wb') as f:
+        f.write(b'half written')
+    assert registry.get() is first
+    with pytest.raises(ValueError):
+        registry.rollback()
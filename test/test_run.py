@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+
+import boto3
+import pytest
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+from run import build_parser, transfer
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# modules that only the subcommands needing them may import
+HEAVY = ('pandas', 'sklearn', 'sqlalchemy', 'boto3', 'botocore')
+# seconds of imports for starting run.py, only checked when set, e.g. IMPORT_BUDGET=0.5 on a quiet
+# machine, as wall-clock limits are flaky on a loaded one
+IMPORT_BUDGET = float(os.environ.get('IMPORT_BUDGET', 'inf'))
+# -X importtime is new in Python 3.7, older versions ignore it and report no imports
+needs_importtime = pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs Python 3.7")
+
+
+def run_imports(*argv):
+    """Run run.py with -X importtime, return the finished process, the modules it imported and the
+    seconds spent importing them"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', 'run.py'] + list(argv), cwd=REPO,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    modules, seconds = set(), 0.0
+    for line in proc.stderr.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        modules.add(fields[2].strip().split('.')[0])
+        # nested imports are indented further, and already counted in their parent
+        if not fields[2].startswith('  '):
+            seconds += int(fields[1]) / 1e6
+    return proc, modules, seconds
+
+
+@needs_importtime
+def test_run_startup():
+    """test if run.py starts without loading any heavy dependency, within IMPORT_BUDGET if set"""
+    for argv in [['--help'], ['download', '--help'], ['store_rds', '--help']]:
+        proc, modules, seconds = run_imports(*argv)
+
+        assert proc.returncode == 0
+        assert not modules.intersection(HEAVY)
+        assert seconds < IMPORT_BUDGET
+
+
+@needs_importtime
+def test_run_startup_unhappy(tmp_path):
+    """test if a database command on a missing file still loads neither scikit-learn nor boto3"""
+    proc, modules, _ = run_imports('store_rds', '--file_path', str(tmp_path / 'missing.csv'),
+                                   '--engine_string', 'sqlite:///%s' % (tmp_path / 'chocolates.db'))
+
+    assert 'No such file or directory' in proc.stderr
+    assert 'sqlalchemy' in modules
+    assert not modules.intersection(['sklearn', 'boto3', 'botocore'])
+
+
+def test_transfer(tmp_path, monkeypatch):
+    """test if transfer uploads in parts of --multipart_chunksize MB, not of the threshold"""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    local_path = tmp_path / 'chocolate.csv'
+    local_path.write_bytes(b'0' * 7 * 1024 * 1024)
+    args = build_parser().parse_args(['upload', '--local_path', str(local_path),
+                                      '--s3path', 's3://example-bucket/chocolate.csv',
+                                      '--multipart_threshold', '5', '--multipart_chunksize', '8'])
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='example-bucket')
+        transfer(args)
+        etag = client.head_object(Bucket='example-bucket', Key='chocolate.csv')['ETag']
+
+    # one part of 8 MB, two if the 5 MB threshold were taken as the part size
+    assert etag.strip('"').endswith('-1')
+
+
+def test_transfer_unhappy():
+    """test if a part size that is not a whole number of MB is rejected"""
+    with pytest.raises(SystemExit):
+        build_parser().parse_args(['download', '--multipart_chunksize', '0.5'])
@@ -1,6 +1,16 @@
+import gzip
+import os
+
+import boto3
 import pytest
 
-from src.s3 import parse_s3
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+from src.s3 import (MB, download_file_from_s3, is_unchanged, local_etag, open_s3_stream, parse_s3,
+                    sync_from_s3, sync_to_s3, transfer_config, upload_file_to_s3)
 
 
 def test_parse_s3():
@@ -14,3 +24,133 @@ def test_parse_s3_invalid_path():
     s3path = "justrandompath"
     with pytest.raises(AttributeError):
         parse_s3(s3path)
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='example-bucket')
+        yield client
+
+
+def test_local_etag(tmp_path, bucket):
+    """test if local_etag() matches the ETag of a single part and of a multipart upload"""
+    path = str(tmp_path / 'data.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(11 * MB))
+
+    config = transfer_config(multipart_threshold=5, multipart_chunksize=5)
+    upload_file_to_s3(path, 's3://example-bucket/multi.bin', config)
+    etag = bucket.head_object(Bucket='example-bucket', Key='multi.bin')['ETag'].strip('"')
+    assert etag.endswith('-3')
+    assert local_etag(path, 5 * MB, 5 * MB) == etag
+
+    upload_file_to_s3(path, 's3://example-bucket/single.bin', transfer_config(multipart_threshold=64))
+    etag = bucket.head_object(Bucket='example-bucket', Key='single.bin')['ETag'].strip('"')
+    assert local_etag(path, 64 * MB) == etag
+
+
+def test_local_etag_unhappy(tmp_path):
+    """test if local_etag() is provided a path that does not exist"""
+    with pytest.raises(OSError):
+        local_etag(str(tmp_path / 'missing.bin'))
+
+
+def test_upload_file_to_s3(tmp_path, bucket):
+    """test if upload_file_to_s3() skips a file that is unchanged in s3 and uploads a changed one"""
+    path = tmp_path / 'clean_data.csv'
+    path.write_text('a,b\n1,2\n')
+    assert upload_file_to_s3(str(path), 's3://example-bucket/data/clean_data.csv')
+    assert not upload_file_to_s3(str(path), 's3://example-bucket/data/clean_data.csv')
+
+    path.write_text('a,b\n1,3\n')
+    assert upload_file_to_s3(str(path), 's3://example-bucket/data/clean_data.csv')
+    assert upload_file_to_s3(str(path), 's3://example-bucket/data/clean_data.csv',
+                             skip_unchanged=False)
+
+
+def test_upload_file_to_s3_multipart(tmp_path, bucket):
+    """test if upload_file_to_s3() skips unchanged multipart files that are not a multiple of the part size"""
+    for size, chunksize in [(20, 8), (17, 8), (11, 5), (16, 8)]:
+        path = str(tmp_path / ('data_%i.bin' % size))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size * MB))
+        config = transfer_config(multipart_threshold=chunksize, multipart_chunksize=chunksize)
+
+        assert upload_file_to_s3(path, 's3://example-bucket/%i.bin' % size, config)
+        assert not upload_file_to_s3(path, 's3://example-bucket/%i.bin' % size, config)
+
+    # uploaded with other settings, the part size is guessed from the number of parts
+    assert is_unchanged(str(tmp_path / 'data_16.bin'), bucket.head_object(Bucket='example-bucket', Key='16.bin'),
+                        transfer_config(multipart_threshold=4, multipart_chunksize=4))
+
+
+def test_upload_file_to_s3_unhappy(tmp_path, bucket):
+    """test if upload_file_to_s3() is provided a file that does not exist"""
+    with pytest.raises(OSError):
+        upload_file_to_s3(str(tmp_path / 'missing.csv'), 's3://example-bucket/missing.csv')
+
+
+def test_download_file_from_s3(tmp_path, bucket):
+    """test if download_file_from_s3() skips a local file that is unchanged"""
+    bucket.put_object(Bucket='example-bucket', Key='raw.csv', Body=b'a,b\n1,2\n')
+    path = str(tmp_path / 'raw.csv')
+    assert download_file_from_s3(path, 's3://example-bucket/raw.csv')
+    assert open(path).read() == 'a,b\n1,2\n'
+    assert not download_file_from_s3(path, 's3://example-bucket/raw.csv')
+    assert is_unchanged(path, bucket.head_object(Bucket='example-bucket', Key='raw.csv'))
+
+
+def test_download_file_from_s3_unhappy(tmp_path, bucket):
+    """test if download_file_from_s3() is provided an object that does not exist"""
+    with pytest.raises(Exception):
+        download_file_from_s3(str(tmp_path / 'raw.csv'), 's3://example-bucket/missing.csv')
+    assert not os.path.exists(str(tmp_path / 'raw.csv'))
+
+
+def test_sync_to_s3(tmp_path, bucket):
+    """test if sync_to_s3() and sync_from_s3() round trip a directory and skip unchanged files"""
+    local = tmp_path / 'catalog'
+    (local / 'v1').mkdir(parents=True)
+    (local / 'CURRENT').write_text('v1')
+    (local / 'v1' / 'meta.json').write_text('{}')
+
+    assert sync_to_s3(str(local), 's3://example-bucket/catalog') == {'transferred': 2, 'skipped': 0}
+    assert sync_to_s3(str(local), 's3://example-bucket/catalog/') == {'transferred': 0, 'skipped': 2}
+
+    copy = tmp_path / 'copy'
+    assert sync_from_s3('s3://example-bucket/catalog', str(copy)) == {'transferred': 2, 'skipped': 0}
+    assert (copy / 'v1' / 'meta.json').read_text() == '{}'
+    assert sync_from_s3('s3://example-bucket/catalog', str(copy)) == {'transferred': 0, 'skipped': 2}
+
+
+def test_sync_to_s3_unhappy(tmp_path, bucket):
+    """test if sync_to_s3() and sync_from_s3() are provided an empty directory and prefix"""
+    assert sync_to_s3(str(tmp_path), 's3://example-bucket/empty') == {'transferred': 0, 'skipped': 0}
+    assert sync_from_s3('s3://example-bucket/empty', str(tmp_path)) == \
+        {'transferred': 0, 'skipped': 0}
+
+
+def test_open_s3_stream(bucket):
+    """test if open_s3_stream() reads plain and gzip objects in small chunks"""
+    body = b''.join(b'%i,bar %i\n' % (i, i) for i in range(1000))
+    bucket.put_object(Bucket='example-bucket', Key='raw.csv', Body=body)
+    bucket.put_object(Bucket='example-bucket', Key='raw.csv.gz', Body=gzip.compress(body))
+
+    assert open_s3_stream('s3://example-bucket/raw.csv', chunk_size=64).read() == body
+    with open_s3_stream('s3://example-bucket/raw.csv.gz', chunk_size=64) as stream:
+        assert stream.readline() == b'0,bar 0\n'
+        assert stream.read() == body[len(b'0,bar 0\n'):]
+
+
+def test_open_s3_stream_unhappy(bucket):
+    """test if open_s3_stream() is provided an unsupported compression or a missing object"""
+    bucket.put_object(Bucket='example-bucket', Key='raw.csv', Body=b'a,b\n')
+    with pytest.raises(ValueError):
+        open_s3_stream('s3://example-bucket/raw.csv', compression='zip')
+    with pytest.raises(Exception):
+        open_s3_stream('s3://example-bucket/missing.csv')
@@ -0,0 +1,90 @@
+import os
+import time
+
+import pytest
+
+import src.stage_cache
+from src.stage_cache import StageCache, code_version, input_hash
+
+
+def test_input_hash(tmp_path):
+    """test if input_hash() changes with the content of a local file"""
+    path = tmp_path / 'raw.csv'
+    path.write_text('a,b\n1,2\n')
+    digest = input_hash(str(path))
+    assert digest == input_hash(str(path))
+    path.write_text('a,b\n1,3\n')
+    assert digest != input_hash(str(path))
+    assert len(code_version(src.stage_cache)) == 64
+
+
+def test_input_hash_unhappy(tmp_path):
+    """test if input_hash() is provided a file that does not exist"""
+    with pytest.raises(OSError):
+        input_hash(str(tmp_path / 'missing.csv'))
+
+
+def test_stage_cache(tmp_path):
+    """test if StageCache runs a stage once and restores its outputs when the fingerprint is unchanged"""
+    cache = StageCache(str(tmp_path / 'cache'))
+    output = tmp_path / 'out' / 'clean.csv'
+    runs = []
+
+    def compute():
+        runs.append(1)
+        output.parent.mkdir(exist_ok=True)
+        output.write_text('cleaned %i' % len(runs))
+
+    key = cache.fingerprint('clean', {'binary_word': 'not'}, ['input'], 'code')
+    assert cache.run('clean', key, {'clean.csv': str(output)}, compute)
+    output.unlink()
+    assert not cache.run('clean', key, {'clean.csv': str(output)}, compute)
+    assert output.read_text() == 'cleaned 1'
+
+    changed = cache.fingerprint('clean', {'binary_word': 'no'}, ['input'], 'code')
+    assert changed != key
+    assert cache.run('clean', changed, {'clean.csv': str(output)}, compute)
+    assert len(runs) == 2
+
+
+def test_stage_cache_unhappy(tmp_path):
+    """test if StageCache reruns disabled stages and stages without a complete cache entry"""
+    output = tmp_path / 'clean.csv'
+    output.write_text('cleaned')
+    disabled = StageCache(str(tmp_path / 'cache'), enabled=False)
+    disabled.store('key', {'clean.csv': str(output)})
+    assert not disabled.restore('key', {'clean.csv': str(output)})
+
+    cache = StageCache(str(tmp_path / 'cache'))
+    cache.store('key', {'clean.csv': str(output)})
+    assert not cache.restore('key', {'clean.csv': str(output), 'model.joblib': str(output)})
+    assert not cache.restore('other', {'clean.csv': str(output)})
+
+
+def test_stage_cache_evict(tmp_path):
+    """test if StageCache keeps only the most recently used entries"""
+    output = tmp_path / 'clean.csv'
+    output.write_text('cleaned')
+    cache = StageCache(str(tmp_path / 'cache'), keep=2)
+
+    for age, key in [(30, 'a'), (20, 'b')]:
+        cache.store(key, {'clean.csv': str(output)})
+        os.utime(str(tmp_path / 'cache' / key), (time.time() - age, time.time() - age))
+    # restoring a makes it the most recently used entry
+    assert cache.restore('a', {'clean.csv': str(output)})
+    cache.store('c', {'clean.csv': str(output)})
+
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == ['a', 'c']
+
+
+def test_stage_cache_evict_unhappy(tmp_path):
+    """test if StageCache without keep, or without a directory, evicts nothing"""
+    output = tmp_path / 'clean.csv'
+    output.write_text('cleaned')
+    assert StageCache(str(tmp_path / 'missing'), keep=1).evict() == []
+
+    cache = StageCache(str(tmp_path / 'cache'))
+    for key in ['a', 'b', 'c']:
+        cache.store(key, {'clean.csv': str(output)})
+    assert cache.evict() == []
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 3
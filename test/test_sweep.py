@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+from joblib import load
+
+from src.sweep import sweep_kmeans
+
+
+def test_sweep_kmeans(tmp_path):
+    """test if sweep_kmeans() scores every grid point and promotes the best one"""
+    rng = np.random.RandomState(12)
+    centers = np.array([[-6, -6], [0, 6], [6, -6]])
+    df_in = pd.DataFrame(np.concatenate([rng.normal(center, 0.5, size=(40, 2)) for center in centers]),
+                         columns=['feature1', 'feature2'])
+    model_save_path = str(tmp_path / 'kmeans.joblib')
+    results_save_path = str(tmp_path / 'sweep_results.csv')
+
+    model, results = sweep_kmeans(df_in, ['feature1', 'feature2'], [2, 3, 5], [12, 42], model_save_path,
+                                  results_save_path, n_workers=2)
+
+    assert len(results) == 6
+    assert model.n_clusters == 3
+    assert load(model_save_path).n_clusters == 3
+    assert pd.read_csv(results_save_path).iloc[0]['n_cluster'] == 3
+    assert results['best'].sum() == 1
+
+
+def test_sweep_kmeans_unhappy(tmp_path):
+    """test if a metric that is not computed is rejected by sweep_kmeans()"""
+    df_in = pd.DataFrame(np.random.RandomState(12).normal(size=(20, 2)), columns=['feature1', 'feature2'])
+
+    with pytest.raises(ValueError):
+        sweep_kmeans(df_in, ['feature1', 'feature2'], [2], [12], str(tmp_path / 'kmeans.joblib'),
+                     str(tmp_path / 'sweep_results.csv'), select_metric='accuracy', n_workers=1)
@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+import yaml
+
+from benchmarks.synthetic import generate_catalog
+from src.clean_data import clean
+
+
+def test_generate_catalog(tmp_path):
+    """test if generate_catalog() is reproducible and its records go through clean()"""
+    with open('config/config.yaml') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    raw = pd.read_csv('data/chocolate_data/chocolate.csv', index_col=0, nrows=5)
+
+    data = generate_catalog(500, seed=1)
+    assert list(data.columns) == list(raw.columns)
+    pd.testing.assert_frame_equal(data, generate_catalog(500, seed=1))
+
+    df = clean(data, **dict(config['clean_data']['clean'], store_path=str(tmp_path / 'clean.csv')))
+    assert len(df) == 500
+    assert set(df['vanilla'].unique()) <= {0, 1}
+    assert df['beans'].eq(1).all()
+
+
+def test_generate_catalog_unhappy():
+    """test if generate_catalog() is asked for an empty catalog"""
+    with pytest.raises(ValueError):
+        generate_catalog(0)